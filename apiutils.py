@@ -6,6 +6,7 @@ __docformat__ = 'reStructuredText'
 
 
 import re
+import struct
 import urllib.parse
 
 re_apicommand = re.compile("^<(?P<command>[a-z]+)(?P<args>( [^ >]+)*)>\r?$",re.I|re.M)
@@ -25,6 +26,26 @@ encoding_defaults = (default_encoding,default_encoding_errors)
 """tuple: convenience value containing (:data:`.default_encoding`, 
 :data:`default_encoding_errors`)"""
 
+compact_peer = struct.Struct("!4sHQQI")
+"""`Struct object`: binary peer record of compact tracker responses.
+
+Packs a peer-line's IPv4 address (4 bytes), port, start byte, end byte and
+timestamp into 26 bytes, in network byte order. A timestamp of 0 marks a
+removed peer.
+"""
+
+compact_range = struct.Struct("!4sHQQ")
+"""`Struct object`: binary byte range record of a peer announcing several
+ranges.
+
+Packs a peer's IPv4 address (4 bytes), port, and the start and end bytes of
+one of its ranges into 22 bytes, in network byte order.
+"""
+
+max_ranges = 64
+"""int: most byte ranges :func:`ranges_decode` accepts, so most ranges a peer
+may announce for a file."""
+
 def arg_encode(arg):
     """Encoding function for API data.
     
@@ -38,3 +59,29 @@ def arg_decode(arg):
     This is a convenience function to allow encoding to uniformly change.
     """
     return urllib.parse.unquote_plus(arg)
+
+def ranges_encode(ranges):
+    """Encode (start_byte, end_byte) pairs as ``start-end,start-end,...``."""
+    return ",".join( "{}-{}".format(start, end) for start, end in ranges )
+
+def ranges_decode(arg):
+    """Decode a list of byte ranges encoded with :func:`ranges_encode`.
+    
+    Raises:
+        ValueError: if *arg* is malformed, or lists more than
+            :data:`max_ranges` ranges.
+    """
+    parts = arg.split(",", max_ranges)
+    if len(parts) > max_ranges:
+        raise ValueError("More than {} byte ranges".format(max_ranges))
+    
+    ranges = []
+    
+    for part in parts:
+        start, sep, end = part.partition("-")
+        if not sep:
+            raise ValueError("Malformed byte range {!r}".format(part))
+        
+        ranges.append( (int(start), int(end)) )
+    
+    return ranges
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Peer chunk server throughput benchmark.
+
+Serves a file from a :class:`~peer.PeerServer` in a child process and
+downloads it with ``RAW=1`` GET SEG requests, once reading every chunk into
+memory before sending it and once sending it with ``sendfile``. For each
+chunk size, reports the MB/s received and the MB/s served per second of CPU
+time used by the server process.
+
+Usage::
+
+    ./bench/bench_peerserve.py [--size MB] [--chunks BYTES [BYTES ...]]
+                               [--clients N] [--repeat R]
+"""
+
+import argparse
+import multiprocessing
+import os
+import os.path
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+SRC_DIR = os.path.realpath( os.path.join( os.path.dirname(__file__), '..' ) )
+sys.path.insert(0, SRC_DIR)
+
+import peer
+
+
+FNAME = "bench.bin"
+
+
+def serve(directory, chunk_size, sendfile, conn):
+    """Child process: serve *directory* until told to stop through *conn*, then
+    send back the CPU time used."""
+    peer.CHUNK_SIZE = chunk_size
+    peer.SENDFILE = sendfile
+    peer.SENDFILE_MIN_SIZE = 0
+
+    # the handlers log every chunk
+    sys.stdout = open(os.devnull, "w")
+
+    server = peer.PeerServer( ('127.0.0.1', 0), peer.PeerServerHandler,
+                              torrents_dir=directory )
+    threading.Thread( target=server.serve_forever, daemon=True ).start()
+
+    start = time.process_time()
+    conn.send( server.server_address[1] )
+    conn.recv()
+    end = time.process_time()
+
+    conn.send( end - start )
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(port, offsets, chunk_size):
+    """Download the chunks at *offsets*, one connection per request."""
+    buf = memoryview( bytearray(chunk_size) )
+
+    for offset in offsets:
+        sock = socket.create_connection( ('127.0.0.1', port) )
+        sock.sendall( "<GET SEG {} {} {} RAW=1>".format( FNAME, offset,
+                                                         chunk_size ).encode() )
+        header, length = peer.networkutil.recvsegment(sock, buf)
+        sock.close()
+
+        if length is None:
+            raise RuntimeError(header)
+
+
+def run(directory, size, chunk_size, sendfile, clients):
+    """Download the whole file once, returning (wall seconds, server CPU seconds)."""
+    ours, theirs = multiprocessing.Pipe()
+    child = multiprocessing.Process( target=serve,
+                        args=(directory, chunk_size, sendfile, theirs) )
+    child.start()
+    port = ours.recv()
+
+    offsets = list( range(0, size, chunk_size) )
+    threads = [ threading.Thread( target=fetch,
+                                  args=(port, offsets[i::clients], chunk_size) )
+                for i in range(clients) ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    ours.send(None)
+    cpu = ours.recv()
+    child.join()
+
+    return wall, cpu
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument("--size", type=int, default=64, help="file size in MB")
+    parser.add_argument("--chunks", type=int, nargs="+",
+                        default=[1024, 65536, 1 << 20])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size << 20
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open( os.path.join(directory, FNAME), "wb" ) as file:
+            file.write( os.urandom(size) )
+        with open( os.path.join(directory, FNAME + ".log"), "w" ) as log:
+            log.write( "0:{}\n".format(size) )
+
+        print("{:>8}  {:>10} {:>12}  {:>10} {:>12}".format( "chunk",
+                "read MB/s", "MB/s/core", "sendfile", "MB/s/core" ))
+
+        for chunk_size in args.chunks:
+            results = []
+
+            for sendfile in (False, True):
+                best = None
+                for _ in range(args.repeat):
+                    wall, cpu = run(directory, size, chunk_size, sendfile,
+                                    args.clients)
+                    if best is None or wall < best[0]:
+                        best = (wall, cpu)
+
+                wall, cpu = best
+                results += [ args.size / wall, args.size / cpu ]
+
+            print("{:>8}  {:>10.1f} {:>12.1f}  {:>10.1f} {:>12.1f}".format(
+                                                        chunk_size, *results ))
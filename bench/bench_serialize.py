@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Tracker file serialization benchmark.
+
+For trackers of growing peer counts, times writing the .track file to a
+buffer and sending it over a local socket, one ``write``/``sendall`` per line
+as :meth:`~trackerfile.trackerfile.writeTo` and
+:meth:`~trackerfile.trackerfile.writeToSocket` used to, against the single
+buffer they build now.
+
+Usage::
+
+    ./bench/bench_serialize.py [--peers N [N ...]] [--repeat R]
+"""
+
+import argparse
+import io
+import os
+import os.path
+import socket
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.realpath( os.path.join( os.path.dirname(__file__), '..' ) )
+sys.path.insert(0, SRC_DIR)
+
+import apiutils
+import trackerfile
+
+
+MD5 = "0123456789abcdef0123456789abcdef"
+FSIZE = 1 << 30
+
+
+def make_tracker(peers):
+    """A tracker with *peers* peers."""
+    tf = trackerfile.trackerfile( "bench.file", FSIZE, "bench", MD5 )
+
+    for i in range(peers):
+        tf.updatePeer( "10.{}.{}.{}".format( (i >> 16) & 255, (i >> 8) & 255,
+                                             i & 255 ),
+                       1024 + i % 60000, 0, (i * 4096) % FSIZE )
+
+    return tf
+
+
+def lines(tf):
+    return list( tf._metadataGenerator() ) + list( tf._peerGenerator() )
+
+
+def write_per_line(tf, fileobj):
+    for line in lines(tf):
+        fileobj.write( line + "\n" )
+
+
+def send_per_line(tf, sock):
+    for line in lines(tf):
+        sock.sendall( bytes(line + "\n", *apiutils.encoding_defaults) )
+
+
+def drain(sock):
+    """Read *sock* until it is closed."""
+    while sock.recv(1 << 16):
+        pass
+
+
+def timeit(func, repeat):
+    """Best wall time of *repeat* calls of *func*, in ms."""
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000
+
+
+def time_socket(send, repeat):
+    """Best time of *repeat* calls of *send(sock)* on a fresh connected
+    socket pair, in ms, including the time for the reader to get it all."""
+    best = None
+
+    for _ in range(repeat):
+        writer, reader = socket.socketpair()
+        thread = threading.Thread( target=drain, args=(reader,) )
+        thread.start()
+
+        start = time.perf_counter()
+        send(writer)
+        writer.close()
+        thread.join()
+        elapsed = time.perf_counter() - start
+
+        reader.close()
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument("--peers", type=int, nargs="+",
+                        default=[10, 100, 1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    print("{:>7}  {:>12} {:>12}  {:>12} {:>12}".format( "peers",
+            "write/line", "writeTo", "send/line", "writeToSocket" ))
+
+    for peers in args.peers:
+        tf = make_tracker(peers)
+
+        buf = io.StringIO()
+        write_per_line(tf, buf)
+        assert buf.getvalue() == tf.toBytes().decode()
+
+        print("{:>7}  {:>9.2f} ms {:>9.2f} ms  {:>9.2f} ms {:>9.2f} ms".format(
+                peers,
+                timeit( lambda: write_per_line(tf, io.StringIO()), args.repeat ),
+                timeit( lambda: tf.writeTo(io.StringIO()), args.repeat ),
+                time_socket( lambda sock: send_per_line(tf, sock), args.repeat ),
+                time_socket( tf.writeToSocket, args.repeat ) ))
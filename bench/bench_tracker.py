@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Tracker server throughput benchmark.
+
+Starts a tracker in a child process, creates one tracker file on it, then
+fires a storm of concurrent updatetracker announces from an asyncio client
+and reports requests/sec and latency percentiles. Both the threaded
+:class:`~server.TrackerServer` and the :class:`~server.AsyncTrackerServer`
+are measured.
+
+Every announce comes from a distinct peer, so afterwards the peers holding
+any byte of the file are counted with ``<REQ PEERS>``, whose total isn't
+capped like the peer-lines of a full GET: any missing peer is a lost update,
+and the script exits with a non-zero status.
+
+Usage::
+
+    ./bench/bench_tracker.py [--requests N] [--concurrency C]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.realpath( os.path.join( os.path.dirname(__file__), '..' ) )
+sys.path.insert(0, SRC_DIR)
+
+import server
+
+
+PORT = 19876
+MD5 = "0123456789abcdef0123456789abcdef"
+FSIZE = 1 << 20
+
+
+def run_server(kind, config_path):
+    """Child process body: serve until killed."""
+    sys.stdout = open(os.devnull, 'w')
+    
+    if kind == 'asyncio':
+        srv = server.AsyncTrackerServer( "127.0.0.1",
+                                         server.TrackerServerHandler,
+                                         config_file=config_path )
+    else:
+        srv = server.TrackerServer( "127.0.0.1", server.TrackerServerHandler,
+                                    config_file=config_path )
+    srv.serve_forever()
+
+
+def wait_for_port(port, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not come up")
+
+
+async def fetch(message):
+    """Send one API message and return the response."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    writer.write( message.encode() )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def request(message):
+    """Send one API message and read the response; return latency in s."""
+    start = time.perf_counter()
+    await fetch(message)
+    return time.perf_counter() - start
+
+
+async def storm(total, concurrency):
+    latencies = []
+    errors = []
+    sem = asyncio.Semaphore(concurrency)
+    
+    async def one(i):
+        async with sem:
+            ip = "10.{}.{}.{}".format( (i >> 16) & 255, (i >> 8) & 255, i & 255 )
+            msg = "<updatetracker bench.file 0 {} {} {}>".format(
+                                                FSIZE - 1, ip, 1024 + i % 60000 )
+            try:
+                latencies.append( await request(msg) )
+            except OSError as err:
+                errors.append(err)
+    
+    start = time.perf_counter()
+    await asyncio.gather( *(one(i) for i in range(total)) )
+    return time.perf_counter() - start, sorted(latencies), len(errors)
+
+
+def bench(kind, total, concurrency):
+    workdir = tempfile.mkdtemp()
+    config_path = os.path.join(workdir, "server.cfg")
+    with open(config_path, 'w') as fl:
+        fl.write("{}\n{}\n".format( PORT, os.path.join(workdir, "torrents") ))
+    
+    proc = multiprocessing.Process( target=run_server,
+                                    args=(kind, config_path), daemon=True )
+    proc.start()
+    
+    try:
+        wait_for_port(PORT)
+        asyncio.run( request("<createtracker bench.file {} bench {} 10.0.0.1 "
+                             "1024>".format(FSIZE, MD5)) )
+        
+        elapsed, lat, errors = asyncio.run( storm(total, concurrency) )
+        
+        response = asyncio.run( fetch("<REQ PEERS bench.file.track 0 {} "
+                                      "0>".format(FSIZE - 1)) ).decode()
+        peers = int( response.split(">", 1)[0].split()[-1] )
+    
+    finally:
+        proc.terminate()
+        proc.join()
+        shutil.rmtree(workdir)
+    
+    #the creator is a peer too
+    lost = len(lat) + 1 - peers
+    
+    pct = lambda p: lat[ min(len(lat) - 1, int(len(lat) * p)) ] * 1000
+    print("{:>9}: {:8.0f} req/s   p50 {:6.2f} ms   p99 {:6.2f} ms   "
+          "{} errors   {} lost updates".format( kind, len(lat) / elapsed,
+                                    pct(0.50), pct(0.99), errors, lost ))
+    
+    return lost
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+    
+    lost = 0
+    for kind in ('threaded', 'asyncio'):
+        lost += bench(kind, args.requests, args.concurrency)
+    
+    sys.exit( 1 if lost else 0 )
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Tracker file parsing microbenchmark.
+
+Builds a .track file with many peers, then times parsing it with
+:meth:`~trackerfile.trackerfile.fromFileObject` against the line-by-line
+:meth:`~trackerfile.trackerfile.parseLine` path every line used to take, and
+times writing it back out with :meth:`~trackerfile.trackerfile.toString`.
+
+Usage::
+
+    ./bench/bench_trackerfile.py [--peers N] [--repeat R]
+"""
+
+import argparse
+import io
+import os
+import os.path
+import sys
+import time
+
+SRC_DIR = os.path.realpath( os.path.join( os.path.dirname(__file__), '..' ) )
+sys.path.insert(0, SRC_DIR)
+
+import trackerfile
+
+
+MD5 = "0123456789abcdef0123456789abcdef"
+FSIZE = 1 << 30
+STAMP = 1500000000
+
+
+def make_track(peers):
+    """A .track file with *peers* peer-lines, as a string."""
+    lines = [ "Filename: bench.file", "Filesize: {}".format(FSIZE),
+              "Description: bench", "MD5: {}".format(MD5) ]
+
+    for i in range(peers):
+        lines.append( "10.{}.{}.{}:{}:0:{}:{}".format(
+                            (i >> 16) & 255, (i >> 8) & 255, i & 255,
+                            1024 + i % 60000, (i * 4096) % FSIZE, STAMP + i ) )
+
+    return "\n".join(lines) + "\n"
+
+
+def parse_lines(text):
+    """Parse *text* one line at a time through parseLine, building a dict of
+    :class:`~ipaddress.IPv4Address` and :class:`~datetime.datetime` values."""
+    metadata = {}
+    peers = {}
+
+    for line in io.StringIO(text):
+        parsed = trackerfile.trackerfile.parseLine(line)
+
+        if parsed and len(parsed) == 2:
+            metadata[ parsed[0] ] = parsed[1]
+        elif parsed:
+            peers[ parsed[0:2] ] = parsed[2:]
+
+    return metadata, peers
+
+
+def timeit(func, repeat):
+    """Best wall time of *repeat* calls of *func*, in ms."""
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument("--peers", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    text = make_track(args.peers)
+    tf = trackerfile.trackerfile.fromFileObject( io.StringIO(text) )
+    assert len(tf._peers) == args.peers
+    assert tf.toString() + "\n" == text
+
+    results = [
+        ("parseLine", lambda: parse_lines(text)),
+        ("fromFileObject",
+            lambda: trackerfile.trackerfile.fromFileObject(io.StringIO(text))),
+        ("fromFileObject+items",
+            lambda: list( trackerfile.trackerfile.fromFileObject(
+                                            io.StringIO(text))._peers.items() )),
+        ("toString", tf.toString),
+    ]
+
+    print("{} peers, best of {}:".format(args.peers, args.repeat))
+    for name, func in results:
+        print("{:>22}: {:8.2f} ms".format( name, timeit(func, args.repeat) ))
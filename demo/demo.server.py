@@ -29,4 +29,5 @@ except KeyboardInterrupt:
     
 finally:
     srv.shutdown()
+    srv.server_close()
     print("Tracker server has shut down")
@@ -3,7 +3,7 @@
 """
 
 from clientInterface import *
-import base64, hashlib
+import base64, collections, hashlib
 import cmd, argparse
 import os, sys, time, random
 import selectors, socket, socketserver
@@ -13,23 +13,97 @@ myip = None
 
 STARTPORT = 11000
 CHUNK_SIZE = 1024
+SEGMENT_SIZE = 1 << 20
+MAX_SEGMENT_SIZE = 4 << 20
 MAX_DATA_SIZE = 4096
+RANGE_QUERY_PEERS = 50
+RANGE_QUERY_LIMIT = 20
+INTERVAL = 3
+COMPACT_PEERS = True
+SENDFILE = hasattr(os, "sendfile")
+SENDFILE_MIN_SIZE = 65536
+KEEPALIVE_TIMEOUT = 30
+CONNECT_TIMEOUT = 5
+OPEN_FILES = 64
+FILE_CHECK_INTERVAL = 1
 
 class PeerServerHandler(socketserver.BaseRequestHandler):
     """The request handler for PeerServer.
     """
     
+    frame = None
+
     def handle(self):
+        """Receive a peer request and pass it to :meth:`dispatch`.
+
+        This method is called when a connection is accepted. A connection
+        starting with ``<KEEPALIVE>`` is handed over to :meth:`keepAlive`
+        instead.
+        """
+        data = self.request.recv(MAX_DATA_SIZE)
+
+        if data.startswith(b"<KEEPALIVE>"):
+            return self.keepAlive(data[len(b"<KEEPALIVE>"):].lstrip(b"\r\n"))
+
+        self.dispatch(str(data, *apiutils.encoding_defaults))
+
+    def keepAlive(self, data):
+        """Serve segment requests on a persistent connection.
+
+        Answers ``<KEEPALIVE timeout>``, then the client may send any number of
+        newline-terminated requests without waiting for responses. Each request
+        may end with an ``ID=id`` option. The responses come back in order, each
+        preceded by a ``<FRAME id length>`` line, or ``<FRAME length>`` for
+        requests without an ID. The connection is closed when the client closes it,
+        after KEEPALIVE_TIMEOUT idle seconds, or after a request which is too long.
+
+        Args:
+            data (bytes): what the client sent after ``<KEEPALIVE>``.
+        """
+        self.request.settimeout(KEEPALIVE_TIMEOUT)
+        self.request.sendall(bytes("<KEEPALIVE {}>\n".format(KEEPALIVE_TIMEOUT), *apiutils.encoding_defaults))
+
+        while True:
+            while b"\n" not in data:
+                if len(data) > MAX_DATA_SIZE:
+                    self.frame = ""
+                    return self.exception("RequestTooLong", "Maximum message length is {}".format(MAX_DATA_SIZE))
+
+                try:
+                    chunk = self.request.recv(MAX_DATA_SIZE)
+                except OSError:
+                    return
+
+                if not chunk:
+                    return
+                data += chunk
+
+            line, _, data = data.partition(b"\n")
+            line = str(line, *apiutils.encoding_defaults).rstrip("\r")
+
+            # Take the ID off, it only goes in the frame
+            head, sep, ident = line.rpartition(" ID=")
+            if sep and ident[:-1].isdigit() and ident.endswith(">"):
+                line, self.frame = head + ">", ident[:-1]
+            else:
+                self.frame = ""
+
+            self.responded = False
+            self.dispatch(line)
+            if not self.responded:
+                self.respond()
+
+    def dispatch(self, data):
         """Convert peer requests into into api_* methods
 
-        This method is called when data is received. It interprets the
-        command-and-arguments structure dictated by the API into a method
-        to which the interpreted arguments are passed. Arguments are decoded
-        using :func:`apiutils.arg_decode` before being passed on, but they
-        remain strings.
+        It interprets the command-and-arguments structure dictated by the API
+        into a method to which the interpreted arguments are passed. Arguments
+        are decoded using :func:`apiutils.arg_decode` before being passed on,
+        but they remain strings.
+
+        Args:
+            data (str): the request.
         """
-        data = str(self.request.recv(MAX_DATA_SIZE), *apiutils.encoding_defaults)
-        
         #Retrieve command and args from message
         match = apiutils.re_apicommand.match( data )
         if not match:
@@ -60,50 +134,84 @@ class PeerServerHandler(socketserver.BaseRequestHandler):
                 print("Bad Request: {}".format(err.args[0]))
                 return self.exception('BadRequest', err.args[0])
 
-    def api_get(self, seg, fname, start_byte, chunk_size):
+    def api_get(self, seg, fname, start_byte, chunk_size, *options):
         """Implements the peer's GET API command.
         
         All arguments are expected to be strings, but *start_byte* and *chunk_size*
-        should be castable to :class:`int`.
+        should be castable to non-negative :class:`int`\ s, or the request is answered
+        with a BadRequest exception. Requests for more than MAX_SEGMENT_SIZE bytes
+        are answered with ``<GET invalid MAX_SEGMENT_SIZE>``, advertising the largest
+        segment size we serve.
+
+        The payload is sent base64 encoded after a ``<GET GOT length>`` line, or, with
+        the ``RAW=1`` option, as raw bytes after a ``<GET RAW length>`` line.
         """
         if seg != "SEG":
             print("GET Error: {}".format(seg))
             return self.exception("BadRequest", "'SEG' expected")
+
+        raw = False
+        for option in options:
+            key, sep, value = option.partition("=")
+            if not sep:
+                return self.exception("BadRequest", "Malformed option {!r}".format(option))
+            if key.upper() == "RAW":
+                raw = value not in ("", "0")
+
+        # Check the range before anything is sent, a header can't be taken back
+        try:
+            start_byte, chunk_size = int(start_byte), int(chunk_size)
+        except ValueError:
+            return self.exception("BadRequest", "start_byte and chunk_size must be integers")
+        if start_byte < 0 or chunk_size < 0:
+            return self.exception("BadRequest", "start_byte and chunk_size can't be negative")
+
         #print("Received request for '{}', starting from byte {} with chunk size {}".format(fname, start_byte, chunk_size))
-        if int(chunk_size) > CHUNK_SIZE:
-            return self.request.sendall(b"<GET invalid>\n")
+        if chunk_size > MAX_SEGMENT_SIZE:
+            return self.respond(bytes("<GET invalid {}>\n".format(MAX_SEGMENT_SIZE), *apiutils.encoding_defaults))
         
-        # Check if a log file exists for the file
-        tracker = os.path.join(self.server.torrents_dir, fname + ".log")
-        if not os.path.isfile(tracker):
-            return self.exception("NotHostingFile", "Peer does not have a logfile for '{}'.".format(fname))
-
-        # Open the file
-        path = os.path.join(self.server.torrents_dir, fname)
-        if not os.path.isfile(path):
-            path = path + ".cache"
-        if not os.path.isfile(path):
+        # Get the file, or its .cache while it is being downloaded
+        try:
+            file = self.server.files.acquire(fname)
+        except OSError:
+            # Since the file doesn't exist, let the tracker know you're no longer hosting it
             downloader.updatetracker(fname, 0, 0, thost, tport)
             return self.exception("FileException", "Could not find file for torrent '{}'".format(fname))
 
+        if file is None:
+            return self.exception("NotHostingFile", "Peer does not have a logfile for '{}'.".format(fname))
+
         try:
-            with open(path, "rb") as file:
-                file.seek(int(start_byte))
-                payload = file.read(int(chunk_size))
+            if raw and SENDFILE and chunk_size >= SENDFILE_MIN_SIZE:
+                # Sent below straight from the page cache to the socket
+                payload = None
+                length = max(0, min(chunk_size, os.fstat(file.fileno()).st_size - start_byte))
+            else:
+                payload = os.pread(file.fileno(), chunk_size, start_byte)
+                length = len(payload)
 
-                # Transmit up to chunk_size bytes
-                response = "<GET GOT {}>\n".format(len(payload))
-                response += bytes.decode(base64.b64encode(payload), "UTF-8")
         except Exception as err:
             print(str(err))
-            # Since the file doesn't exist, let the tracker know you're no longer hosting it
+            self.server.files.release(file)
 
             # Return an Exception
             return self.exception("Exception when trying to serve file", str(err))
 
-
-        self.request.sendall( bytes(response, *apiutils.encoding_defaults) )
-        print("Transmitted bytes {}-{} of file {}".format(start_byte, int(start_byte) + len(payload), fname))
+        # Transmit up to chunk_size bytes
+        try:
+            if payload is None:
+                header = bytes("<GET RAW {}>\n".format(length), *apiutils.encoding_defaults)
+                self.respond(header, segment=(file, start_byte, length))
+            elif raw:
+                header = bytes("<GET RAW {}>\n".format(length), *apiutils.encoding_defaults)
+                self.respond(header, payload)
+            else:
+                response = "<GET GOT {}>\n".format(length)
+                response += bytes.decode(base64.b64encode(payload), "UTF-8")
+                self.respond( bytes(response, *apiutils.encoding_defaults) )
+        finally:
+            self.server.files.release(file)
+        print("Transmitted bytes {}-{} of file {}".format(start_byte, start_byte + length, fname))
 
 
 
@@ -118,7 +226,23 @@ class PeerServerHandler(socketserver.BaseRequestHandler):
         response = "<EXCEPTION {}>\n{}<EXCEPTION END>\n".format( exceptionType,
                                                                  exceptionInfo )
     
-        self.request.sendall( bytes(response, *apiutils.encoding_defaults) )
+        self.respond( bytes(response, *apiutils.encoding_defaults) )
+
+    def respond(self, *buffers, segment=None):
+        """Sends a response made of buffers, followed by count bytes of file from offset
+        if segment is (file, offset, count).
+
+        On a kept-alive connection, the response is preceded by its ``<FRAME>`` line.
+        """
+        if self.frame is not None:
+            length = sum(len(buf) for buf in buffers) + (segment[2] if segment else 0)
+            frame = "<FRAME {} {}>\n".format(self.frame, length) if self.frame else "<FRAME {}>\n".format(length)
+            buffers = (bytes(frame, *apiutils.encoding_defaults),) + buffers
+            self.responded = True
+
+        networkutil.sendbuffers(self.request, buffers)
+        if segment:
+            networkutil.sendfile(self.request, *segment)
 
 class PeerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """The socket server for handling incoming requests.
@@ -132,11 +256,16 @@ class PeerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         """PeerServer initializer. Extends TCPServer constructor
         """
         self.torrents_dir = torrents_dir
+        self.files = filecache(self.torrents_dir)
         
         
         super(PeerServer, self).__init__(address, RequestHandlerClass,
                                             bind_and_activate)
 
+    def server_close(self):
+        super(PeerServer, self).server_close()
+        self.files.clear()
+
     @property
     def torrents_dir(self):
         return self.__torrents_dir
@@ -152,6 +281,134 @@ class PeerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
             
         
     
+class openfile():
+    """ A file opened for reading by :class:`filecache`
+    """
+
+    def __init__(self, path, logpath, fd):
+        self.path = path
+        self.logpath = logpath
+        self.fd = fd
+        self.inode = os.fstat(fd).st_ino
+        self.checked = time.monotonic()
+        self.users = 0
+        self.evicted = False
+
+    def fileno(self):
+        return self.fd
+
+    def current(self):
+        """ Whether the torrent is still hosted (its .log file exists) and path still is
+        the file opened. Checked at most every FILE_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if now - self.checked < FILE_CHECK_INTERVAL:
+            return True
+
+        try:
+            if os.stat(self.path).st_ino != self.inode or not os.path.isfile(self.logpath):
+                return False
+        except OSError:
+            return False
+
+        self.checked = now
+        return True
+
+
+class filecache():
+    """ Bounded LRU of the files served by the chunk server, kept open and keyed by torrent
+
+    The handler threads share the descriptors, reading them with ``os.pread`` or sending
+    them with sendfile, neither of which moves a file offset. A file is only closed once
+    evicted and released by every thread using it.
+
+    Files still being downloaded are served from their .cache file, which the downloader
+    process renames to the final file once complete. Every FILE_CHECK_INTERVAL seconds an
+    entry checks its path still is the same file and its .log file still exists: entries
+    whose .cache was renamed are reopened from the final path, and replaced files are
+    reopened, while torrents whose .log is gone aren't served anymore.
+    """
+
+    def __init__(self, torrents_dir, size=OPEN_FILES):
+        self.torrents_dir = torrents_dir
+        self.size = size
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, fname):
+        """ Returns the open file of torrent fname, to be released once done with it
+
+        Returns:
+            openfile: The file, or None if we don't host fname (it has no .log file)
+
+        Raises:
+            OSError: if neither the file nor its .cache can be opened
+        """
+        with self.lock:
+            file = self.files.get(fname)
+            if file is not None:
+                self.files.move_to_end(fname)
+                file.users += 1
+
+        if file is not None:
+            if file.current():
+                return file
+            self.invalidate(fname, file)
+            self.release(file)
+
+        logpath = os.path.join(self.torrents_dir, fname + ".log")
+        if not os.path.isfile(logpath):
+            return None
+
+        path = os.path.join(self.torrents_dir, fname)
+        if not os.path.isfile(path):
+            path = path + ".cache"
+        if not os.path.isfile(path):
+            raise FileNotFoundError("No file for torrent '{}'".format(fname))
+
+        fd = os.open(path, os.O_RDONLY)
+        file = openfile(path, logpath, fd)
+        file.users = 1
+
+        with self.lock:
+            if fname in self.files:
+                self.evict(self.files.pop(fname))
+            self.files[fname] = file
+            while len(self.files) > self.size:
+                self.evict(self.files.popitem(last=False)[1])
+
+        return file
+
+    def release(self, file):
+        """ Gives back a file returned by acquire
+        """
+        with self.lock:
+            file.users -= 1
+            if file.evicted and not file.users:
+                os.close(file.fd)
+
+    def invalidate(self, fname, file=None):
+        """ Forgets the open file of torrent fname, closing it once released
+
+        If file is given, the entry is only forgotten if it still is that file, and not
+        one another thread opened in the meantime.
+        """
+        with self.lock:
+            if fname in self.files and (file is None or self.files[fname] is file):
+                self.evict(self.files.pop(fname))
+
+    def clear(self):
+        with self.lock:
+            while self.files:
+                self.evict(self.files.popitem()[1])
+
+    def evict(self, file):
+        # Called with the lock held
+        file.evicted = True
+        if not file.users:
+            os.close(file.fd)
+
+
 class peer():
     """ Main Peer class; handles job-2 and job-3 for file hosting and downloading
     """
@@ -200,7 +457,9 @@ class peer():
                 print(err)
                 return
 
-            # Update the server with each log file
+            # Update the server with each log file, then wait as long as it suggests
+            interval = UPDATE_INTERVAL
+            entries = []
             for file in trackerfiles:
                 if file[-4:].lower() == ".log":
                     log = []
@@ -215,8 +474,16 @@ class peer():
 
                     largest = max(log, key = lambda entry: entry[1] - entry[0])
                     filename = "".join(file.split("/")[-1].split(".log")[:-1])
-                    downloader.updatetracker(filename, largest[0], (largest[1] - 1) if largest[1] > 0 else 0, thost, tport)
-            time.sleep(UPDATE_INTERVAL)
+                    entries.append((filename, largest[0], (largest[1] - 1) if largest[1] > 0 else 0, downloader.logranges(log)))
+
+            # Announce in batches, one by one if the server doesn't support batches
+            interval = downloader.updatetrackers(entries, thost, tport, interval)
+            if interval is None:
+                interval = UPDATE_INTERVAL
+                for filename, start_byte, end_byte, ranges in entries:
+                    response = downloader.updatetracker(filename, start_byte, end_byte, thost, tport, ranges)
+                    interval = downloader.suggestedinterval(response, interval)
+            time.sleep(interval)
 
     def createtracker(filename):
         """ Create the supplementary log file for a tracker. 
@@ -256,6 +523,18 @@ class downloader():
 
     workers = []
 
+    # Tracker servers which rejected announces listing several ranges
+    plain_servers = set()
+
+    # Tracker servers which rejected GET options, and get plain <GET name.track> requests
+    plain_get_servers = set()
+
+    # Peers which rejected RAW=1 segment requests, and get base64 ones
+    base64_peers = set()
+
+    # Largest segment size of peers which rejected a SEGMENT_SIZE request, see segmentsize
+    segment_sizes = {}
+
     def __init__(self, queue):
         self.queue = queue
 
@@ -327,7 +606,7 @@ class downloader():
         """
         fname = tracker[0]
         log = []
-        INTERVAL = 3
+        interval = INTERVAL
 
         # Check if a log and/or cache exists for this file
         logpath = os.path.join(FILE_DIRECTORY, fname + ".log")
@@ -354,16 +633,24 @@ class downloader():
         downloading = []
         sel = selectors.DefaultSelector()
 
+        # Kept-alive connections to the peers, see peerconnection
+        conns = {}
+
+        # Raw segments are received straight into this buffer and written from it
+        segment = memoryview(bytearray(SEGMENT_SIZE))
+
         # Make sure the tracker is up to date
-        if downloader.gettracker(tracker[0], thost, tport):
-            fpath = os.path.join(FILE_DIRECTORY, tracker[0] + ".track")
-            tracker = trackerfile.trackerfile.fromPath(fpath)
+        version = None
+        tracker, version, changed, interval = downloader.refreshtracker(tracker, version, thost, tport, interval)
+        peers = downloader.candidates(tracker, log, downloading, thost, tport)
 
 
         # Start 
         lastupdate = time.time()
         while downloader.size_remaining(log, tracker) > 0:
             if killer:
+                for conn in conns.values():
+                    conn.close()
                 return
             if downloading:
                 events = sel.select()
@@ -373,7 +660,7 @@ class downloader():
                     sock, y, z, data = a                    
 
                     if event_type == selectors.EVENT_WRITE:
-                        payload = "<GET SEG {} {} {}>".format(*data)
+                        payload = downloader.segmentrequest(data)
                         #print(payload)
                         failed = False
                         try:
@@ -384,69 +671,93 @@ class downloader():
                         sel.unregister(sock)
                         if not failed:
                             sel.register(sock, selectors.EVENT_READ, data)
-                    else:
+                        continue
 
-                        sel.unregister(sock)
-                        resp = b""
-                        while True:
-                            try:
-                                dat = sock.recv(MAX_DATA_SIZE)
-                            except Exception as err:
-                                print(str(err))
-                                break
-                            if not dat:
-                                break
-                            resp += dat
-
-                        sock.close()
-
-                        chunk = bytes.decode(resp, *apiutils.encoding_defaults)
+                    for data, chunk, length in downloader.responses(sel, sock, data, conns, segment):
                         match = apiutils.re_apicommand.match(chunk)
 
-                        if match and match.group(1) == "GET":
+                        args = match.group("args").split() if match else []
 
+                        if length is not None:
+                            payload = segment[:length]
+                        elif match and match.group(1) == "GET" and args[:1] == ["invalid"]:
+                            # Too large a segment, retry with the size the peer advertised
+                            downloader.segment_sizes[data[3]] = max(int(args[1]), 1) if args[1:2] and args[1].isdigit() else CHUNK_SIZE
+                            payload = False
+                        elif match and match.group(1) == "GET":
                             payload = base64.b64decode(chunk.replace(match.group() + "\n", ""))
-                            if len(payload) == data[2]:
-                                downloader.update(cache, log, logpath, data[1], data[2], payload)
-                                #print("Downloaded bytes {} to {} of {}".format(data[1], data[1] + data[2], data[0]))
+                        else:
+                            payload = None
+
+                        if payload is False:
+                            pass
+                        elif payload is None:
+                            if match and match.group(1) == "EXCEPTION" and args[:1] == ["BadRequest"] and data[3] not in downloader.base64_peers:
+                                # The peer doesn't know about RAW, ask it for base64
+                                downloader.base64_peers.add(data[3])
                             else:
-                                print("Error - incorrect size!")
-                                dead_peers.append(peer)
-                                time.sleep(0.5)
+                                print("Error. {}".format(apiutils.arg_decode(chunk)))
+                                dead_peers.append(data[3])
+                        elif len(payload) == data[2]:
+                            downloader.update(cache, log, logpath, data[1], data[2], payload)
+                            #print("Downloaded bytes {} to {} of {}".format(data[1], data[1] + data[2], data[0]))
                         else:
-                            print("Error. {}".format(apiutils.arg_decode(chunk)))
-                            dead_peers.append(peer)
+                            print("Error - incorrect size!")
+                            dead_peers.append(data[3])
+                            time.sleep(0.5)
                         downloading.remove((data[1], data[1] + data[2]))
 
                             # Request an updated tracker file
 
-            chunk_queue = downloader.next_bytes(log, tracker, downloading, dead_peers)
+            chunk_queue = downloader.next_bytes(log, tracker, downloading, dead_peers, peers)
             if not chunk_queue:
                 # No useful chunks to download... try checking for tracker updates
-                if not downloading and time.time() - lastupdate > INTERVAL:
+                if not downloading and time.time() - lastupdate > interval:
                     lastupdate = time.time()
-                    if downloader.gettracker(tracker[0], thost, tport):
-                        fpath = os.path.join(FILE_DIRECTORY, tracker[0] + ".track")
-                        tracker = trackerfile.trackerfile.fromPath(fpath)
+                    tracker, version, changed, interval = downloader.refreshtracker(tracker, version, thost, tport, interval)
+                    if changed:
+                        peers = downloader.candidates(tracker, log, downloading, thost, tport)
                         dead_peers = []
 
                 continue
             
 
             for peer, start, size in chunk_queue:
-                if len(downloading) > 3 and time.time() - lastupdate > INTERVAL:
-                    if downloader.gettracker(tracker[0], thost, tport):
+                if len(downloading) > 3 and time.time() - lastupdate > interval:
+                    tracker, version, changed, interval = downloader.refreshtracker(tracker, version, thost, tport, interval)
+                    if changed is not None:
                         lastupdate = time.time()
-                        fpath = os.path.join(FILE_DIRECTORY, tracker[0] + ".track")
-                        tracker = trackerfile.trackerfile.fromPath(fpath)
+                    if changed:
+                        peers = downloader.candidates(tracker, log, downloading, thost, tport)
                         dead_peers = []
                         break
                 if len(downloading) > 8: 
                     break
                 downloading.append((start, start + size))
 
-                message = (apiutils.arg_encode(fname), start, size)
+                message = (apiutils.arg_encode(fname), start, size, peer)
 
+                try:
+                    conn = conns.get(peer) or peerconnection.open(peer)
+                    if conn:
+                        if peer not in conns:
+                            conns[peer] = conn
+                            sel.register(conn.sock, selectors.EVENT_READ, conn)
+                        conn.request(downloader.segmentrequest(message), message)
+                        continue
+                except Exception:
+                    print("Dead peer {}!".format(peer))
+                    dead_peers.append(peer)
+                    downloading.remove((start, start + size))
+                    if peer in conns:
+                        sel.unregister(conns[peer].sock)
+                        conn = conns.pop(peer)
+                        conn.close()
+                        for pending, data in conn.pending:
+                            downloading.remove((data[1], data[1] + data[2]))
+                    break
+
+                # The peer doesn't keep connections alive
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 sel.register(s, selectors.EVENT_WRITE, message)
                 try:
@@ -462,6 +773,9 @@ class downloader():
 
         print("Finished downloading '{}'".format(fname))
 
+        for conn in conns.values():
+            conn.release()
+
         # Close files
         if not cache.closed:
             cache.close()
@@ -548,11 +862,234 @@ class downloader():
         else:
             print(apiutils.arg_decode(response))
 
-    def updatetracker(file, start_byte, end_byte, host, port):
+    def refreshtracker(tracker, version, host, port, interval=None):
+        """ Brings a tracker up to date with the tracker server
+
+        Sends the version of the tracker last received, so the server only answers with
+        the peers that changed since then, or with nothing if none did. The .track file
+        is only rewritten when the server sends the whole tracker.
+
+        If COMPACT_PEERS is set, peers are requested as binary records, see decodepeers,
+        and the .track file is left alone.
+
+        Every range of peers which have several is requested too, see next_bytes.
+
+        Servers which reject these options are remembered, and sent a plain GET for the
+        whole tracker from then on.
+
+        Arguments:
+            tracker (:class:`~trackerfile.trackerfile`): The tracker to bring up to date
+            version (str): The version token the server sent with *tracker*, or None
+            host (str): The tracker server's address
+            port (int): The tracker server's port
+            interval (int, optional): Seconds to wait before the next refresh, kept unless
+                the server suggests another interval
+
+        Returns:
+            (tracker, version, changed, interval): The up to date tracker, its version token
+            and the interval to wait. *changed* is False if the tracker didn't change, and
+            None if the request failed.
+        """
+        fname = tracker[0]
+        if (host, port) in downloader.plain_get_servers:
+            if not downloader.gettracker(fname, host, port):
+                return tracker, version, None, interval
+            return trackerfile.trackerfile.fromPath(os.path.join(FILE_DIRECTORY, fname + ".track")), None, True, interval
+
+        message = "<GET {}.track VERSION={} COMPACT={:d} RANGES=1>".format(apiutils.arg_encode(fname), version or "none", COMPACT_PEERS)
+
+        response = networkutil.sendraw(host, port, message) or b""
+
+        # Cut the binary records out, the rest of the response is text
+        peers = None
+        start = response.find(b"<REP GET PEERS ")
+        if start >= 0:
+            end = response.index(b"\n", start) + 1
+            size = int(response[start + 15:end - 2]) * apiutils.compact_peer.size
+            peers = downloader.decodepeers(memoryview(response)[end:end + size])
+            response = response[:start] + response[end + size:]
+
+        ranges = {}
+        start = response.find(b"<REP GET RANGES ")
+        if start >= 0:
+            end = response.index(b"\n", start) + 1
+            size = int(response[start + 16:end - 2]) * apiutils.compact_range.size
+            ranges = downloader.decoderanges(memoryview(response)[end:end + size])
+            response = response[:start] + response[end + size:]
+
+        response = response.decode(*apiutils.encoding_defaults)
+
+        match = apiutils.re_apicommand.match(response)
+        args = match.group("args").split() if match else []
+
+        if not match or match.group("command") != "REP" or len(args) < 3:
+            if response.startswith("<EXCEPTION BadRequest>"):
+                # The server doesn't know about the options, ask plainly
+                downloader.plain_get_servers.add((host, port))
+                return downloader.refreshtracker(tracker, version, host, port, interval)
+            print(apiutils.arg_decode(response))
+            return tracker, version, None, interval
+
+        kind, token = args[1], args[2]
+        interval = downloader.suggestedinterval(response, interval)
+        payload = apiutils.re_apicommand.sub("", response)
+
+        if kind == "NOTMODIFIED":
+            return tracker, token, False, interval
+
+        elif kind == "DELTA" and peers is not None:
+            for peer, values in peers.items():
+                if values is None:
+                    tracker[4].pop(peer, None)
+                else:
+                    tracker[4][peer] = values + (ranges.get(peer),)
+            return tracker, token, True, interval
+
+        elif kind == "DELTA":
+            for line in payload.split("\n"):
+                if line.startswith("+"):
+                    tracker.updatePeer(*trackerfile.trackerfile.parsePeer(line[1:]))
+                elif line.startswith("-"):
+                    ip, port = line[1:].split(":")
+                    tracker.removePeer(ip, port)
+            return tracker, token, True, interval
+
+        elif peers is not None:
+            tracker = trackerfile.trackerfile.fromFileObject(payload.split("\n"))
+            for peer, values in peers.items():
+                tracker[4][peer] = values + (ranges.get(peer),)
+            return tracker, token, True, interval
+
+        fpath = os.path.join(FILE_DIRECTORY, fname + ".track")
+        with open(fpath, "w") as trackfile:
+            trackfile.write(payload)
+
+        return trackerfile.trackerfile.fromPath(fpath), token, True, interval
+
+    def decodepeers(records):
+        """ Decodes the binary peer records of a compact tracker response
+
+        Arguments:
+            records (bytes-like): Records packed with apiutils.compact_peer
+
+        Returns:
+            dict: maps (ip, port) to (start_byte, end_byte, timestamp), with *ip* a string
+            and *timestamp* an int, or to None for removed peers
+        """
+        return { (socket.inet_ntoa(ip), port): (start, end, stamp) if stamp else None
+                 for ip, port, start, end, stamp in apiutils.compact_peer.iter_unpack(records) }
+
+    def decoderanges(records):
+        """ Decodes the binary range records of a compact tracker response
+
+        Arguments:
+            records (bytes-like): Records packed with apiutils.compact_range
+
+        Returns:
+            dict: maps (ip, port) to the list of (start_byte, end_byte) ranges of the peer,
+            with *ip* a string
+        """
+        ranges = {}
+        for ip, port, start, end in apiutils.compact_range.iter_unpack(records):
+            ranges.setdefault((socket.inet_ntoa(ip), port), []).append((start, end))
+
+        return ranges
+
+    def suggestedinterval(response, default):
+        """ Reads the interval the tracker server suggests waiting before the next request
+
+        The server appends it to <updatetracker succ>, to <updatetrackers> and to
+        versioned <REP GET> responses.
+
+        Returns:
+            int: The suggested number of seconds, or *default* if there is none
+        """
+        match = apiutils.re_apicommand.match(response or "")
+        if not match:
+            return default
+
+        args = match.group("args").split()
+        expected = 2 if match.group("command") in ("updatetracker", "updatetrackers") else 4
+        if len(args) == expected and args[-1].isdigit():
+            return int(args[-1])
+
+        return default
+
+    def updatetrackers(entries, host, port, interval):
+        """ Sends updatetrackers commands, each announcing as many files as fit in one message
+
+        Peers holding several ranges of a file announce all of them, unless the server
+        rejected that before. Entries listing ranges which the server fails are announced
+        again without them, and the server isn't sent ranges anymore.
+
+        Arguments:
+            entries: list of (file, start_byte, end_byte, ranges) tuples, *ranges* being
+                every (start_byte, end_byte) range of the file we have, or None
+            host (str): The tracker server's address
+            port (int): The tracker server's port
+            interval (int): The interval to return if the server suggests none
+
+        Returns:
+            int: The interval the server suggests waiting before the next announce, or None
+            if the server doesn't support updatetrackers
+        """
+        plain = (host, port) in downloader.plain_servers
+        prefix = "<updatetrackers {} {}".format(myip, STARTPORT)
+        batches = [[]]
+        length = len(prefix) + 1
+        for file, start_byte, end_byte, ranges in entries:
+            entry = " {}:{}:{}".format(apiutils.arg_encode(file), start_byte, end_byte)
+            ranged = bool(ranges and len(ranges) > 1 and not plain)
+            if ranged:
+                entry += ":" + apiutils.ranges_encode(ranges)
+            if batches[-1] and length + len(entry) > MAX_DATA_SIZE:
+                batches.append([])
+                length = len(prefix) + 1
+            batches[-1].append((entry, ranged, (file, start_byte, end_byte, ranges)))
+            length += len(entry)
+
+        batches = [batch for batch in batches if batch]
+        messages = [prefix + "".join(entry for entry, _, _ in batch) + ">" for batch in batches]
+        responses = networkutil.sendmany(host, port, messages) or []
+        rejected = []
+        for batch, response in zip(batches, responses):
+            response = response.decode(*apiutils.encoding_defaults)
+            match = apiutils.re_apicommand.match(response or "")
+            if not match or match.group("command") != "updatetrackers":
+                return None
+
+            for (_, ranged, sent), line in zip(batch, response.split("\n")[1:-2]):
+                file, result = line.strip("<>").split()
+                if result == "fail" and ranged:
+                    # Maybe the server doesn't know about ranges, announce this one plainly
+                    rejected.append(sent)
+                elif result != "succ":
+                    print("Failed to update tracker for {}: {}".format(apiutils.arg_decode(file), result))
+
+            interval = downloader.suggestedinterval(response, interval)
+
+        if rejected:
+            downloader.plain_servers.add((host, port))
+            interval = downloader.updatetrackers(rejected, host, port, interval) or interval
+
+        return interval
+
+    def updatetracker(file, start_byte, end_byte, host, port, ranges=None):
         """ Sends an updatetracker command to the server
+
+        *ranges*, every (start_byte, end_byte) range of the file we have, are announced
+        too if there are several, unless the server rejected that before. Only a server
+        answering <EXCEPTION BadRequest> to the RANGES option is sent plain announces
+        from then on.
         """
         fname = apiutils.arg_encode(file)
         msg = "<updatetracker {} {} {} {} {}>".format(fname, start_byte, end_byte, myip, STARTPORT)
+        if ranges and len(ranges) > 1 and (host, port) not in downloader.plain_servers:
+            response = networkutil.send(host, port, msg[:-1] + " RANGES={}>".format(apiutils.ranges_encode(ranges)))
+            if not (response or "").startswith("<EXCEPTION BadRequest>"):
+                return response
+            downloader.plain_servers.add((host, port))
+
         response = networkutil.send(host, port, msg)
 
         match = apiutils.re_apicommand.match(response)
@@ -571,6 +1108,55 @@ class downloader():
 
         return response
 
+    def rangepeers(file, start_byte, end_byte, host, port, limit):
+        """ Sends a REQ PEERS request for the freshest peers holding any of a range of bytes
+
+        Returns:
+            dict: maps (ip, port) to (start_byte, end_byte, timestamp), like a tracker's
+            peers, or None if the request failed
+        """
+        msg = "<REQ PEERS {}.track {} {} {}>".format(apiutils.arg_encode(file), start_byte, end_byte, limit)
+        response = networkutil.send(host, port, msg)
+
+        match = apiutils.re_apicommand.match(response)
+        if not match or match.group("command") != "REP":
+            print(apiutils.arg_decode(response))
+            return None
+
+        peers = {}
+        for line in apiutils.re_apicommand.sub("", response).split("\n"):
+            if line:
+                ip, peer_port, start, end, stamp = trackerfile.trackerfile.parsePeer(line)[:5]
+                peers[(ip, peer_port)] = (start, end, stamp)
+
+        return peers
+
+    def candidates(tracker, log, downloading, host, port):
+        """ Picks the peers next_bytes should choose from
+
+        Trackers with up to RANGE_QUERY_PEERS peers are used as they are. For larger ones,
+        the tracker server is asked for the RANGE_QUERY_LIMIT freshest peers holding bytes
+        that are still needed, so next_bytes only has to scan those.
+
+        Returns:
+            dict: maps (ip, port) to (start_byte, end_byte, timestamp), like tracker[4]
+        """
+        peers = tracker[4]
+        if len(peers) <= RANGE_QUERY_PEERS:
+            return peers
+
+        # First byte that is neither downloaded nor being downloaded
+        need = 0
+        for start, end in downloader.merged(log + downloading):
+            if start > need:
+                break
+            need = max(need, end)
+
+        last = int(tracker[1]) - 1
+        ranged = downloader.rangepeers(tracker[0], min(need, last), last, host, port, RANGE_QUERY_LIMIT)
+
+        return ranged if ranged else peers
+
     def size_remaining(log, tracker):
         """ Compute the remaining number of bytes needed to finish downloading the torrent corresponding
         to the given log
@@ -587,23 +1173,26 @@ class downloader():
 
         return filesize - cachesize
 
-    def next_bytes(log, tracker, downloading, failed_peers):
+    def next_bytes(log, tracker, downloading, failed_peers, peers=None):
         """ Determines which chunk should be downloaded next for the given trackerfile
 
         As per the specification:
             Segment selection: The to-be-downloaded segment(s) is (are) chosen sequentially.
             Peer selection: The peer which has the newest timestamp is selected to be connected to
+
+        Only *peers* are considered if given, see candidates. Defaults to every peer of
+        *tracker*.
         """
-        peers = (tracker[4])
+        if peers is None:
+            peers = tracker[4]
         freq = dict()
 
-        # Sort by start byte
-        peer_list = sorted(peers.keys(), key=lambda k: 1)
+        # Every range of every peer, see spans
+        span_list = downloader.spans(peers)
 
         start_byte, end_byte = None, None
-        for peer in peer_list:
+        for peer, peer_start, peer_end, stamp in span_list:
             if peer not in failed_peers:
-                peer_start, peer_end = int(peers[peer][0]), int(peers[peer][1])
                 for entry in downloader.merged(log + downloading):
                     start, end = entry
                     if start <= peer_start and end >= peer_end:
@@ -617,19 +1206,18 @@ class downloader():
         if start_byte != None:
 
             # Sort by peer timestamp
-            peer_list = sorted(peers.keys(), key=lambda k: peers[k][2])
+            span_list.sort(key=lambda span: span[3])
 
-            for peer in peer_list:
+            for peer, peer_start, peer_end, stamp in span_list:
                 if peer not in failed_peers:
-                    peer_start, peer_end = int(peers[peer][0]), int(peers[peer][1])
-
                     if start_byte >= peer_start and start_byte < peer_end:
                         # Queue some chunks from this peer
 
                         chunk_queue = []
                         start = start_byte
-                        while start < peer_end and start - start_byte < CHUNK_SIZE * 10:
-                            size = min(CHUNK_SIZE, peer_end - start + 1)
+                        segment_size = downloader.segmentsize(peer)
+                        while start < peer_end and start - start_byte < segment_size * 10:
+                            size = min(segment_size, peer_end - start + 1)
                             if size == 0:
                                 continue
                             chunk_queue.append((peer, start, size))
@@ -642,6 +1230,93 @@ class downloader():
         return None
 
 
+    def segmentrequest(data):
+        """ The GET SEG request for data, a (file, start_byte, size, peer) tuple
+        """
+        message = "<GET SEG {} {} {}>".format(*data[:3])
+        if data[3] not in downloader.base64_peers:
+            message = message[:-1] + " RAW=1>"
+        return message
+
+    def responses(sel, sock, data, conns, buf):
+        """ Reads the segments received on a readable socket
+
+        For a kept-alive connection (data is its :class:`peerconnection`), reads one response,
+        then the following ones as long as part of them was already received, since the
+        selector won't report those. If the connection breaks, it is closed and every request
+        still pending on it fails. Otherwise, sock was opened for a single request (data) and
+        is read until the peer closes it.
+
+        Yields:
+            tuple: (data, response, length), see networkutil.recvsegment. buf is reused for
+            the next segment once the caller asks for it.
+        """
+        if not isinstance(data, peerconnection):
+            sel.unregister(sock)
+            try:
+                chunk, length = networkutil.recvsegment(sock, buf)
+            except Exception as err:
+                print(str(err))
+                chunk, length = "", None
+
+            sock.close()
+            yield data, chunk, length
+            return
+
+        conn = data
+        if not conn.pending:
+            # Nothing is expected, the peer closed the idle connection
+            sel.unregister(sock)
+            conn.close()
+            del conns[conn.peer]
+            return
+
+        while conn.pending:
+            try:
+                yield conn.response(buf)
+            except Exception as err:
+                print(str(err))
+                sel.unregister(sock)
+                conn.close()
+                del conns[conn.peer]
+                for pending, data in list(conn.pending):
+                    yield data, "", None
+                return
+
+            if not conn.buffered():
+                break
+
+    def segmentsize(peer):
+        """ The number of bytes to request from peer at once
+
+        SEGMENT_SIZE, unless the peer answered such a request with ``<GET invalid max>``,
+        advertising a smaller maximum, or with ``<GET invalid>``, in which case it only
+        serves CHUNK_SIZE bytes at once.
+        """
+        return min(SEGMENT_SIZE, downloader.segment_sizes.get(peer, SEGMENT_SIZE))
+
+    def spans(peers):
+        """ Lists every range of bytes of every peer
+
+        Arguments:
+            peers: maps (ip, port) to (start_byte, end_byte, timestamp), like tracker[4].
+                If it is a trackerfile.PeerTable, peers holding several ranges are listed
+                once per range.
+
+        Returns:
+            list: (peer, start_byte, end_byte, timestamp) tuples
+        """
+        spans = []
+        for peer, values in peers.items():
+            ranges = [(values[0], values[1])]
+            if isinstance(peers, trackerfile.PeerTable):
+                ranges = peers.ranges(peer)
+
+            for start, end in ranges:
+                spans.append((peer, int(start), int(end), values[2]))
+
+        return spans
+
     def update(cache, log, logpath, start, size, payload):
         """ Updates the logfile based on the newly retreived chunk
         """
@@ -656,14 +1331,27 @@ class downloader():
                     for st, en in log:
                         l.write("{}:{}\n".format(st, en))
 
-                # Update the tracker with the largest contiguous chunk
+                # Update the tracker with the largest contiguous chunk, and every other one
                 largest = max(log, key = lambda entry: entry[1] - entry[0])
                 filename = "".join(logpath.split("/")[-1].split(".log")[:-1])
-                downloader.updatetracker(filename, largest[0], largest[1] - 1, thost, tport)
+                downloader.updatetracker(filename, largest[0], largest[1] - 1, thost, tport, downloader.logranges(log))
                 
 
                 return True
 
+    def logranges(log):
+        """ Converts log entries into the inclusive byte ranges announced to the tracker
+
+        At most apiutils.max_ranges ranges are announced, the largest ones.
+
+        Parameters:
+            log: list of (start_byte, end_byte) tuples, *end_byte* excluded
+        """
+        ranges = [(start, end - 1) for start, end in downloader.merged(log) if end > start]
+        if len(ranges) > apiutils.max_ranges:
+            ranges = sorted(sorted(ranges, key=lambda r: r[1] - r[0], reverse=True)[:apiutils.max_ranges])
+        return ranges
+
     def merged(log):
         """ Merge adjacent log entries
 
@@ -686,6 +1374,18 @@ class downloader():
 
 
 class networkutil():
+    """ Sends API messages, reusing connections where the server allows it
+
+    A server which answers ``<KEEPALIVE>`` with ``<KEEPALIVE timeout>`` keeps the connection
+    open: every message is sent on its own line and the responses come back in order, each
+    preceded by a ``<FRAME length>`` line. Open connections are kept in :attr:`pool` and
+    closed once idle for longer than the server's timeout. Servers which don't answer the
+    handshake are remembered in :attr:`one_shot` and get one connection per message.
+    """
+    pool = {}
+    one_shot = set()
+    lock = threading.Lock()
+
     def send(ip, port, message):
         """ Sends a message over the network and returns the response
 
@@ -694,6 +1394,151 @@ class networkutil():
             port (int): The target port
             message (str): The message to send to the server
         """
+        resp = networkutil.sendraw(ip, port, message)
+        if resp is None:
+            return
+
+        return resp.decode(*apiutils.encoding_defaults)
+
+    def sendraw(ip, port, message):
+        """ Sends a message over the network and returns the undecoded response
+
+        Arguments:
+            ip (:class:`~ipaddress.IPv4Address`): The target address
+            port (int): The target port
+            message (str): The message to send to the server
+
+        Returns:
+            bytes: The response
+        """
+        resps = networkutil.sendmany(ip, port, [message])
+        return resps[0] if resps else None
+
+    def sendmany(ip, port, messages):
+        """ Sends several messages and returns the undecoded responses, in order
+
+        On a kept-alive connection the messages are all written before any response is
+        read, so they cost a single round trip.
+
+        Arguments:
+            ip (:class:`~ipaddress.IPv4Address`): The target address
+            port (int): The target port
+            messages (list): The messages (str) to send to the server
+
+        Returns:
+            list: The responses (bytes), or None if the server couldn't be reached
+        """
+        address = (str(ip), int(port))
+
+        if address not in networkutil.one_shot:
+            # a pooled connection may have been closed by the server in the meantime,
+            # so retry once on a fresh one
+            for attempt in range(2):
+                conn = networkutil.connect(address)
+                if conn is None:
+                    break
+
+                try:
+                    resps = networkutil.pipeline(conn, messages)
+                except (OSError, ValueError) as err:
+                    conn[0].close()
+                    if attempt:
+                        print(str(err))
+                    continue
+
+                networkutil.release(address, conn)
+                return resps
+
+        resps = []
+        for message in messages:
+            resp = networkutil.sendonce(address, message)
+            if resp is None:
+                return None
+            resps.append(resp)
+
+        return resps
+
+    def connect(address):
+        """ Returns a kept-alive connection to address, from the pool if one is still open
+
+        Returns:
+            tuple: (socket, file, timeout), or None if the server doesn't keep connections alive
+        """
+        global myip
+        now = time.time()
+        with networkutil.lock:
+            conns = networkutil.pool.get(address, [])
+            while conns:
+                s, f, timeout, expires = conns.pop()
+                if expires > now:
+                    return s, f, timeout
+                s.close()
+
+        try:
+            s = socket.create_connection(address)
+            s.sendall(b"<KEEPALIVE>\n")
+            f = s.makefile("rb")
+            line = f.readline(MAX_DATA_SIZE)
+        except OSError as err:
+            print(str(err))
+            return None
+
+        match = apiutils.re_apicommand.match(line.decode(*apiutils.encoding_defaults))
+        if not match or match.group("command") != "KEEPALIVE":
+            s.close()
+            networkutil.one_shot.add(address)
+            return None
+
+        myip = s.getsockname()[0]
+        return s, f, int(match.group("args"))
+
+    def forget():
+        """ Drops the pooled connections in a forked child process
+
+        The child inherits the parent's pool, and both sides pipelining on the same
+        connection would read each other's responses. Called through os.register_at_fork.
+        """
+        networkutil.lock = threading.Lock()
+        for conns in networkutil.pool.values():
+            for s, f, timeout, expires in conns:
+                f.close()
+                s.close()
+        networkutil.pool = {}
+
+    def pipeline(conn, messages):
+        """ Writes every message to a kept-alive connection and reads their framed responses
+        """
+        s, f, timeout = conn
+        s.sendall(b"".join(bytes(message, *apiutils.encoding_defaults) + b"\n"
+                           for message in messages))
+
+        resps = []
+        for message in messages:
+            match = apiutils.re_apicommand.match(
+                f.readline(MAX_DATA_SIZE).decode(*apiutils.encoding_defaults))
+            if not match or match.group("command") != "FRAME":
+                raise ValueError("Connection closed by the server")
+
+            length = int(match.group("args"))
+            resp = f.read(length)
+            if len(resp) != length:
+                raise ValueError("Connection closed by the server")
+            resps.append(resp)
+
+        return resps
+
+    def release(address, conn):
+        """ Puts a connection back in the pool, until shortly before the server would close it
+        """
+        s, f, timeout = conn
+        with networkutil.lock:
+            networkutil.pool.setdefault(address, []).append(
+                (s, f, timeout, time.time() + timeout - 1))
+
+    def sendonce(address, message):
+        """ Sends a message on a new connection and reads the response until the server
+        closes it
+        """
         global myip
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -701,7 +1546,7 @@ class networkutil():
             print("unable to create socket")
             return
 
-        s.connect((ip, int(port)))
+        s.connect(address)
         s.send(bytes((message), *apiutils.encoding_defaults))
         myip = s.getsockname()[0]
         resp = b""
@@ -716,10 +1561,288 @@ class networkutil():
             resp += data
 
         s.close()
-        return resp.decode(*apiutils.encoding_defaults)
+        return resp
+
+    def sendbuffers(sock, buffers):
+        """ Sends buffers one after the other without joining them, in a single system call
+        where the platform allows it
+        """
+        if not hasattr(sock, "sendmsg"):
+            return sock.sendall(b"".join(buffers))
+
+        buffers = [memoryview(buf) for buf in buffers]
+        while buffers:
+            sent = sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if buffers:
+                buffers[0] = buffers[0][sent:]
+
+    def sendfile(sock, file, offset, count):
+        """ Sends count bytes of file from offset with os.sendfile, so they go from the page
+        cache to the socket without being copied into Python
+
+        A socket with a timeout is non-blocking underneath, so whenever its send buffer is
+        full this waits for it to drain, for up to the socket's timeout.
+
+        Raises:
+            socket.timeout: if the socket stayed full for longer than its timeout
+            EOFError: if the file ends before count bytes were sent
+        """
+        selector = None
+        try:
+            while count > 0:
+                try:
+                    sent = os.sendfile(sock.fileno(), file.fileno(), offset, count)
+                except BlockingIOError:
+                    if selector is None:
+                        selector = selectors.DefaultSelector()
+                        selector.register(sock, selectors.EVENT_WRITE)
+                    if not selector.select(sock.gettimeout()):
+                        raise socket.timeout("timed out")
+                    continue
+                if not sent:
+                    raise EOFError("File ended {} bytes short of the segment".format(count))
+                offset += sent
+                count -= sent
+        finally:
+            if selector is not None:
+                selector.close()
+
+    def recvsegment(sock, buf):
+        """ Reads a GET SEG response until the peer closes the connection
+
+        The response to a ``RAW=1`` request is a ``<GET RAW length>`` line followed by the
+        raw payload, which is read straight into buf with ``recv_into``.
+
+        Arguments:
+            sock (socket): The connection to the peer, the request already sent
+            buf (memoryview): Writable buffer large enough for the requested chunk
+
+        Returns:
+            tuple: (header, length), header being the first line of the response. length
+            is the number of payload bytes read into buf for a ``<GET RAW>`` response, else
+            None and header holds the whole response, decoded.
+        """
+        head = b""
+        while b"\n" not in head:
+            data = sock.recv(MAX_DATA_SIZE)
+            if not data:
+                return head.decode(*apiutils.encoding_defaults), None
+            head += data
+
+        line, rest = head.split(b"\n", 1)
+        header = line.decode(*apiutils.encoding_defaults)
+        match = apiutils.re_apicommand.match(header)
+        args = match.group("args").split() if match else []
+
+        if not match or match.group("command") != "GET" or args[:1] != ["RAW"]:
+            # Base64 payload or exception, read the rest as text
+            resp = head
+            while True:
+                data = sock.recv(MAX_DATA_SIZE)
+                if not data:
+                    break
+                resp += data
+            return resp.decode(*apiutils.encoding_defaults), None
+
+        length = int(args[1])
+        if length > len(buf) or len(rest) > length:
+            raise ValueError("Segment of {} bytes doesn't fit".format(length))
+
+        buf[:len(rest)] = rest
+        received = len(rest)
+        while received < length:
+            count = sock.recv_into(buf[received:length])
+            if not count:
+                break
+            received += count
 
+        return header, received
 
 
+class peerconnection():
+    """ A connection to another peer's chunk server, kept alive between segment requests
+
+    The connection starts with ``<KEEPALIVE>``, answered with ``<KEEPALIVE timeout>``. Requests
+    are then sent on their own line with an ``ID=id`` option, without waiting for the
+    responses to the previous ones, which come back in order, each preceded by a
+    ``<FRAME id length>`` line. Idle connections are kept in :attr:`pool` until shortly
+    before the peer would close them. Peers which don't answer the handshake are
+    remembered in :attr:`one_shot` and get one connection per request.
+    """
+    pool = {}
+    one_shot = set()
+    lock = threading.Lock()
+
+    def __init__(self, peer, sock):
+        self.peer = peer
+        self.sock = sock
+        self.timeout = None
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.next_id = 0
+
+    def open(peer):
+        """ Returns a kept-alive connection to peer, from the pool if one is still open
+
+        Returns:
+            peerconnection: The connection, or None if the peer doesn't keep connections alive
+
+        Raises:
+            OSError: if the peer can't be reached
+        """
+        now = time.time()
+        with peerconnection.lock:
+            for address, conns in list(peerconnection.pool.items()):
+                for conn, expires in conns[:]:
+                    if expires <= now:
+                        conns.remove((conn, expires))
+                        conn.close()
+                if not conns:
+                    del peerconnection.pool[address]
+
+            conns = peerconnection.pool.get(peer)
+            if conns:
+                return conns.pop()[0]
+
+        if peer in peerconnection.one_shot:
+            return None
+
+        # The handshake is bounded by CONNECT_TIMEOUT too, until the peer tells its timeout
+        conn = peerconnection(peer, socket.create_connection((str(peer[0]), int(peer[1])), CONNECT_TIMEOUT))
+        try:
+            conn.sock.sendall(b"<KEEPALIVE>\n")
+            match = apiutils.re_apicommand.match(conn.readline().decode(*apiutils.encoding_defaults))
+        except (OSError, ValueError):
+            match = None
+
+        if not match or match.group("command") != "KEEPALIVE" or not match.group("args").strip().isdigit():
+            conn.close()
+            peerconnection.one_shot.add(peer)
+            return None
+
+        conn.timeout = int(match.group("args"))
+        conn.sock.settimeout(conn.timeout)
+        return conn
+
+    def request(self, message, data):
+        """ Sends a request, without waiting for the response
+
+        Arguments:
+            message (str): The request
+            data: Returned along with the response, see response
+        """
+        self.next_id += 1
+        line = "{} ID={}>\n".format(message[:-1], self.next_id)
+        self.sock.sendall(bytes(line, *apiutils.encoding_defaults))
+        self.pending.append((self.next_id, data))
+
+    def response(self, buf):
+        """ Reads the response to the oldest pending request
+
+        Arguments:
+            buf (memoryview): Writable buffer large enough for the requested chunk
+
+        Returns:
+            tuple: (data, header, length), data being what was passed to request, and
+            header and length as returned by networkutil.recvsegment
+
+        Raises:
+            OSError, ValueError: if the connection broke, it can't be used anymore. The
+                request stays pending.
+        """
+        ident, data = self.pending[0]
+
+        match = apiutils.re_apicommand.match(self.readline().decode(*apiutils.encoding_defaults))
+        args = match.group("args").split() if match else []
+        if not match or match.group("command") != "FRAME" or args[:1] != [str(ident)] or len(args) != 2:
+            raise ValueError("Unexpected response from {}".format(self.peer))
+
+        size = int(args[1])
+        if not size:
+            self.pending.popleft()
+            return data, "", None
+
+        line = self.readline()
+        size -= len(line) + 1
+        header = line.decode(*apiutils.encoding_defaults)
+        match = apiutils.re_apicommand.match(header)
+        args = match.group("args").split() if match else []
+
+        if match and match.group("command") == "GET" and args[:1] == ["RAW"]:
+            if int(args[1]) != size or size > len(buf):
+                raise ValueError("Segment of {} bytes doesn't fit".format(size))
+            self.read(buf[:size])
+            self.pending.popleft()
+            return data, header, size
+
+        rest = bytearray(size)
+        self.read(rest)
+        self.pending.popleft()
+        return data, header + "\n" + rest.decode(*apiutils.encoding_defaults), None
+
+    def readline(self):
+        """ Reads a line, without the newline
+        """
+        while b"\n" not in self.buffer:
+            if len(self.buffer) > MAX_DATA_SIZE:
+                raise ValueError("Line too long from {}".format(self.peer))
+
+            data = self.sock.recv(MAX_DATA_SIZE)
+            if not data:
+                raise EOFError("Connection closed by {}".format(self.peer))
+            self.buffer += data
+
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return bytes(line.rstrip(b"\r"))
+
+    def read(self, buf):
+        """ Fills buf, with what was already received first
+        """
+        received = min(len(buf), len(self.buffer))
+        buf[:received] = self.buffer[:received]
+        del self.buffer[:received]
+
+        while received < len(buf):
+            count = self.sock.recv_into(buf[received:])
+            if not count:
+                raise EOFError("Connection closed by {}".format(self.peer))
+            received += count
+
+    def buffered(self):
+        """ Whether part of the next response was already received
+        """
+        return len(self.buffer) > 0
+
+    def release(self):
+        """ Puts the connection back in the pool, or closes it if responses are pending
+        """
+        if self.pending:
+            return self.close()
+
+        with peerconnection.lock:
+            peerconnection.pool.setdefault(self.peer, []).append(
+                (self, time.time() + self.timeout - 1))
+
+    def close(self):
+        self.sock.close()
+
+    def forget():
+        """ Drops the pooled connections in a forked child process, see networkutil.forget
+        """
+        peerconnection.lock = threading.Lock()
+        for conns in peerconnection.pool.values():
+            for conn, expires in conns:
+                conn.close()
+        peerconnection.pool = {}
+
+
+if hasattr(os, "register_at_fork"):
+    # The downloader process is forked from the peer, which already talked to the tracker
+    os.register_at_fork(after_in_child=networkutil.forget)
+    os.register_at_fork(after_in_child=peerconnection.forget)
+
 
 class interpreter(cmd.Cmd):
     """ The command line interpreter for interfacing the user with the API methods
@@ -821,6 +1944,16 @@ class interpreter(cmd.Cmd):
         response = networkutil.send(host, port, "<REQ LIST>")
         print(response)
 
+    def do_SEARCH(self, line):
+        """ Sends the REQ SEARCH api command to the server
+        """
+        parse = cmds["SEARCH"].parse_args(interpreter.str_to_args(line))
+        host, port = parse.host or thost, parse.port or tport
+        args = [str(parse.offset), str(parse.limit)] + [apiutils.arg_encode(term) for term in parse.terms]
+        print("Searching tracker files on tracker {}:{}".format(host, port))
+        response = networkutil.send(host, port, "<REQ SEARCH {}>".format(" ".join(args)))
+        print(response)
+
     def write(self, msg):
         print(msg)
 
@@ -853,6 +1986,7 @@ cmds = {
     "gettracker" : cmdparser(description="Retrieve a tracker file", add_help=False),
     "GET" : cmdparser(description="Retrieve a segment of a torrent file", add_help=False),
     "REQ" : cmdparser(description="Request a list of tracker files", add_help=False),
+    "SEARCH" : cmdparser(description="Search the list of tracker files", add_help=False),
     "quit" : cmdparser(description="Exit the program", add_help=False)
 }
 
@@ -868,6 +2002,11 @@ cmds["updatetracker"].add_argument("-host", type=str, help="IP address of tracke
 cmds["updatetracker"].add_argument("-port", type=int, help="Port number of tracker server", nargs="?")
 cmds["REQ"].add_argument("-host", type=str, help="Tracker ip", nargs="?")
 cmds["REQ"].add_argument("-port", type=int, help="Tracker port", nargs="?")
+cmds["SEARCH"].add_argument("terms", type=str, nargs="*", help="Words in the filename or description, or ~text to match any part of them")
+cmds["SEARCH"].add_argument("-offset", type=int, default=0, help="Number of results to skip")
+cmds["SEARCH"].add_argument("-limit", type=int, default=20, help="Maximum number of results")
+cmds["SEARCH"].add_argument("-host", type=str, help="Tracker ip", nargs="?")
+cmds["SEARCH"].add_argument("-port", type=int, help="Tracker port", nargs="?")
 cmds["gettracker"].add_argument("fname", type=str, help="Name of tracker file")
 cmds["gettracker"].add_argument("-host", type=str, help="IP address of tracker server", nargs="?")
 cmds["gettracker"].add_argument("-port", type=int, help="Port number of tracker server", nargs="?")
@@ -9,40 +9,150 @@ __docformat__ = 'reStructuredText'
 import socket
 import socketserver
 import threading
+import asyncio
+import argparse
+import multiprocessing
+import tempfile
+import zlib
 
 import sys
 import os
 import os.path
+import signal
 
 import urllib.parse
 from ipaddress import IPv4Address,AddressValueError
 
-import fcntl
-
 import trackerfile
+import trackerstore
+import sqlitestore
 import apiutils
 import sillycfg
 
-flock = threading.Lock()
+
+DEFAULT_CONFIG_FILE = './serverThreadConfig.cfg'
+
+
+def shardOf(name, workers):
+    """Index of the prefork worker which owns the tracker for *name*.
+    
+    Uses CRC-32 rather than :func:`hash` so that every worker process agrees.
+    """
+    return zlib.crc32( bytes(name, *apiutils.encoding_defaults) ) % workers
+
+def journalName(worker, workers):
+    """Name of the journal of prefork *worker*, in the torrents directory.
+    
+    Each worker journals the trackers it owns separately; a single process
+    uses :const:`trackerstore.JOURNAL_NAME`.
+    """
+    if workers == 1:
+        return trackerstore.JOURNAL_NAME
+    
+    return "{}.{}".format( trackerstore.JOURNAL_NAME, worker )
+
+def splitJournals(torrents_dir, workers):
+    """Move the journaled records of every tracker to the journal of the
+    worker which owns it among *workers*, see
+    :func:`trackerstore.splitJournals`."""
+    
+    moved = trackerstore.splitJournals( torrents_dir, lambda name:
+                            journalName( shardOf(name, workers), workers ) )
+    if moved:
+        print("Moved {} journal record(s) to their new owners".format(moved))
 
 class TrackerServerHandler(socketserver.BaseRequestHandler):
     """The request handler for TrackerServer.
     """
     
     def handle(self):
-        """Convert peer requests into api_* methods.
+        """Receive a peer request and pass it to :meth:`dispatch`.
         
-        This method is called when data is received. It interprets the
-        command-and-arguments structure dictated by the API into a method
-        to which the interpreted arguments are passed. Arguments are decoded
-        using :func:`apiutils.arg_decode` before being passed on, but they
-        remain strings.
+        This method is called when a connection is accepted. A connection
+        starting with ``<KEEPALIVE>`` is handed over to :meth:`keepAlive`
+        instead.
         """
         
         #get (MAX_MESSAGE_LENGTH + 1) bytes
-        data = str(self.request.recv(self.server.MAX_MESSAGE_LENGTH+1),
-                                                    *apiutils.encoding_defaults)
+        data = self.request.recv(self.server.MAX_MESSAGE_LENGTH+1)
+        
+        rest = self.server.keepAliveRequest( data )
+        if rest is not None:
+            return self.keepAlive( rest )
+        
+        self.server.requestStarted()
+        
+        try:
+            self.dispatch( data )
+        
+        finally:
+            self.server.requestFinished()
+    
+    
+    def keepAlive(self, data):
+        """Serve requests on a persistent connection.
+        
+        The client may send any number of newline-terminated requests,
+        without waiting for responses. They are answered in order, each
+        framed by :meth:`TrackerServerMixIn.dispatchFramed`. The connection
+        is closed when the client closes it, after
+        ``KEEPALIVE_TIMEOUT`` idle seconds, or after a request which is too
+        long.
+        
+        Args:
+            data (bytes): what the client sent after ``<KEEPALIVE>``.
+        """
+        
+        server = self.server
+        peername = self.request.getpeername()
+        
+        self.request.settimeout( server.KEEPALIVE_TIMEOUT )
+        self.request.sendall( server.keepAliveResponse() )
+        
+        while True:
+            while b"\n" not in data:
+                if len(data) > server.MAX_MESSAGE_LENGTH:
+                    #too long, let dispatch reject it
+                    line, data = data, None
+                    break
+                
+                try:
+                    chunk = self.request.recv( server.MAX_MESSAGE_LENGTH+1 )
+                except OSError:
+                    return
+                
+                if not chunk:
+                    return
+                data += chunk
+            
+            else:
+                line, _, data = data.partition( b"\n" )
+            
+            server.requestStarted()
+            
+            try:
+                self.request.sendall( server.dispatchFramed( line, peername ) )
+            finally:
+                server.requestFinished()
+            
+            if data is None:
+                return
+    
+    
+    def dispatch(self, data):
+        """Convert peer requests into api_* methods.
         
+        It interprets the command-and-arguments structure dictated by the API
+        into a method to which the interpreted arguments are passed. Arguments
+        are decoded using :func:`apiutils.arg_decode` before being passed on,
+        but they remain strings.
+        
+        Args:
+            data (bytes): the raw request, at most
+                ``MAX_MESSAGE_LENGTH + 1`` bytes of it.
+        """
+        
+        raw, data = data, str(data, *apiutils.encoding_defaults)
         
         #check if data is <= MAX_MESSAGE_LENGTH
         if len(data) > self.server.MAX_MESSAGE_LENGTH:
@@ -65,7 +175,12 @@ class TrackerServerHandler(socketserver.BaseRequestHandler):
         
         #parse arguments
         args = args.split()
-        args = map( apiutils.arg_decode, args )
+        args = list( map( apiutils.arg_decode, args ) )
+        
+        #hand the request over to the worker which owns the tracker
+        name = self.torrentName( command, args )
+        if name is not None and not self.server.owns( name ):
+            return self.forward( name, raw )
         
         #find the desired method
         api_method = getattr( self, 'api_{}'.format(command),None )
@@ -83,8 +198,43 @@ class TrackerServerHandler(socketserver.BaseRequestHandler):
             if 'positional arguments' in str(err):
                 print("Bad Request: {}".format(err.args[0]))
                 return self.exception('BadRequest', err.args[0])
-            
+    
+    
+    
+    def torrentName(self, command, args):
+        """Name of the tracker that *command* operates on.
         
+        Returns:
+            str or None: None for commands which aren't about one tracker.
+        """
+        if not args:
+            return None
+        
+        if command in ('createtracker', 'updatetracker'):
+            return args[0]
+        
+        if command == 'get':
+            return trackerstore.trackName( args[0] )
+        
+        if command == 'req' and args[0].upper() == 'PEERS' and len(args) > 1:
+            return trackerstore.trackName( args[1] )
+        
+        return None
+    
+    
+    def forward(self, name, data):
+        """Relay the raw request *data* to the worker owning *name*."""
+        
+        try:
+            response = self.server.forward( name, data,
+                                            self.request.getpeername() )
+        except OSError as err:
+            print("Failed to forward request for {!r}: {}".format(name, err))
+            # this is out-of-spec, but necessary
+            return self.exception( 'WorkerUnavailable', str(err) )
+        
+        self.request.sendall( response )
+    
     
     def api_createtracker(self, fname, fsize, descrip, md5, ip, port):
         """Implements the createtracker API command.
@@ -112,12 +262,8 @@ class TrackerServerHandler(socketserver.BaseRequestHandler):
             return
         
         
-        tfname = "{}.track".format( fname )
-        
-        tfpath = os.path.join( self.server.torrents_dir, tfname )
-        
         #check if .track file already exists
-        if os.path.exists( tfpath ):
+        if fname in self.server.trackers:
             print("Couldn't create tracker, already exists.")
             self.request.sendall( b"<createtracker ferr>" )
             return
@@ -142,24 +288,173 @@ class TrackerServerHandler(socketserver.BaseRequestHandler):
         
         print("Added {} (creator) to trackerfile".format( ip ))
         
-        #write tracker to file
-        with open(tfpath, 'w') as fl:
-            fcntl.lockf( fl, fcntl.LOCK_EX )
-            tf.writeTo( fl )
-            fcntl.lockf( fl, fcntl.LOCK_UN )
-        
-        print("Wrote trackerfile to disk.")
+        #add tracker to the store, it will be written to disk by the flusher
+        if not self.server.trackers.create( fname, tf ):
+            print("Couldn't create tracker, already exists.")
+            self.request.sendall( b"<createtracker ferr>" )
+            return
         
         self.request.sendall( b"<createtracker succ>" )
         return
     
     
-    def api_updatetracker(self, fname, start_bytes, end_bytes, ip, port):
+    def api_updatetracker(self, fname, start_bytes, end_bytes, ip, port,
+                                *options):
         """Implements the updatetracker API command.
         
         All arguments are expected to be strings, but *start_bytes*,
         *end_bytes*, and *port* should be castable to :class:`int` and 
         *ip* should be castable to :class:`~ipaddress.IPv4Address`.
+        
+        A peer holding several ranges of the file may list them all with a
+        ``RANGES=start-end,start-end,...`` option, *start_bytes* and
+        *end_bytes* being its largest range. At most
+        :data:`apiutils.max_ranges` ranges are accepted.
+        """
+        
+        try:
+            ranges = self.parseOptions( options ).get("RANGES")
+        except ValueError as err:
+            return self.exception( 'BadRequest', err.args[0] )
+        
+        result = self.announce( fname, start_bytes, end_bytes, ip, port,
+                                ranges )
+        
+        if result != "succ":
+            self.request.sendall( bytes( "<updatetracker {}>".format(result),
+                                         *apiutils.encoding_defaults ) )
+            return
+        
+        #suggest when to announce again
+        self.request.sendall( bytes( "<updatetracker succ {}>".format(
+                                            self.server.announceInterval() ),
+                                     *apiutils.encoding_defaults ) )
+        return
+    
+    
+    def api_updatetrackers(self, ip, port, *entries):
+        """Implements the out-of-spec batched announce command.
+        
+        ``<updatetrackers ip port fname:start_bytes:end_bytes ...>`` does the
+        work of one updatetracker command per entry, for a single (*ip*,
+        *port*) peer. An entry may end with a fourth field listing the peer's
+        ranges, like updatetracker's ``RANGES`` option. The response has one
+        result per entry, in order::
+        
+            <updatetrackers count interval>
+            <fname result>
+            ...
+            <updatetrackers END>
+        
+        where *result* is ``succ``, ``ferr`` or ``fail`` like for
+        updatetracker, and *interval* is the suggested number of seconds
+        before the next announce. In prefork mode, entries for trackers owned
+        by other workers are forwarded to them in one batch per worker.
+        """
+        
+        results = [None] * len(entries)
+        parsed = [ self.parseEntry(entry) for entry in entries ]
+        remote = {}
+        
+        for i, parts in enumerate(parsed):
+            if parts is None:
+                print("Malformed entry: {!r}".format(entries[i]))
+                results[i] = "fail"
+            
+            elif not self.server.owns( parts[0] ):
+                worker = shardOf( parts[0], self.server.workers )
+                remote.setdefault( worker, [] ).append( i )
+            
+            else:
+                results[i] = self.announce( parts[0], parts[1], parts[2],
+                                            ip, port, parts[3] )
+        
+        for indexes in remote.values():
+            batch = [ parsed[i] for i in indexes ]
+            
+            for i, result in zip( indexes,
+                                  self.forwardAnnounces(ip, port, batch) ):
+                results[i] = result
+        
+        lines = [ "<updatetrackers {} {}>".format( len(entries),
+                                            self.server.announceInterval() ) ]
+        for entry, parts, result in zip( entries, parsed, results ):
+            fname = entry if parts is None else parts[0]
+            lines.append( "<{} {}>".format( apiutils.arg_encode(fname),
+                                            result ))
+        lines.append( "<updatetrackers END>\n" )
+        
+        self.request.sendall( bytes( "\n".join(lines),
+                                     *apiutils.encoding_defaults ) )
+    
+    
+    @staticmethod
+    def parseEntry(entry):
+        """Split an :meth:`api_updatetrackers` entry.
+        
+        Returns:
+            tuple: (*fname*, *start_bytes*, *end_bytes*, *ranges*), *ranges*
+            being None if the entry has no fourth field, or None if the entry
+            is malformed.
+        """
+        
+        ranges = None
+        
+        #filenames may contain ':', so fields are taken from the right
+        head, sep, last = entry.rpartition(':')
+        if sep and '-' in last:
+            entry, ranges = head, last
+        
+        parts = entry.rsplit( ':', 2 )
+        if len(parts) != 3:
+            return None
+        
+        return parts[0], parts[1], parts[2], ranges
+    
+    
+    def forwardAnnounces(self, ip, port, batch):
+        """Forward a batch of announces to the worker owning their trackers.
+        
+        Args:
+            batch (list): (*fname*, *start_bytes*, *end_bytes*, *ranges*)
+                entries, all for trackers owned by the same worker.
+        
+        Returns:
+            list: the result of every entry, see :meth:`api_updatetrackers`.
+        """
+        
+        entries = [ "{}:{}:{}".format( apiutils.arg_encode(fname), start, end )
+                    + ( ":" + ranges if ranges else "" )
+                    for fname, start, end, ranges in batch ]
+        data = bytes( "<updatetrackers {} {} {}>".format( ip, port,
+                                                          " ".join(entries) ),
+                      *apiutils.encoding_defaults )
+        
+        try:
+            response = self.server.forward( batch[0][0], data,
+                                            self.request.getpeername() )
+        except OSError as err:
+            print("Failed to forward announces: {}".format(err))
+            return [ "fail" ] * len(batch)
+        
+        lines = str( response, *apiutils.encoding_defaults ).split("\n")
+        results = [ line.strip("<>").split()[-1] for line in lines[1:-2] ]
+        
+        if len(results) != len(batch):
+            return [ "fail" ] * len(batch)
+        
+        return results
+    
+    
+    def announce(self, fname, start_bytes, end_bytes, ip, port, ranges=None):
+        """Add or update a peer-line of the tracker for *fname*.
+        
+        All arguments are expected to be strings, like for
+        :meth:`api_updatetracker`. *ranges*, if given, lists every range the
+        peer has, encoded with :func:`apiutils.ranges_encode`.
+        
+        Returns:
+            str: ``succ``, ``ferr`` if there's no such tracker, or ``fail``.
         """
         fname = str(fname)
         
@@ -168,143 +463,482 @@ class TrackerServerHandler(socketserver.BaseRequestHandler):
         except ValueError:
             print("Either start_bytes ({!r}), end_bytes ({!r}), or port ({!r})"\
                    " is not a valid integer".format(start_bytes,end_bytes,port))
-            self.request.sendall( b"<updatetracker fail>" )
-            return
+            return "fail"
+        
+        if ranges is not None:
+            try:
+                ranges = apiutils.ranges_decode( ranges )
+            except ValueError as err:
+                print(err)
+                return "fail"
         
         try:
             ip = IPv4Address(ip)
         except AddressValueError:
             print("Malformed IP Address: {!r}".format(ip))
-            self.request.sendall( b"<updatetracker fail>" )
-            return
-        
-        tfname = "{}.track".format( fname )
-        
-        tfpath = os.path.join( self.server.torrents_dir, tfname )
+            return "fail"
         
         #check if .track file exists
-        if not os.path.exists( tfpath ):
+        if fname not in self.server.trackers:
             print("Can't update tracker file, doesn't exist")
-            self.request.sendall( b"<updatetracker ferr>" )
-            return
+            return "ferr"
         
-        #create trackerfile from existing tracker
+        #add peer, stale peers are expired by the tracker store
         try:
-            tf = trackerfile.trackerfile.fromPath( tfpath )
+            self.server.trackers.updatePeer( fname, ip, port,
+                                             start_bytes, end_bytes, ranges )
         except Exception as err:
             print(err)
-            self.request.sendall( b"<updatetracker fail>" )
-            return
+            return "fail"
         
-        #clean trackerfile
-        tf.clean()
+        print("Added {} to trackerfile".format( ip ))
+        
+        return "succ"
+    
+    
+    
+    def api_req(self, *args):
+        """Implements the so-called "list" API command (<REQ LIST>).
+        
+        The method expects no arguments, but will accept them for compatibility.
+        The response is built by :meth:`TrackerServerMixIn.listResponse`.
+        
+        ``<REQ SEARCH ...>`` is handed over to :meth:`.search`, and
+        ``<REQ PEERS ...>`` to :meth:`.peers`.
+        """
+        
+        if args and args[0].upper() == 'SEARCH':
+            return self.search( *args[1:] )
+        
+        if args and args[0].upper() == 'PEERS':
+            return self.peers( *args[1:] )
         
-        #add peer peer
         try:
-            tf.updatePeer( ip, port, start_bytes, end_bytes )
+            response = self.server.listResponse()
         except Exception as err:
             print(err)
-            self.request.sendall( b"<updatetracker fail>" )
+            # ! this is out-of-spec, but necessary
+            self.exception(type(err).__name__, str(err))
             return
         
-        print("Added {} (creator) to trackerfile".format( ip ))
+        self.request.sendall( response )
         
-        #write tracker to file
-        with open(tfpath, 'w') as fl:
-            fcntl.lockf( fl, fcntl.LOCK_EX )
-            tf.writeTo( fl )
-            fcntl.lockf( fl, fcntl.LOCK_UN )
+        print("Successfully send REP response to {0[0]}:{0[1]}.".format(
+                                                    self.request.getpeername()))
+        return
+    
+    
+    def search(self, offset, limit, *terms):
+        """Implements the out-of-spec paginated list command (<REQ SEARCH>).
         
-        print("Wrote trackerfile to disk.")
+        ``<REQ SEARCH offset limit [term ...]>`` lists at most *limit* of the
+        trackers matching every *term*, skipping the first *offset* matches.
+        Terms are matched against the filename and description as explained
+        in :class:`~trackerstore.CatalogIndex`. *limit* is capped at
+        ``MAX_SEARCH_LIMIT``.
         
-        self.request.sendall( b"<updatetracker succ>" )
-        return
+        The response is framed like the REQ LIST one::
+        
+            <REP SEARCH count offset total>
+            <i filename filesize md5>
+            ...
+            <REP SEARCH END>
+        
+        where *i* is the position of the tracker among all *total* matches.
+        """
+        
+        try:
+            offset, limit = int(offset), int(limit)
+        except ValueError:
+            print("Either offset ({!r}) or limit ({!r}) is not a valid " \
+                                                "integer".format(offset,limit))
+            return self.exception( 'BadRequest', "offset and limit must be " \
+                                                                   "integers" )
+        
+        if offset < 0 or limit < 0:
+            return self.exception( 'BadRequest', "offset and limit must not " \
+                                                              "be negative" )
+        
+        limit = min( limit, self.server.MAX_SEARCH_LIMIT )
+        
+        total, entries = self.server.trackers.search( terms, offset, limit )
         
+        lines = [ "<REP SEARCH {} {} {}>".format(len(entries), offset, total) ]
+        for i in range(len(entries)):
+            lines.append( "<{} {} {} {}>".format(offset + i, *entries[i]) )
+        lines.append( "<REP SEARCH END>\n" )
+        
+        self.request.sendall( bytes( "\n".join(lines),
+                                     *apiutils.encoding_defaults ) )
+        
+        print("Sent {} of {} search results to {}:{}.".format( len(entries),
+                                        total, *self.request.getpeername() ))
     
     
-    def api_req(self, *_):
-        """Implements the so-called "list" API command (<REQ LIST>).
+    def peers(self, track_fname, start_byte, end_byte, limit):
+        """Implements the out-of-spec range query command (<REQ PEERS>).
         
-        The method expects no arguments, but will accept them for compatibility.
-        """
+        ``<REQ PEERS track_fname start_byte end_byte limit>`` returns the at
+        most *limit* most recently seen peers of the tracker which hold any
+        of the bytes from *start_byte* to *end_byte*. *limit* is capped at
+        ``MAX_SEARCH_LIMIT``.
+        
+        The response lists the peers like a .track file::
+        
+            <REP PEERS count total>
+            ip:port:start_byte:end_byte:timestamp
+            ...
+            <REP PEERS END md5>
         
-        thelist = []
-        tracklist = []
+        where *total* is the number of peers overlapping the range.
+        """
         
-        dirname = self.server.torrents_dir
+        name = trackerstore.trackName( str(track_fname) )
         
         try:
-            thelist = os.listdir( dirname )
-        except Exception as err:
-            print(err)
-            # ! this is out-of-spec, but necessary
-            self.exception(type(err).__name__, str(err))
-            return
+            start_byte, end_byte = int(start_byte), int(end_byte)
+            limit = int(limit)
+        except ValueError:
+            print("Either start_byte ({!r}), end_byte ({!r}) or limit ({!r}) "\
+                  "is not a valid integer".format(start_byte,end_byte,limit))
+            return self.exception( 'BadRequest', "start_byte, end_byte and " \
+                                                   "limit must be integers" )
         
-        for flname in thelist:
-            if flname.endswith('.track'):
-                tracklist.append(flname)
+        if start_byte < 0 or end_byte < start_byte or limit < 0:
+            return self.exception( 'BadRequest', "Invalid range or limit" )
         
-        self.request.sendall( bytes("<REP LIST {}>\n".format(len(tracklist)),
-                                    *apiutils.encoding_defaults) )
+        if name is None or name not in self.server.trackers:
+            print("Can't get tracker file, doesn't exist")
+            return self.exception("FileNotFound", "No such file {!r}".format(
+                                                                   track_fname))
         
-        for i in range(len(tracklist)):
-            tfname = tracklist[i]
-            
-            tf = trackerfile.trackerfile.fromPath( os.path.join(dirname,tfname))
-            
-            self.request.sendall( bytes("<{} {} {} {}>\n".format(i, tf.filename,
-                                                         tf.filesize, tf.md5),
-                                                 *apiutils.encoding_defaults) )
+        limit = min( limit, self.server.MAX_SEARCH_LIMIT )
         
-        self.request.sendall( b"<REP LIST END>\n" )
+        total, entries = self.server.trackers.overlapping( name, start_byte,
+                                                           end_byte, limit )
         
-        print("Successfully send REP response to {0[0]}:{0[1]}.".format(
-                                                    self.request.getpeername()))
-        return
+        lines = [ "<REP PEERS {} {}>".format(len(entries), total) ]
+        for peer, values in entries:
+            lines.append( "{0[0]}:{0[1]}:{1[0]}:{1[1]}:{2}".format( peer,
+                                            values, int(values[2].timestamp()) ))
+        lines.append( "<REP PEERS END {}>\n".format(
+                                            self.server.trackers.get(name).md5) )
+        
+        self.request.sendall( bytes( "\n".join(lines),
+                                     *apiutils.encoding_defaults ) )
+        
+        print("Sent {} of {} peers of {!r} to {}:{}.".format( len(entries),
+                                total, track_fname, *self.request.getpeername() ))
     
     
-    def api_get(self, track_fname):
+    def api_get(self, track_fname, *options):
         """Implements the GET API command.
         
         *track_fname* should be the name of a .track file in the torrents
         directory given in the server config file.
+        
+        *options* are ``KEY=value`` arguments. With ``VERSION=token``, where
+        *token* is the version of the tracker the client already has (or
+        ``none``), the response is versioned, see :meth:`getVersioned`.
+        
+        With ``COMPACT=1``, peer-lines are replaced by binary records, see
+        :meth:`getCompactBody`.
+        
+        With ``RANGES=1``, the ranges of peers which have several are listed
+        too: in a sixth field of their peer-lines (see :mod:`trackerfile`),
+        or in a ``<REP GET RANGES count>`` block of
+        :data:`apiutils.compact_range` records after the compact peers.
+        Without it, only their largest range is.
+        
+        Full responses list at most
+        :meth:`~TrackerServerMixIn.peerLimit` peers, picked with
+        :func:`trackerstore.selectPeers`.
         """
         track_fname = str(track_fname)
         
-        tfpath = os.path.join( self.server.torrents_dir, track_fname )
+        try:
+            options = self.parseOptions( options )
+        except ValueError as err:
+            return self.exception( 'BadRequest', err.args[0] )
+        
+        name = trackerstore.trackName( track_fname )
         
         #check if .track file exists
-        if not os.path.exists( tfpath ):
+        if name is None or name not in self.server.trackers:
             print("Can't get tracker file, doesn't exist")
             self.exception("FileNotFound", "No such file {!r}".format(
                                                                    track_fname))
             return
         
-        #create trackerfile from existing tracker
-        try:
-            tf = trackerfile.trackerfile.fromPath( tfpath )
-        except Exception as err:
-            print(err)
-            return self.exception(type(err).__name__, str(err))
-        
-        #clean trackerfile
-        if tf.clean():
-            with open( tfpath, 'w' ) as fl:
-                fcntl.lockf( fl, fcntl.LOCK_EX )
-                tf.writeTo( fl )
-                fcntl.lockf( fl, fcntl.LOCK_UN )
-        
+        limit = self.server.peerLimit()
+        compact = options.get("COMPACT", "0") not in ("", "0")
+        ranges = options.get("RANGES", "0") not in ("", "0")
+        
+        if "VERSION" in options:
+            response = self.getVersioned( name, options["VERSION"], limit,
+                                          compact, ranges )
+        elif compact:
+            _, body = self.server.trackers.rendered( name,
+                    ("COMPACT", limit, ranges),
+                    lambda tf: self.getCompactBody( self.selectPeers(tf, limit),
+                                                    ranges ),
+                    self.cacheable(limit) )
+            response = b"<REP GET BEGIN>\n" + body
+        else:
+            #the whole response is cached until the tracker changes, unless
+            #it is a random sample of its peers
+            _, response = self.server.trackers.rendered( name,
+                    ("GET", limit, ranges),
+                    lambda tf: self.getResponse( self.selectPeers(tf, limit),
+                                                 ranges ),
+                    self.cacheable(limit) )
         
-        #write the tracker file to the socket
-        self.request.sendall( b"<REP GET BEGIN>\n" )
-        tf.writeToSocket( self.request ) 
-        self.request.sendall( bytes( "<REP GET END {}>\n".format(tf.md5),
-                                                   *apiutils.encoding_defaults))
+        self.request.sendall( response )
         
         print("Sent REP response for {0!r} to {1[0]}:{1[1]}".format(track_fname,
                                                     self.request.getpeername()))
     
+    @staticmethod
+    def getResponse(tf, ranges=False):
+        """Render the complete <REP GET> response for tracker *tf*, listing
+        the peers' *ranges* if asked to.
+        
+        Returns:
+            bytes: the response, from ``<REP GET BEGIN>`` to
+            ``<REP GET END md5>``.
+        """
+        
+        return b"<REP GET BEGIN>\n" + TrackerServerHandler.getBody( tf, ranges )
+    
+    
+    def getVersioned(self, name, token, limit, compact=False, ranges=False):
+        """Render the GET response for a client which has version *token* of
+        the tracker for *name*.
+        
+        Versions are tokens of the form ``epoch-version``, see
+        :attr:`~trackerstore.TrackerStore.epoch`. The response is one of:
+        
+        * ``<REP GET NOTMODIFIED token interval>`` if the client is up to
+          date,
+        * ``<REP GET DELTA token interval>``, then a
+          ``+ip:port:start:end:timestamp`` line for every added or changed
+          peer and a ``-ip:port`` line for every removed peer, then
+          ``<REP GET END md5>``,
+        * ``<REP GET BEGIN token interval>``, then the tracker with at most
+          *limit* peers like an unversioned GET, if the changes since *token*
+          aren't known or there are more than *limit* of them.
+        
+        *interval* is the number of seconds the client should wait before
+        asking again, see :meth:`~TrackerServerMixIn.refreshInterval`. If
+        *compact*, peers are sent as binary records like in
+        :meth:`getCompactBody`, with removed peers having a timestamp of 0.
+        If *ranges*, the ranges of peers which have several are listed like
+        in :meth:`api_get`.
+        
+        Returns:
+            bytes: the response.
+        """
+        trackers = self.server.trackers
+        interval = self.server.refreshInterval()
+        
+        epoch, _, since = token.partition("-")
+        
+        if epoch == trackers.epoch and since.isdigit():
+            version, changed = trackers.changes( name, int(since) )
+        else:
+            changed = None
+        
+        if changed is not None and len(changed) > limit:
+            #too many changes, a full response is capped to limit peers
+            changed = None
+        
+        if changed is None:
+            if compact:
+                key, render = ("COMPACT", limit, ranges), self.getCompactBody
+            else:
+                key, render = ("GET VERSION", limit, ranges), self.getBody
+            
+            version, body = trackers.rendered( name, key, lambda tf:
+                                    render( self.selectPeers(tf, limit),
+                                            ranges ),
+                                    self.cacheable(limit) )
+            head = "<REP GET BEGIN {}-{} {}>\n".format( trackers.epoch, version,
+                                                       interval )
+            
+            return bytes( head, *apiutils.encoding_defaults ) + body
+        
+        token = "{}-{}".format( trackers.epoch, version )
+        
+        if not changed:
+            return bytes( "<REP GET NOTMODIFIED {} {}>\n".format(token,
+                                                                 interval),
+                          *apiutils.encoding_defaults )
+        
+        head = "<REP GET DELTA {} {}>\n".format( token, interval )
+        end = "<REP GET END {}>\n".format( trackers.get(name).md5 )
+        
+        if compact:
+            return b"".join( ( bytes( head, *apiutils.encoding_defaults ),
+                               self.packPeers( changed.items() ),
+                               self.packRanges( changed.items() ) if ranges
+                               else b"",
+                               bytes( end, *apiutils.encoding_defaults ) ) )
+        
+        lines = [ head ]
+        
+        for peer, values in changed.items():
+            if values is None:
+                lines.append( "-{0[0]}:{0[1]}\n".format(peer) )
+                continue
+            
+            line = "+{0[0]}:{0[1]}:{1[0]}:{1[1]}:{2}".format( peer, values,
+                                                int(values[2].timestamp()) )
+            if ranges and values[3]:
+                line += ":" + apiutils.ranges_encode( values[3] )
+            
+            lines.append( line + "\n" )
+        
+        lines.append( end )
+        
+        return bytes( "".join(lines), *apiutils.encoding_defaults )
+    
+    
+    def selectPeers(self, tf, limit):
+        """Trim tracker *tf* down to *limit* peers using the server's
+        :attr:`~TrackerServerMixIn.peer_strategy`."""
+        
+        return trackerstore.selectPeers( tf, limit, self.server.peer_strategy )
+    
+    
+    def cacheable(self, limit):
+        """Whether a tracker trimmed by :meth:`selectPeers` may be cached by
+        :meth:`~trackerstore.TrackerStore.rendered`.
+        
+        Returns:
+            callable: false for trackers with more than *limit* peers if
+            the peers are picked at random, so every response gets a new
+            sample.
+        """
+        if self.server.peer_strategy != 'random':
+            return None
+        
+        return lambda tf: len(tf._peers) <= limit
+    
+    
+    @classmethod
+    def getCompactBody(cls, tf, ranges=False):
+        """Render tracker *tf* with its peers as binary records.
+        
+        The metadata lines are followed by ``<REP GET PEERS count>``, then
+        *count* records packed with :data:`apiutils.compact_peer`, then if
+        *ranges* ``<REP GET RANGES count>`` and *count* records packed with
+        :data:`apiutils.compact_range`, then ``<REP GET END md5>``.
+        
+        Returns:
+            bytes: the response, minus its first line.
+        """
+        
+        meta = "".join( line + "\n" for line in tf._metadataGenerator() )
+        meta += "<REP GET PEERS {}>\n".format( len(tf._peers) )
+        
+        #peer records are stored in the wire layout, as in binary .track files
+        if ranges:
+            count, records = tf._peers.packRanges()
+            records = bytes( "<REP GET RANGES {}>\n".format(count),
+                             *apiutils.encoding_defaults ) + records
+        else:
+            records = b""
+        
+        return b"".join( ( bytes( meta, *apiutils.encoding_defaults ),
+                           tf._peers.pack(),
+                           records,
+                           bytes( "<REP GET END {}>\n".format(tf.md5),
+                                  *apiutils.encoding_defaults ) ) )
+    
+    
+    @staticmethod
+    def packPeers(peers):
+        """Pack (*peer*, *values*) pairs into a ``<REP GET PEERS count>``
+        line followed by :data:`apiutils.compact_peer` records. *values* of
+        None stand for removed peers.
+        
+        Returns:
+            bytes: the packed peers.
+        """
+        
+        records = []
+        
+        for (ip, port), values in peers:
+            if values is None:
+                records.append( apiutils.compact_peer.pack( ip.packed, port,
+                                                            0, 0, 0 ) )
+            else:
+                records.append( apiutils.compact_peer.pack( ip.packed, port,
+                                values[0], values[1],
+                                int(values[2].timestamp()) ) )
+        
+        head = "<REP GET PEERS {}>\n".format( len(records) )
+        
+        return bytes( head, *apiutils.encoding_defaults ) + b"".join( records )
+    
+    
+    @staticmethod
+    def packRanges(peers):
+        """Pack the ranges of (*peer*, *values*) pairs, as returned by
+        :meth:`~trackerstore.TrackerStore.changes`, into a
+        ``<REP GET RANGES count>`` line followed by
+        :data:`apiutils.compact_range` records.
+        
+        Returns:
+            bytes: the packed ranges.
+        """
+        
+        records = [ apiutils.compact_range.pack( ip.packed, port, start, end )
+                    for (ip, port), values in peers if values and values[3]
+                    for start, end in values[3] ]
+        
+        head = "<REP GET RANGES {}>\n".format( len(records) )
+        
+        return bytes( head, *apiutils.encoding_defaults ) + b"".join( records )
+    
+    
+    @staticmethod
+    def getBody(tf, ranges=False):
+        """Render tracker *tf* followed by ``<REP GET END md5>``, listing the
+        peers' *ranges* if asked to.
+        
+        Returns:
+            bytes: the response, minus its first line.
+        """
+        
+        return b"".join( ( tf.toBytes(ranges),
+                           bytes( "<REP GET END {}>\n".format(tf.md5),
+                                  *apiutils.encoding_defaults ) ) )
+    
+    
+    @staticmethod
+    def parseOptions(options):
+        """Parse ``KEY=value`` request options.
+        
+        Returns:
+            dict: the values, keyed by upper-cased key.
+        
+        Raises:
+            ValueError: if an option has no ``=``.
+        """
+        
+        parsed = {}
+        
+        for option in options:
+            key, sep, value = option.partition("=")
+            if not sep:
+                raise ValueError("Malformed option {!r}".format(option))
+            
+            parsed[key.upper()] = value
+        
+        return parsed
+    
+    
     def api_hello(self, *_):
         """ Implements the out-of-spec API hello message.
         
@@ -330,43 +964,315 @@ class TrackerServerHandler(socketserver.BaseRequestHandler):
         self.request.sendall( bytes(response, *apiutils.encoding_defaults) )
 
 
-class TrackerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    """The socket server for handling incoming requests.
+class _BufferedRequest:
+    """Stand-in for a request socket which collects what is sent to it.
     
-    Unlike the TCPServer constructor, this takes a *server_ip* string
-    instead of a tuple address because we will read the port for the
-    address from the config file.
+    Lets :class:`TrackerServerHandler` run outside of :mod:`socketserver`.
     
     Arguments:
-        server_ip (str): The IP to bind to and listen to.
-        RequestHandlerClass (:class:`~socketserver.BaseRequestHandler`): 
-            Should be :class:`~.TrackerServerHandler`.
-        bind_and_activate (bool, optional): automatically invokes server
-            binding and activation procedures.
-        config_file (str, optional): Path to server configuration file.
+        peername (tuple): the (ip, port) address of the remote end.
     """
     
-    allow_reuse_address = True
+    def __init__(self, peername):
+        self.peername = peername
+        self.chunks = []
+    
+    def sendall(self, data):
+        self.chunks.append( bytes(data) )
+    
+    def getpeername(self):
+        return self.peername
+    
+    def getvalue(self):
+        """bytes: everything sent so far."""
+        return b"".join( self.chunks )
+
+
+class TrackerServerMixIn:
+    """Config and tracker handling shared by the tracker server flavors.
+    
+    Attributes:
+        config_file (:class:`~sillycfg.ServerConfig`): The server config.
+        trackers (:class:`~trackerstore.TrackerStore`): The resident trackers
+            read and mutated by the request handlers.
+        worker (int): Index of this process among the prefork workers.
+        workers (int): Number of prefork workers, see :func:`servePrefork`.
+        max_peers (int): Most peers listed in a full GET response when the
+            server isn't busy, see :meth:`peerLimit`.
+        peer_strategy (str): How those peers are picked, one of
+            :const:`trackerstore.PEER_STRATEGIES`.
+    """
     
     config_file = None
+    trackers = None
+    worker = 0
+    workers = 1
+    max_peers = 200
+    peer_strategy = 'freshest'
     MAX_MESSAGE_LENGTH = 4096
+    MAX_SEARCH_LIMIT = 100
+    MIN_PEERS = 25
+    BUSY_REQUESTS = 32
+    MAX_LOAD_LEVEL = 4
+    ANNOUNCE_INTERVAL = 60
+    REFRESH_INTERVAL = 3
+    KEEPALIVE_TIMEOUT = 30
+    request_queue_size = 128
     __torrents_dir = None
+    __list_cache = (None, b"")
+    __active = 0
+    __active_lock = None
     
-    def __init__(self, server_ip, RequestHandlerClass, 
-                       bind_and_activate=True,
-                       config_file='./serverThreadConfig.cfg'):
-        """TrackerServer initializer."""
+    def _setupPeerLists(self, max_peers, peer_strategy):
+        """Configure the peer lists sent to clients, see :meth:`peerLimit`."""
+        
+        if max_peers is not None:
+            self.max_peers = int(max_peers)
+        
+        if peer_strategy is not None:
+            if peer_strategy not in trackerstore.PEER_STRATEGIES:
+                raise ValueError("Unknown peer strategy {!r}".format(
+                                                                peer_strategy))
+            self.peer_strategy = peer_strategy
+        
+        self.__active_lock = threading.Lock()
+    
+    def requestStarted(self):
+        """Count a request as in flight, see :meth:`loadLevel`."""
+        
+        with self.__active_lock:
+            self.__active += 1
+    
+    def requestFinished(self):
+        """Count a request as done, see :meth:`loadLevel`."""
+        
+        with self.__active_lock:
+            self.__active -= 1
+    
+    def loadLevel(self):
+        """How busy the server is.
+        
+        0 while fewer than ``BUSY_REQUESTS`` requests are in flight, then
+        incremented every time that number doubles, up to ``MAX_LOAD_LEVEL``.
+        """
+        
+        level = (self.__active // self.BUSY_REQUESTS).bit_length()
+        return min( level, self.MAX_LOAD_LEVEL )
+    
+    def peerLimit(self):
+        """Most peers to list in a full GET response.
+        
+        :attr:`max_peers`, halved for every :meth:`loadLevel`, but never
+        less than ``MIN_PEERS``.
+        """
+        
+        return max( self.max_peers >> self.loadLevel(),
+                    min(self.MIN_PEERS, self.max_peers) )
+    
+    def announceInterval(self):
+        """Seconds a peer should wait before announcing again.
+        
+        ``ANNOUNCE_INTERVAL``, doubled for every :meth:`loadLevel`, but
+        short enough for the peer not to be expired in between.
+        """
+        
+        interval = self.ANNOUNCE_INTERVAL << self.loadLevel()
+        timeout = int( self.trackers.peer_timeout.total_seconds() )
+        
+        return max( 1, min( interval, timeout // 2 ) )
+    
+    def refreshInterval(self):
+        """Seconds a downloading peer should wait before asking for a tracker
+        again: ``REFRESH_INTERVAL``, doubled for every :meth:`loadLevel`."""
+        
+        return self.REFRESH_INTERVAL << self.loadLevel()
+    
+    def _setupTrackers(self, server_ip, config_file, flush_interval,
+                             database=None, binary_tracks=False):
+        """Read the config and load the trackers.
+        
+        Trackers are kept in .track files in the shared folder, written in
+        the binary format if *binary_tracks*, or in the SQLite database at
+        *database* if given. An empty *database* stands for
+        :const:`sqlitestore.DB_NAME` in the shared folder.
+        
+        Returns:
+            tuple: the (ip, port) address to bind to.
+        """
         
         self.config_file = sillycfg.ServerConfig.fromFile( config_file )
         self.torrents_dir = self.config_file.sharedFolder
         server_port = self.config_file.listenPort
         
+        if flush_interval is None:
+            flush_interval = self.config_file.flushInterval
+        
+        if database == "":
+            database = os.path.join( self.torrents_dir, sqlitestore.DB_NAME )
+        
+        if database is not None:
+            backend = sqlitestore.SQLiteBackend( database )
+        else:
+            #prefork workers are started once servePrefork split the journals
+            if self.workers == 1:
+                splitJournals( self.torrents_dir, 1 )
+            
+            backend = trackerstore.TrackFileBackend( self.torrents_dir,
+                            journal_name=journalName( self.worker, self.workers ),
+                            binary=binary_tracks )
+        
+        self.trackers = trackerstore.TrackerStore( backend, flush_interval,
+                                                   owns=self.owns )
+        print("Loaded {} tracker(s) from {}".format( self.trackers.load(),
+                                                database or self.torrents_dir ))
+        
         server_address = (server_ip,server_port)
         
         print("Server will bind to {}:{}".format(*server_address))
         
-        super(TrackerServer, self).__init__(server_address, RequestHandlerClass,
-                                            bind_and_activate)
+        return server_address
+    
+    def owns(self, name):
+        """Whether the tracker for *name* is served by this process."""
+        
+        return self.workers == 1 or shardOf(name, self.workers) == self.worker
+    
+    def shardPath(self, worker):
+        """Path of the Unix socket on which *worker* takes forwarded
+        requests."""
+        
+        return os.path.join( tempfile.gettempdir(), "mstorrent-{}-{}.sock".format(
+                                        self.config_file.listenPort, worker ) )
+    
+    def forward(self, name, data, peername):
+        """Send the raw request *data* to the worker that owns *name*.
+        
+        Args:
+            name (str): Name of the tracker the request is about.
+            data (bytes): The request as received from the peer.
+            peername (tuple): Address of the peer that sent the request.
+        
+        Returns:
+            bytes: the owner's response.
+        
+        Raises:
+            OSError: if the owner can't be reached.
+        """
+        
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        
+        try:
+            sock.connect( self.shardPath( shardOf(name, self.workers) ) )
+            sock.sendall( bytes("{} {}\n".format(*peername),
+                                *apiutils.encoding_defaults) + data )
+            sock.shutdown( socket.SHUT_WR )
+            
+            chunks = []
+            while True:
+                chunk = sock.recv( 65536 )
+                if not chunk:
+                    break
+                chunks.append( chunk )
+        
+        finally:
+            sock.close()
+        
+        return b"".join( chunks )
+    
+    def keepAliveRequest(self, data):
+        """Check whether the first bytes *data* received on a connection ask
+        for a persistent connection.
+        
+        Returns:
+            bytes or None: what follows the ``<KEEPALIVE>`` line in *data*,
+            or None if *data* doesn't start with one.
+        """
+        
+        if not data.startswith( b"<KEEPALIVE>" ):
+            return None
+        
+        rest = data[len(b"<KEEPALIVE>"):]
+        
+        if rest.startswith( b"\r\n" ):
+            return rest[2:]
+        
+        return rest[1:] if rest.startswith( b"\n" ) else rest
+    
+    def keepAliveResponse(self):
+        """Answer to ``<KEEPALIVE>``: ``<KEEPALIVE timeout>``, where
+        *timeout* is the number of idle seconds after which the server closes
+        the connection."""
+        
+        return bytes( "<KEEPALIVE {}>\n".format(self.KEEPALIVE_TIMEOUT),
+                      *apiutils.encoding_defaults )
+    
+    def dispatchFramed(self, data, peername):
+        """Run a request received on a persistent connection.
+        
+        Unlike :meth:`dispatchBuffered` in a handler's :meth:`dispatch`, it
+        doesn't count the request for :meth:`loadLevel`: callers count it
+        until its response is sent.
+        
+        Returns:
+            bytes: ``<FRAME length>`` on its own line, then the *length* bytes
+            of the response.
+        """
+        
+        response = self.dispatchBuffered( data, peername )
+        
+        head = bytes( "<FRAME {}>\n".format(len(response)),
+                      *apiutils.encoding_defaults )
+        
+        return head + response
+    
+    def dispatchBuffered(self, data, peername):
+        """Run a request through a handler outside of :mod:`socketserver`.
+        
+        Args:
+            data (bytes): The raw request.
+            peername (tuple): Address of the peer that sent the request.
+        
+        Returns:
+            bytes: everything the handler responded.
+        """
+        
+        #build the handler without running socketserver's handle()
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = _BufferedRequest( peername )
+        handler.client_address = peername
+        handler.server = self
+        
+        handler.dispatch( data )
+        
+        return handler.request.getvalue()
+    
+    def listResponse(self):
+        """The full ``<REP LIST ...>`` response, as bytes.
+        
+        The response is serialized once per
+        :attr:`~trackerstore.TrackerStore.catalog_version` and cached, so
+        answering a REQ LIST is usually a single ``sendall`` of this buffer.
+        New .track files dropped into the torrents directory are picked up
+        through :meth:`~trackerstore.TrackerStore.rescan`.
+        """
+        
+        self.trackers.rescan()
+        
+        cached_version, response = self.__list_cache
+        if cached_version == self.trackers.catalog_version:
+            return response
+        
+        version, entries = self.trackers.catalog()
+        
+        lines = [ "<REP LIST {}>".format(len(entries)) ]
+        for i in range(len(entries)):
+            lines.append( "<{} {} {} {}>".format(i, *entries[i]) )
+        lines.append( "<REP LIST END>\n" )
+        
+        response = bytes( "\n".join(lines), *apiutils.encoding_defaults )
+        self.__list_cache = (version, response)
+        
+        return response
     
     @property
     def torrents_dir(self):
@@ -382,20 +1288,417 @@ class TrackerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         self.__torrents_dir = val
 
 
+class TrackerServer(TrackerServerMixIn, socketserver.ThreadingMixIn,
+                    socketserver.TCPServer):
+    """The socket server for handling incoming requests.
+    
+    Unlike the TCPServer constructor, this takes a *server_ip* string
+    instead of a tuple address because we will read the port for the
+    address from the config file.
+    
+    Arguments:
+        server_ip (str): The IP to bind to and listen to.
+        RequestHandlerClass (:class:`~socketserver.BaseRequestHandler`): 
+            Should be :class:`~.TrackerServerHandler`.
+        bind_and_activate (bool, optional): automatically invokes server
+            binding and activation procedures.
+        config_file (str, optional): Path to server configuration file.
+        flush_interval (int, optional): Seconds between writes of modified
+            trackers to disk. Overrides the value from the config file, which
+            in turn defaults to :const:`trackerstore.FLUSH_INTERVAL`.
+        worker (int, optional): Index of this process among the prefork
+            workers. Only meaningful if *workers* is more than 1.
+        workers (int, optional): Number of prefork workers sharing the listen
+            port, see :func:`servePrefork`. Defaults to 1.
+        database (str, optional): Path of a SQLite database to keep the
+            trackers in, see :mod:`sqlitestore`. An empty string stands for
+            :const:`sqlitestore.DB_NAME` in the shared folder. Defaults to
+            .track files in the shared folder.
+        binary_tracks (bool, optional): Whether to write .track files in the
+            binary format of :mod:`trackerfile`. Defaults to False.
+        max_peers (int, optional): Most peers listed in a full GET response.
+            Defaults to :attr:`~TrackerServerMixIn.max_peers`.
+        peer_strategy (str, optional): How to pick those peers, one of
+            :const:`trackerstore.PEER_STRATEGIES`. Defaults to
+            :attr:`~TrackerServerMixIn.peer_strategy`.
+    """
+    
+    allow_reuse_address = True
+    
+    def __init__(self, server_ip, RequestHandlerClass, 
+                       bind_and_activate=True,
+                       config_file=DEFAULT_CONFIG_FILE,
+                       flush_interval=None,
+                       worker=0, workers=1, database=None,
+                       binary_tracks=False, max_peers=None, peer_strategy=None):
+        """TrackerServer initializer."""
+        
+        self.worker, self.workers = int(worker), int(workers)
+        self.shard_server = None
+        
+        self._setupPeerLists( max_peers, peer_strategy )
+        
+        server_address = self._setupTrackers( server_ip, config_file,
+                                              flush_interval, database,
+                                              binary_tracks )
+        
+        super(TrackerServer, self).__init__(server_address, RequestHandlerClass,
+                                            bind_and_activate)
+        
+        if self.workers > 1:
+            self.shard_server = ShardServer( self.shardPath(self.worker), self )
+            threading.Thread( name="shard_server", daemon=True,
+                              target=self.shard_server.serve_forever ).start()
+        
+        self.trackers.start()
+    
+    def server_bind(self):
+        """Bind with SO_REUSEPORT when running as a prefork worker."""
+        
+        if self.workers > 1:
+            self.socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+        
+        super(TrackerServer, self).server_bind()
+    
+    def server_close(self):
+        """Stop the tracker flusher, write out dirty trackers, then close."""
+        
+        super(TrackerServer, self).server_close()
+        
+        if self.shard_server is not None:
+            self.shard_server.shutdown()
+            self.shard_server.server_close()
+            os.remove( self.shardPath(self.worker) )
+        
+        self.trackers.stop()
+
+
+class ShardRequestHandler(socketserver.StreamRequestHandler):
+    """Handles requests forwarded by other prefork workers.
+    
+    A forwarded request is the "ip port" address of the peer that sent it on
+    its own line, followed by the raw request. The response is the owner's
+    answer to the peer, which the forwarding worker relays.
+    """
+    
+    def handle(self):
+        ip, port = str( self.rfile.readline(),
+                        *apiutils.encoding_defaults ).split()
+        data = self.rfile.read()
+        
+        self.wfile.write( self.server.tracker_server.dispatchBuffered( data,
+                                                            (ip, int(port)) ) )
+
+
+class ShardServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server taking requests forwarded by the other workers.
+    
+    Arguments:
+        path (str): Path of the Unix socket.
+        tracker_server (:class:`TrackerServer`): The worker's tracker server,
+            which actually handles the requests.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, path, tracker_server):
+        self.tracker_server = tracker_server
+        
+        #left behind by a worker which didn't shut down cleanly
+        if os.path.exists(path):
+            os.remove(path)
+        
+        super(ShardServer, self).__init__( path, ShardRequestHandler )
+
+
+def _preforkWorker(server_ip, worker, workers, options):
+    """Body of a prefork worker process."""
+    
+    srv = TrackerServer( server_ip, TrackerServerHandler,
+                         worker=worker, workers=workers, **options )
+    
+    try:
+        srv.serve_forever()
+    
+    except KeyboardInterrupt:
+        pass
+    
+    finally:
+        #don't let a second interrupt cut the final flush short
+        signal.signal( signal.SIGINT, signal.SIG_IGN )
+        srv.server_close()
+
+
+def servePrefork(server_ip, workers, **options):
+    """Run *workers* tracker server processes sharing one listen port.
+    
+    Every worker binds the port from the config file with SO_REUSEPORT and
+    the kernel spreads incoming connections across them. Each tracker is owned
+    by exactly one worker, chosen by :func:`shardOf`; a worker receiving a
+    request about a tracker it doesn't own forwards it to the owner over a
+    Unix socket. Owners journal and flush their trackers themselves, and each
+    worker picks up the others' new trackers when listing. Before the
+    workers start, journaled records are moved to the journal of their
+    tracker's owner, in case the number of workers changed.
+    
+    Blocks until every worker has exited.
+    
+    Args:
+        server_ip (str): The IP to bind to and listen to.
+        workers (int): Number of worker processes.
+        **options: Keyword arguments for :class:`TrackerServer`, such as
+            *config_file* or *flush_interval*.
+    """
+    
+    if options.get("database") is None:
+        config = sillycfg.ServerConfig.fromFile(
+                            options.get("config_file", DEFAULT_CONFIG_FILE) )
+        splitJournals( config.sharedFolder, workers )
+    
+    procs = []
+    
+    for worker in range(workers):
+        proc = multiprocessing.Process( target=_preforkWorker,
+                                        name="tracker_worker_{}".format(worker),
+                                        args=(server_ip, worker, workers,
+                                              options) )
+        proc.start()
+        procs.append( proc )
+    
+    try:
+        for proc in procs:
+            proc.join()
+    
+    except KeyboardInterrupt:
+        #the interrupt may only have reached this process
+        for proc in procs:
+            if proc.is_alive():
+                os.kill( proc.pid, signal.SIGINT )
+        
+        for proc in procs:
+            proc.join()
+
+
+class AsyncTrackerServer(TrackerServerMixIn):
+    """Single-threaded tracker server running on an :mod:`asyncio` loop.
+    
+    Accepts the same arguments and serves the same API as
+    :class:`TrackerServer`, but handles every connection as a coroutine
+    instead of spawning a thread for it. Requests are still interpreted by
+    *RequestHandlerClass*, whose responses are buffered and written back
+    once the api_* method returns.
+    
+    Arguments:
+        server_ip (str): The IP to bind to and listen to.
+        RequestHandlerClass (:class:`~socketserver.BaseRequestHandler`): 
+            Should be :class:`~.TrackerServerHandler`.
+        config_file (str, optional): Path to server configuration file.
+        flush_interval (int, optional): See :class:`TrackerServer`.
+        database (str, optional): See :class:`TrackerServer`.
+        binary_tracks (bool, optional): See :class:`TrackerServer`.
+        max_peers (int, optional): See :class:`TrackerServer`.
+        peer_strategy (str, optional): See :class:`TrackerServer`.
+    """
+    
+    def __init__(self, server_ip, RequestHandlerClass,
+                       config_file=DEFAULT_CONFIG_FILE,
+                       flush_interval=None, database=None,
+                       binary_tracks=False, max_peers=None, peer_strategy=None):
+        """AsyncTrackerServer initializer."""
+        
+        self._setupPeerLists( max_peers, peer_strategy )
+        
+        self.server_address = self._setupTrackers( server_ip, config_file,
+                                                   flush_interval, database,
+                                                   binary_tracks )
+        self.RequestHandlerClass = RequestHandlerClass
+        
+        self._loop = None
+        self._stopping = None
+        
+        self.trackers.start()
+    
+    async def handle_connection(self, reader, writer):
+        """Serve a single connection, the coroutine version of
+        :meth:`~socketserver.BaseRequestHandler.handle`.
+        
+        Requests are dispatched one at a time on the event loop, so the
+        connection is counted for :meth:`loadLevel` from the moment it is
+        accepted until its response is drained, rather than only while it
+        is dispatched. A persistent connection is only counted while its
+        handshake is pending, then for each of its requests.
+        """
+        
+        peername = writer.get_extra_info('peername')
+        pending = True
+        self.requestStarted()
+        
+        try:
+            data = await reader.read( self.MAX_MESSAGE_LENGTH+1 )
+            
+            rest = self.keepAliveRequest( data )
+            if rest is not None:
+                pending = False
+                self.requestFinished()
+                
+                await self.keepAlive( reader, writer, rest )
+                return
+            
+            writer.write( self.dispatchBuffered( data, peername ) )
+            await writer.drain()
+        
+        except (ConnectionError, OSError) as err:
+            print(err)
+        
+        finally:
+            if pending:
+                self.requestFinished()
+            
+            writer.close()
+    
+    async def keepAlive(self, reader, writer, data):
+        """Serve requests on a persistent connection, the coroutine version
+        of :meth:`TrackerServerHandler.keepAlive`."""
+        
+        peername = writer.get_extra_info('peername')
+        
+        writer.write( self.keepAliveResponse() )
+        await writer.drain()
+        
+        while True:
+            while b"\n" not in data:
+                if len(data) > self.MAX_MESSAGE_LENGTH:
+                    line, data = data, None
+                    break
+                
+                try:
+                    chunk = await asyncio.wait_for(
+                                    reader.read( self.MAX_MESSAGE_LENGTH+1 ),
+                                    self.KEEPALIVE_TIMEOUT )
+                except asyncio.TimeoutError:
+                    return
+                
+                if not chunk:
+                    return
+                data += chunk
+            
+            else:
+                line, _, data = data.partition( b"\n" )
+            
+            #counted until drained, as in handle_connection
+            self.requestStarted()
+            
+            try:
+                writer.write( self.dispatchFramed( line, peername ) )
+                await writer.drain()
+            finally:
+                self.requestFinished()
+            
+            if data is None:
+                return
+    
+    async def serve(self):
+        """Coroutine accepting connections until :meth:`shutdown`."""
+        
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        
+        server = await asyncio.start_server( self.handle_connection,
+                                             *self.server_address,
+                                             backlog=self.request_queue_size,
+                                             reuse_address=True )
+        
+        async with server:
+            await server.start_serving()
+            await self._stopping.wait()
+    
+    def serve_forever(self):
+        """Run the event loop until :meth:`shutdown` is called."""
+        
+        asyncio.run( self.serve() )
+    
+    def shutdown(self):
+        """Stop :meth:`serve_forever`. May be called from any thread."""
+        
+        if self._loop is not None and not self._loop.is_closed():
+            try:
+                self._loop.call_soon_threadsafe( self._stopping.set )
+            except RuntimeError:
+                #loop already closed
+                pass
+    
+    def server_close(self):
+        """Stop the tracker flusher and write out dirty trackers."""
+        
+        self.trackers.stop()
+
+
 #
 # Executable form for testing
 #
 if __name__ == '__main__':
     
+    parser = argparse.ArgumentParser( description="Tracker server" )
+    parser.add_argument( "ip", nargs="?", default="localhost",
+                         help="IP address to listen on" )
+    parser.add_argument( "--asyncio", action="store_true",
+                         help="serve every connection from a single asyncio "
+                              "event loop instead of one thread each" )
+    parser.add_argument( "--workers", type=int, default=1,
+                         help="number of threaded server processes sharing "
+                              "the listen port (default: 1)" )
+    parser.add_argument( "--max-peers", type=int,
+                         help="most peers listed in a GET response when the "
+                              "server isn't busy (default: {})".format(
+                                            TrackerServerMixIn.max_peers) )
+    parser.add_argument( "--peer-strategy",
+                         choices=trackerstore.PEER_STRATEGIES,
+                         help="how to pick the peers listed in a GET response "
+                              "(default: {})".format(
+                                            TrackerServerMixIn.peer_strategy) )
+    parser.add_argument( "--sqlite", metavar="DATABASE", nargs="?", const="",
+                         help="keep trackers in a SQLite database instead of "
+                              ".track files (default database: {} in the "
+                              "shared folder)".format(sqlitestore.DB_NAME) )
+    parser.add_argument( "--binary-tracks", action="store_true",
+                         help="write .track files in the binary format" )
+    args = parser.parse_args()
+    
+    if args.asyncio and args.workers > 1:
+        parser.error("--asyncio can't be combined with --workers, every "
+                     "prefork worker is a threaded server")
+    
     srv_ip = "localhost"
     
-    if len(sys.argv) > 1:
+    try:
+        srv_ip = str( IPv4Address(args.ip) )
+    except AddressValueError:
+        pass
+    
+    if args.workers > 1:
         try:
-            srv_ip = str( IPv4Address(sys.argv[1]) )
-        except AddressValueError:
+            servePrefork( srv_ip, args.workers, database=args.sqlite,
+                          binary_tracks=args.binary_tracks,
+                          max_peers=args.max_peers,
+                          peer_strategy=args.peer_strategy )
+        except KeyboardInterrupt:
             pass
+        
+        print("Tracker server has shut down")
+        sys.exit(0)
     
-    srv = TrackerServer( srv_ip, TrackerServerHandler )
+    if args.asyncio:
+        srv = AsyncTrackerServer( srv_ip, TrackerServerHandler,
+                                  database=args.sqlite,
+                                  binary_tracks=args.binary_tracks,
+                                  max_peers=args.max_peers,
+                                  peer_strategy=args.peer_strategy )
+    else:
+        srv = TrackerServer( srv_ip, TrackerServerHandler,
+                             database=args.sqlite,
+                             binary_tracks=args.binary_tracks,
+                             max_peers=args.max_peers,
+                             peer_strategy=args.peer_strategy )
     
     print("Listening on port {}".format(srv.config_file.listenPort))
     
@@ -405,7 +1708,8 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         print("\n"+"="*40)
         print("Bye, have a wonderful time! (Tracker server shutting down)")
-        
+    
     finally:
         srv.shutdown()
+        srv.server_close()
         print("Tracker server has shut down")
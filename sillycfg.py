@@ -363,6 +363,9 @@ class ServerConfig(BaseConfig):
     
     Spec defines that *"[f]irst line is the port no to which the peer listens...
     and last line is the name of the shared folder"*.
+    
+    We additionally allow an optional integer line between the two, the
+    number of seconds between flushes of modified trackers to disk.
     """
     
     def _validate(self):
@@ -395,3 +398,19 @@ class ServerConfig(BaseConfig):
             raise InvalidCfg
         
         return self[-1]
+    
+    
+    @property
+    def flushInterval(self):
+        """ServerConfig-specific attribute, seconds between tracker flushes.
+        
+        NOT DEFINED BY SPEC.
+        Optional, should be the second line of config. None if missing.
+        """
+        if not self.validate():
+            raise InvalidCfg
+        
+        if len(self) > 2 and isinstance(self[1],int):
+            return self[1]
+        
+        return None
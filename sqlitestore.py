@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""SQLite persistence for the tracker server.
+
+:class:`SQLiteBackend` keeps every tracker in a single SQLite database instead
+of one .track file each, for deployments with many torrents. The database is
+opened in WAL mode so readers never block the flusher, and each flush writes
+all dirty trackers in a single transaction: a crash leaves the database as of
+the previous flush. Mutations made since are lost, so the flush interval
+bounds how much announce state can be lost.
+
+The database can be created from, and exported back to, a directory of
+.track files with :func:`importTrackFiles` and :func:`exportTrackFiles`, or
+from the command line::
+    
+    ./sqlitestore.py import trackers.sqlite3 torrents/
+    ./sqlitestore.py export trackers.sqlite3 torrents/
+
+Attributes:
+    DB_NAME (str): default name of the database in the torrents directory.
+"""
+
+__license__ = "MIT"
+__docformat__ = 'reStructuredText'
+
+import sqlite3
+import socket
+import threading
+import datetime
+import argparse
+import itertools
+import sys
+from ipaddress import IPv4Address
+
+import apiutils
+import trackerfile
+import trackerstore
+
+
+DB_NAME = 'trackers.sqlite3'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    name        TEXT PRIMARY KEY,
+    filesize    INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    md5         TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS peers (
+    torrent     TEXT NOT NULL REFERENCES torrents (name),
+    ip          TEXT NOT NULL,
+    port        INTEGER NOT NULL,
+    start_byte  INTEGER NOT NULL,
+    end_byte    INTEGER NOT NULL,
+    last_seen   INTEGER NOT NULL,
+    ranges      TEXT,
+    PRIMARY KEY (torrent, ip, port)
+);
+CREATE INDEX IF NOT EXISTS peers_last_seen ON peers (torrent, last_seen);
+"""
+
+
+class SQLiteBackend(trackerstore.BaseBackend):
+    """Stores every tracker in one SQLite database.
+    
+    Trackers are rows of the ``torrents`` table and their peers rows of the
+    ``peers`` table, indexed on (torrent, last_seen). The ``ranges`` column
+    holds the ranges of peers which have several, encoded with
+    :func:`apiutils.ranges_encode`, and is NULL otherwise. A flush replaces the
+    peer rows of every dirty tracker in one transaction; mutations aren't
+    recorded in between.
+    
+    Trackers added by other processes sharing the database are noticed
+    through ``PRAGMA data_version``, which changes whenever another
+    connection commits, and then the largest rowid of ``torrents``, which
+    only changes when a tracker is added: flushes of peer rows by other
+    processes don't cause a rescan.
+    
+    Arguments:
+        path (str): Path of the database, created if missing.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect( path, check_same_thread=False )
+        self._data_version = None
+        self._last_torrent = None
+        
+        with self._lock:
+            self._db.execute( "PRAGMA journal_mode=WAL" )
+            self._db.execute( "PRAGMA synchronous=NORMAL" )
+            self._db.execute( "PRAGMA busy_timeout=5000" )
+            self._db.executescript( _SCHEMA )
+            
+            #databases created before peers could have several ranges
+            columns = [ row[1] for row in
+                        self._db.execute( "PRAGMA table_info(peers)" ) ]
+            if "ranges" not in columns:
+                self._db.execute( "ALTER TABLE peers ADD COLUMN ranges TEXT" )
+    
+    
+    def load(self):
+        return self.scan( () ), set()
+    
+    
+    def changed(self):
+        """True if another connection added a tracker since the last scan."""
+        with self._lock:
+            version = self._db.execute( "PRAGMA data_version" ).fetchone()[0]
+            if version == self._data_version:
+                return False
+            
+            self._data_version = version
+            return self._lastTorrent() != self._last_torrent
+    
+    
+    def _lastTorrent(self):
+        """Largest rowid of ``torrents``; must hold :attr:`_lock`."""
+        return self._db.execute( "SELECT max(rowid) FROM torrents" ).fetchone()[0]
+    
+    
+    def scan(self, known):
+        """Read every tracker whose name isn't in *known*.
+        
+        Only the peer rows of those trackers are read, unless *known* is
+        empty and every peer row is wanted anyway.
+        """
+        trackers = {}
+        
+        with self._lock:
+            self._data_version = self._db.execute(
+                                        "PRAGMA data_version" ).fetchone()[0]
+            self._last_torrent = self._lastTorrent()
+            
+            for name, size, descrip, md5 in self._db.execute(
+                    "SELECT name, filesize, description, md5 FROM torrents" ):
+                
+                if name not in known:
+                    trackers[name] = trackerfile.trackerfile( name, size,
+                                                              descrip, md5 )
+            
+            query = ( "SELECT torrent, ip, port, start_byte, end_byte, "
+                      "last_seen, ranges FROM peers" )
+            
+            if not known:
+                rows = self._db.execute( query )
+            else:
+                rows = itertools.chain.from_iterable(
+                        self._db.execute( query + " WHERE torrent = ?",
+                                          (name,) ).fetchall()
+                        for name in list(trackers) )
+            
+            for name, ip, port, start, end, seen, ranges in rows:
+                if name in trackers:
+                    trackers[name].updatePeer( IPv4Address(ip), port,
+                                    start, end,
+                                    datetime.datetime.utcfromtimestamp(seen),
+                                    ranges and apiutils.ranges_decode(ranges) )
+        
+        return trackers
+    
+    
+    def exists(self, name):
+        with self._lock:
+            return self._db.execute( "SELECT 1 FROM torrents WHERE name = ?",
+                                     (name,) ).fetchone() is not None
+    
+    
+    def serialize(self, name, tf):
+        """Capture the tracker's metadata row and its peer rows."""
+        peers = [ (name, socket.inet_ntoa(ip), port, record.start_byte,
+                   record.end_byte, record.stamp,
+                   record.ranges and apiutils.ranges_encode( record.spans() ))
+                  for (ip, port), record in tf._peers.records() ]
+        
+        return (name, tf.filesize, tf.description, tf.md5), peers
+    
+    
+    def write(self, items):
+        """Write every tracker in one transaction.
+        
+        Either all trackers are written, or none is.
+        """
+        with self._lock:
+            try:
+                with self._db:
+                    for name, (meta, peers) in items:
+                        self._db.execute( "INSERT OR IGNORE INTO torrents "
+                                          "VALUES (?, ?, ?, ?)", meta )
+                        self._db.execute( "DELETE FROM peers WHERE torrent = ?",
+                                          (name,) )
+                        self._db.executemany( "INSERT INTO peers "
+                                              "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                              peers )
+            
+            except sqlite3.Error as err:
+                print("Failed to write {} tracker(s): {}".format(len(items),
+                                                                 err))
+                return [ name for name, _ in items ]
+        
+        return []
+    
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _copy(source, dest):
+    """Write every tracker from backend *source* to backend *dest*.
+    
+    Returns:
+        int: the number of trackers copied.
+    """
+    trackers, _ = source.load()
+    
+    failed = dest.write( [ (name, dest.serialize(name, tf))
+                           for name, tf in trackers.items() ] )
+    if failed:
+        raise IOError("Failed to write {} tracker(s)".format(len(failed)))
+    
+    return len(trackers)
+
+
+def importTrackFiles(db_path, torrents_dir):
+    """Copy the .track files of *torrents_dir* into the database at
+    *db_path*, including any change still in the journal.
+    
+    Returns:
+        int: the number of trackers imported.
+    """
+    source = trackerstore.TrackFileBackend( torrents_dir )
+    dest = SQLiteBackend( db_path )
+    
+    try:
+        return _copy( source, dest )
+    finally:
+        source.close()
+        dest.close()
+
+
+def exportTrackFiles(db_path, torrents_dir):
+    """Write every tracker of the database at *db_path* to a .track file in
+    *torrents_dir*.
+    
+    Returns:
+        int: the number of trackers exported.
+    """
+    source = SQLiteBackend( db_path )
+    dest = trackerstore.TrackFileBackend( torrents_dir, journal=False )
+    
+    try:
+        return _copy( source, dest )
+    finally:
+        source.close()
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(
+                    description="Convert between .track files and a database" )
+    parser.add_argument( "action", choices=("import", "export"),
+                         help="import .track files into the database, or "
+                              "export the database to .track files" )
+    parser.add_argument( "database", help="path of the SQLite database" )
+    parser.add_argument( "torrents_dir",
+                         help="directory containing the .track files" )
+    args = parser.parse_args()
+    
+    if args.action == "import":
+        count = importTrackFiles( args.database, args.torrents_dir )
+    else:
+        count = exportTrackFiles( args.database, args.torrents_dir )
+    
+    print("{}ed {} tracker(s)".format( args.action.capitalize(), count ))
+    sys.exit(0)
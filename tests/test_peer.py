@@ -0,0 +1,294 @@
+"""Tests for :mod:`peer`."""
+
+import multiprocessing
+import os
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname(__file__), '..' ) )
+
+import peer
+import server
+
+
+@unittest.skipUnless( peer.SENDFILE, "os.sendfile is unavailable" )
+class TestSendfile(unittest.TestCase):
+
+    SIZE = 4 << 20
+
+
+    def setUp(self):
+        self.file = tempfile.TemporaryFile()
+        self.data = os.urandom(self.SIZE)
+        self.file.write(self.data)
+        self.file.flush()
+
+        self.sender, self.receiver = socket.socketpair()
+        self.sender.setsockopt( socket.SOL_SOCKET, socket.SO_SNDBUF, 4096 )
+        self.receiver.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 4096 )
+
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        self.file.close()
+
+
+    def test_slow_reader(self):
+        """A socket with a timeout is non-blocking: a full send buffer is
+        waited on instead of failing with EAGAIN."""
+        self.sender.settimeout(5)
+        received = bytearray()
+
+        def read():
+            while len(received) < self.SIZE - 1000:
+                time.sleep(0.001)
+                received.extend( self.receiver.recv(65536) )
+
+        reader = threading.Thread( target=read )
+        reader.start()
+        peer.networkutil.sendfile( self.sender, self.file, 1000,
+                                   self.SIZE - 1000 )
+        reader.join(10)
+
+        self.assertEqual( bytes(received), self.data[1000:] )
+
+
+    def test_stalled_reader(self):
+        """A reader that never reads makes it time out."""
+        self.sender.settimeout(0.2)
+
+        with self.assertRaises( socket.timeout ):
+            peer.networkutil.sendfile( self.sender, self.file, 0, self.SIZE )
+
+
+class TestPeerConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind( ('127.0.0.1', 0) )
+        self.listener.listen(1)
+        self.peer = self.listener.getsockname()
+        self.timeout = peer.CONNECT_TIMEOUT
+        peer.CONNECT_TIMEOUT = 0.2
+
+
+    def tearDown(self):
+        peer.CONNECT_TIMEOUT = self.timeout
+        peer.peerconnection.one_shot.discard(self.peer)
+        self.listener.close()
+
+
+    def test_silent_handshake(self):
+        """A peer which never answers the handshake doesn't hang open()."""
+        start = time.monotonic()
+        conn = peer.peerconnection.open(self.peer)
+
+        self.assertIsNone(conn)
+        self.assertLess( time.monotonic() - start, 5 )
+        self.assertIn( self.peer, peer.peerconnection.one_shot )
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.interval = peer.FILE_CHECK_INTERVAL
+        peer.FILE_CHECK_INTERVAL = 0
+        self.files = peer.filecache( self.dir, 4 )
+        self.write( 'f', b'old' )
+
+
+    def tearDown(self):
+        peer.FILE_CHECK_INTERVAL = self.interval
+        self.files.clear()
+        shutil.rmtree( self.dir )
+
+
+    def write(self, name, data):
+        path = os.path.join( self.dir, name )
+        with open( path + '.tmp', 'wb' ) as fl:
+            fl.write(data)
+        os.rename( path + '.tmp', path )
+        with open( path + '.log', 'w' ) as log:
+            log.write( "0:{}\n".format( len(data) ) )
+
+
+    def read(self, name):
+        file = self.files.acquire(name)
+        if file is None:
+            return None
+        try:
+            return os.pread( file.fileno(), 100, 0 )
+        finally:
+            self.files.release(file)
+
+
+    def test_deleted_log(self):
+        """A torrent whose .log is deleted isn't served anymore."""
+        self.assertEqual( self.read('f'), b'old' )
+        os.remove( os.path.join( self.dir, 'f.log' ) )
+        self.assertIsNone( self.read('f') )
+
+
+    def test_replaced_file(self):
+        """A file replaced on disk is reopened."""
+        self.assertEqual( self.read('f'), b'old' )
+        self.write( 'f', b'new' )
+        self.assertEqual( self.read('f'), b'new' )
+
+
+    def test_recheck_interval(self):
+        """Entries are only checked every FILE_CHECK_INTERVAL seconds."""
+        peer.FILE_CHECK_INTERVAL = 60
+        self.assertEqual( self.read('f'), b'old' )
+        self.write( 'f', b'new' )
+        self.assertEqual( self.read('f'), b'old' )
+
+
+    def test_invalidate_other_entry(self):
+        """Invalidating a stale entry spares the one which replaced it."""
+        stale = self.files.acquire('f')
+        self.write( 'f', b'new' )
+        fresh = self.files.acquire('f')
+        self.assertIsNot( stale, fresh )
+
+        self.files.invalidate( 'f', stale )
+        self.files.release(stale)
+        self.assertIs( self.files.files['f'], fresh )
+        self.assertFalse( fresh.evicted )
+        self.files.release(fresh)
+
+
+class TestBadSegment(unittest.TestCase):
+
+    SIZE = 100000
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(self.SIZE)
+        with open( os.path.join( self.dir, 'f' ), 'wb' ) as fl:
+            fl.write(self.data)
+        with open( os.path.join( self.dir, 'f.log' ), 'w' ) as log:
+            log.write( "0:{}\n".format(self.SIZE) )
+
+        self.server = peer.PeerServer( ('127.0.0.1', 0),
+                                       peer.PeerServerHandler,
+                                       torrents_dir=self.dir )
+        threading.Thread( target=self.server.serve_forever,
+                          daemon=True ).start()
+        self.conn = socket.create_connection( self.server.server_address,
+                                              timeout=10 )
+        self.reader = self.conn.makefile('rb')
+
+
+    def tearDown(self):
+        self.reader.close()
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.files.clear()
+        shutil.rmtree( self.dir )
+
+
+    def frame(self):
+        """Read the next framed response."""
+        head = self.reader.readline().decode()
+        self.assertTrue( head.startswith("<FRAME "), head )
+        return self.reader.read( int( head.split()[-1][:-1] ) )
+
+
+    def test_bad_ranges(self):
+        """Malformed or negative ranges are rejected before any header, and
+        the connection keeps serving."""
+        self.conn.sendall( b"<KEEPALIVE>\n"
+                           b"<GET SEG f x 10>\n"
+                           b"<GET SEG f 0 ten RAW=1>\n"
+                           b"<GET SEG f -5 70000 RAW=1>\n"
+                           b"<GET SEG f 10 -1>\n"
+                           b"<GET SEG f 10 70000 RAW=1>\n" )
+        self.assertTrue( self.reader.readline().startswith(b"<KEEPALIVE ") )
+
+        for _ in range(4):
+            self.assertTrue( self.frame().startswith(
+                                            b"<EXCEPTION BadRequest>\n") )
+
+        self.assertEqual( self.frame(), b"<GET RAW 70000>\n"
+                                        + self.data[10:70010] )
+
+
+@unittest.skipUnless( hasattr(os, "register_at_fork"), "os.register_at_fork is "
+                      "unavailable" )
+class TestForkedPool(unittest.TestCase):
+
+    MESSAGES = 200
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        config = os.path.join( self.dir, "server.cfg" )
+        with open( config, 'w' ) as fl:
+            fl.write( "0\n{}\n".format( os.path.join(self.dir, "torrents") ) )
+
+        self.server = server.TrackerServer( "127.0.0.1",
+                                            server.TrackerServerHandler,
+                                            config_file=config )
+        threading.Thread( target=self.server.serve_forever,
+                          daemon=True ).start()
+        self.address = self.server.server_address
+
+        for name in ("parent", "child"):
+            self.send( "<createtracker {} 100 x {} 1.2.3.4 5>".format(
+                                                            name, 'a' * 32 ) )
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.socket.close()
+        peer.networkutil.forget()
+        shutil.rmtree( self.dir )
+
+
+    def send(self, message):
+        return peer.networkutil.send( *self.address, message )
+
+
+    def fetch(self, name):
+        """GET the tracker of *name* repeatedly; True if every response was
+        the right one."""
+        for _ in range(self.MESSAGES):
+            response = self.send( "<GET {}.track>".format(name) )
+            if "Filename: {}\n".format(name) not in (response or ""):
+                return False
+        return True
+
+
+    def child(self, results):
+        results.put( self.fetch("child") )
+
+
+    def test_parent_and_child(self):
+        """A forked child doesn't share the parent's pooled connection."""
+        self.assertTrue( self.fetch("parent") )
+        self.assertTrue( peer.networkutil.pool )
+
+        results = multiprocessing.get_context("fork").Queue()
+        child = multiprocessing.get_context("fork").Process(
+                                    target=self.child, args=(results,) )
+        child.start()
+        ours = self.fetch("parent")
+        child.join(30)
+
+        self.assertTrue( ours )
+        self.assertTrue( results.get( timeout=5 ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""Tests for :mod:`server`."""
+
+import os.path
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname(__file__), '..' ) )
+
+import server
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a tracker server on a free port for every test."""
+
+    SERVER = server.TrackerServer
+    OPTIONS = {}
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        config = os.path.join( self.dir, "server.cfg" )
+        with open( config, 'w' ) as fl:
+            fl.write( "{}\n{}\n".format( self.freePort(),
+                                         os.path.join(self.dir, "torrents") ) )
+
+        self.server = self.SERVER( "127.0.0.1", server.TrackerServerHandler,
+                                   config_file=config, **self.OPTIONS )
+        self.thread = threading.Thread( target=self.server.serve_forever,
+                                        daemon=True )
+        self.thread.start()
+        self.address = self.server.server_address
+
+        #the asyncio server only listens once its loop runs
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection( self.address, timeout=10 ).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(10)
+        self.server.server_close()
+        shutil.rmtree( self.dir )
+
+
+    @staticmethod
+    def freePort():
+        with socket.socket() as s:
+            s.bind( ('127.0.0.1', 0) )
+            return s.getsockname()[1]
+
+
+    def send(self, message):
+        """Send *message* on a new connection and return the response."""
+        with socket.create_connection( self.address, timeout=10 ) as s:
+            s.sendall( message.encode() )
+            s.shutdown( socket.SHUT_WR )
+
+            response = b""
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    return response.decode("latin-1")
+                response += chunk
+
+
+    def create(self, name):
+        self.assertIn( "succ", self.send( "<createtracker {} 100000 x {} "
+                                          "1.2.3.4 5>".format( name,
+                                                               'a' * 32 ) ) )
+
+
+    def announce(self, name, port, start=0, end=1000):
+        return self.send( "<updatetracker {} {} {} 10.0.0.1 {}>".format(
+                                                  name, start, end, port ) )
+
+
+    def peers(self, response):
+        """The ip:port of every peer-line of a text GET *response*."""
+        return { line.rsplit(":", 3)[0] for line in response.splitlines()
+                 if re.match( r"\d+\.\d+\.\d+\.\d+:", line ) }
+
+
+class TestConcurrentUpdates(ServerTestCase):
+
+    TORRENTS = 4
+    THREADS = 8
+    PEERS = 20
+
+
+    def announceAll(self, thread):
+        for i in range(self.PEERS):
+            for torrent in range(self.TORRENTS):
+                response = self.announce( "file{}".format(torrent),
+                                          thread * 100 + i, 0, i + 1 )
+                if "succ" not in response:
+                    return
+
+
+    def test_no_lost_updates(self):
+        """Concurrent updatetracker requests for several torrents all make
+        it into the trackers."""
+        for torrent in range(self.TORRENTS):
+            self.create( "file{}".format(torrent) )
+
+        threads = [ threading.Thread( target=self.announceAll, args=(i,) )
+                    for i in range(self.THREADS) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+
+        expected = { "10.0.0.1:{}".format( thread * 100 + i )
+                     for thread in range(self.THREADS)
+                     for i in range(self.PEERS) } | { "1.2.3.4:5" }
+
+        for torrent in range(self.TORRENTS):
+            response = self.send( "<GET file{}.track>".format(torrent) )
+            self.assertEqual( self.peers(response), expected )
+
+
+class TestRandomPeers(ServerTestCase):
+
+    OPTIONS = { 'max_peers': 5, 'peer_strategy': 'random' }
+
+
+    def setUp(self):
+        super().setUp()
+        self.create("f")
+        for port in range(1, 51):
+            self.announce( "f", port )
+
+
+    def test_fresh_sample(self):
+        """GETs of an unchanged tracker with too many peers aren't served
+        the same cached sample."""
+        for request in ("<GET f.track>", "<GET f.track COMPACT=1>",
+                        "<GET f.track VERSION=none>"):
+            samples = set()
+            for _ in range(10):
+                response = self.send(request)
+                self.assertIn( "<REP GET BEGIN", response )
+                samples.add( response )
+
+            self.assertGreater( len(samples), 1, request )
+
+        self.assertEqual( len( self.peers( self.send("<GET f.track>") ) ), 5 )
+
+
+class TestDelta(ServerTestCase):
+
+    OPTIONS = { 'max_peers': 5 }
+
+
+    def test_capped_delta(self):
+        """More changes than a full response may list get a full
+        response."""
+        self.create("f")
+        self.announce( "f", 1 )
+        head = self.send("<GET f.track VERSION=none>").splitlines()[0]
+        token = head.split()[3]
+
+        self.announce( "f", 2 )
+        response = self.send( "<GET f.track VERSION={}>".format(token) )
+        self.assertTrue( response.startswith("<REP GET DELTA") )
+        self.assertEqual( self.peers(response), set() )
+        self.assertIn( "+10.0.0.1:2:", response )
+
+        for port in range(3, 20):
+            self.announce( "f", port )
+        response = self.send( "<GET f.track VERSION={}>".format(token) )
+        self.assertTrue( response.startswith("<REP GET BEGIN") )
+        self.assertEqual( len( self.peers(response) ), 5 )
+
+
+class TestAsyncLoad(ServerTestCase):
+
+    SERVER = server.AsyncTrackerServer
+
+
+    def test_pending_connections(self):
+        """Connections waiting on the event loop count towards the load."""
+        self.server.BUSY_REQUESTS = 2
+        self.assertEqual( self.server.loadLevel(), 0 )
+
+        clients = [ socket.create_connection( self.address, timeout=10 )
+                    for _ in range(4) ]
+        try:
+            deadline = time.monotonic() + 10
+            while ( self.server.loadLevel() < 2
+                    and time.monotonic() < deadline ):
+                time.sleep(0.01)
+            self.assertEqual( self.server.loadLevel(), 2 )
+        finally:
+            for client in clients:
+                client.close()
+
+        deadline = time.monotonic() + 10
+        while self.server.loadLevel() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual( self.server.loadLevel(), 0 )
+
+
+if __name__ == '__main__':
+    unittest.main()
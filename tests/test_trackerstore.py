@@ -0,0 +1,318 @@
+"""Tests for :mod:`trackerstore`."""
+
+import datetime
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname(__file__), '..' ) )
+
+import trackerfile
+import trackerstore
+
+
+class SlowBackend(trackerstore.TrackFileBackend):
+    """Journals like :class:`trackerstore.TrackFileBackend`, but every record
+    waits on :attr:`gate` first, as if the disk were slow."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.recording = threading.Event()
+
+
+    def record(self, *fields):
+        self.recording.set()
+        self.gate.wait(10)
+        super().record( *fields )
+
+
+class TestConcurrentAnnounces(unittest.TestCase):
+
+    THREADS = 8
+    PEERS = 50
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.backend = SlowBackend( self.dir )
+        self.store = trackerstore.TrackerStore( self.backend, 3600 )
+
+        for i in range(self.THREADS):
+            self.store.create( self.name(i),
+                trackerfile.trackerfile( self.name(i), 1000, 'x', 'a' * 32 ) )
+
+
+    def tearDown(self):
+        self.backend.gate.set()
+        self.backend.close()
+        shutil.rmtree( self.dir )
+
+
+    def name(self, i):
+        return "file{}".format(i)
+
+
+    def announce(self, i):
+        for port in range(1, self.PEERS + 1):
+            self.store.updatePeer( self.name(i), '10.0.0.1', port, 0, port )
+
+
+    def reload(self):
+        """Load a fresh store from the directory, as after a crash."""
+        store = trackerstore.TrackerStore(
+                        trackerstore.TrackFileBackend(self.dir), 3600 )
+        store.load()
+        return store
+
+
+    def test_journal_io_outside_store_lock(self):
+        """A slow journal write doesn't block announces to other trackers."""
+        self.store.flush()
+        self.backend.gate.clear()
+        self.backend.recording.clear()
+
+        writer = threading.Thread( target=self.store.updatePeer,
+                                   args=(self.name(0), '10.0.0.2', 1, 0, 1) )
+        writer.start()
+        self.assertTrue( self.backend.recording.wait(10) )
+
+        #the writer is stuck in the backend; these only queue their records
+        other = threading.Thread( target=self.announce, args=(1,) )
+        other.start()
+        other.join(10)
+        self.assertFalse( other.is_alive() )
+        self.assertTrue( self.store.lock.acquire( timeout=1 ) )
+        self.store.lock.release()
+
+        self.backend.gate.set()
+        writer.join(10)
+        self.assertFalse( writer.is_alive() )
+
+        store = self.reload()
+        self.assertEqual( len( store.get( self.name(1) )._peers ), self.PEERS )
+        self.assertEqual( len( store.get( self.name(0) )._peers ), 1 )
+
+
+    def test_no_lost_updates(self):
+        """Concurrent announces and flushes lose nothing, in memory or once
+        the journal is replayed."""
+        threads = [ threading.Thread( target=self.announce, args=(i,) )
+                    for i in range(self.THREADS) ]
+        stop = threading.Event()
+
+        def flusher():
+            while not stop.is_set():
+                self.store.flush()
+
+        flushing = threading.Thread( target=flusher )
+        flushing.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        flushing.join()
+
+        store = self.reload()
+        for i in range(self.THREADS):
+            self.assertEqual( len( self.store.get( self.name(i) )._peers ),
+                              self.PEERS )
+            self.assertEqual( len( store.get( self.name(i) )._peers ),
+                              self.PEERS )
+
+        #the journal holds whatever the last flush didn't compact
+        self.assertEqual( self.store._records, [] )
+
+
+class TestRendered(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = trackerstore.TrackerStore(
+                trackerstore.TrackFileBackend( self.dir, journal=False ), 3600 )
+        self.store.create( 'f', trackerfile.trackerfile( 'f', 1000, 'x',
+                                                         'a' * 32 ) )
+
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+
+    def render(self, key):
+        return self.store.rendered( 'f', key,
+                                    lambda tf: ( key, len(tf._peers) ) )
+
+
+    def test_changes_drop_entries(self):
+        """Results are rendered again after a change, and the stale ones
+        aren't kept around."""
+        for port in range(1, 20):
+            self.store.updatePeer( 'f', '10.0.0.1', port, 0, port )
+            for key in range(port, port + 3):
+                version, result = self.render(key)
+                self.assertEqual( version, self.store.version('f') )
+                self.assertEqual( result, (key, port) )
+
+            self.assertEqual( len( self.store._rendered['f'] ), 3 )
+
+        self.assertIs( self.render(19)[1], self.render(19)[1] )
+
+
+class TestSplitJournals(unittest.TestCase):
+
+    TRACKERS = 12
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+
+    def journalName(self, workers):
+        """Spread the trackers over *workers* journals like prefork workers
+        would."""
+        def name(tracker):
+            if workers == 1:
+                return trackerstore.JOURNAL_NAME
+            return "{}.{}".format( trackerstore.JOURNAL_NAME,
+                                   int( tracker[4:] ) % workers )
+        return name
+
+
+    def store(self, journal_name):
+        return trackerstore.TrackerStore( trackerstore.TrackFileBackend(
+                                self.dir, journal_name=journal_name ), 3600 )
+
+
+    def announce(self, workers, port):
+        """Announce *port* to every tracker through the journals of
+        *workers* workers, without flushing."""
+        journal_name = self.journalName(workers)
+
+        for worker in range(workers):
+            store = self.store( journal_name("file{}".format(worker)) )
+            store.load()
+
+            for i in range(worker, self.TRACKERS, workers):
+                name = "file{}".format(i)
+                if store.get(name) is None:
+                    store.create( name, trackerfile.trackerfile( name, 1000,
+                                                        'x', 'a' * 32 ) )
+                store.updatePeer( name, '10.0.0.1', port, 0, port )
+
+            store.backend.close()
+
+
+    def test_worker_count_changes(self):
+        """No journaled announce is lost when the number of workers
+        changes, and every journal only keeps the trackers it owns."""
+        self.announce( 2, 1 )
+
+        self.assertEqual( trackerstore.splitJournals( self.dir,
+                                                      self.journalName(2) ), 0 )
+        self.assertGreater( trackerstore.splitJournals( self.dir,
+                                                        self.journalName(3) ), 0 )
+        self.announce( 3, 2 )
+
+        journal_name = self.journalName(3)
+        for worker in range(3):
+            journal = trackerstore.TrackerJournal( os.path.join( self.dir,
+                                        journal_name("file{}".format(worker)) ) )
+            names = { fields[1] for fields in journal.records() }
+            self.assertEqual( names, { "file{}".format(i) for i in
+                                       range(worker, self.TRACKERS, 3) } )
+
+        trackerstore.splitJournals( self.dir, self.journalName(1) )
+        self.assertEqual( sorted( os.listdir(self.dir) ),
+                          [ trackerstore.JOURNAL_NAME + ".old" ] )
+
+        store = self.store( trackerstore.JOURNAL_NAME )
+        self.assertEqual( store.load(), self.TRACKERS )
+        for i in range(self.TRACKERS):
+            self.assertEqual( len( store.get( "file{}".format(i) )._peers ),
+                              2 )
+
+
+class TestOverlapping(unittest.TestCase):
+
+    SIZE = 10000
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = trackerstore.TrackerStore(
+                trackerstore.TrackFileBackend( self.dir, journal=False ), 3600 )
+        self.store.create( 'f', trackerfile.trackerfile( 'f', self.SIZE, 'x',
+                                                         'a' * 32 ) )
+        self.random = random.Random(4)
+
+
+    def tearDown(self):
+        shutil.rmtree( self.dir )
+
+
+    def randomRanges(self):
+        bounds = sorted( self.random.sample( range(self.SIZE),
+                                             2 * self.random.randint(1, 3) ) )
+        return list( zip( bounds[0::2], bounds[1::2] ) )
+
+
+    def expected(self, start, end):
+        """How much each overlapping peer overlaps, found by scanning every
+        range."""
+        tf = self.store.get('f')
+        found = {}
+        for peer in tf._peers:
+            overlaps = [ min( e, end ) - max( s, start )
+                         for s, e in tf.peerRanges(*peer)
+                         if s <= end and e >= start ]
+            if overlaps:
+                found[peer] = max(overlaps)
+        return found
+
+
+    def test_index_follows_changes(self):
+        """The index stays in step with announces, removals and expiry."""
+        for step in range(600):
+            port = self.random.randrange(40)
+            action = self.random.random()
+
+            if action < 0.7:
+                ranges = self.randomRanges()
+                self.store.updatePeer( 'f', '10.0.0.1', port, *ranges[0],
+                                       ranges=ranges )
+            else:
+                self.store.removePeer( 'f', '10.0.0.1', port )
+
+            if step % 10 == 0:
+                start = self.random.randrange(self.SIZE)
+                end = self.random.randrange(start, self.SIZE)
+                total, peers = self.store.overlapping( 'f', start, end )
+
+                expected = self.expected(start, end)
+                self.assertEqual( total, len(expected) )
+                self.assertEqual( { peer: min( values[1], end )
+                                          - max( values[0], start )
+                                    for peer, values in peers }, expected )
+
+        total, peers = self.store.overlapping( 'f', 0, self.SIZE - 1, 5 )
+        self.assertEqual( total, len( self.store.get('f')._peers ) )
+        self.assertEqual( len(peers), 5 )
+
+        self.store.expire( datetime.datetime.utcnow()
+                           + datetime.timedelta( days=1 ) )
+        self.assertEqual( self.store.overlapping( 'f', 0, self.SIZE - 1 ),
+                          (0, []) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,29 @@
 # -*- coding: utf-8 -*-
 """Abstraction and handling of .track files.
 
+Peers are kept in a :class:`PeerTable`, which stores each peer-line as packed
+address bytes and ints, the way they are parsed from the file. The
+:class:`~ipaddress.IPv4Address` and :class:`~datetime.datetime` objects of the
+public API are only built when a caller reads them.
+
+A peer-line describes one range of bytes the peer has. A peer holding several
+disjoint ranges may list all of them in an optional sixth field,
+``ip:port:start:end:timestamp:start-end,start-end,...``, with *start* and
+*end* its largest range. The ranges are kept as a flat :class:`array.array`
+in the peer's :class:`PeerRecord`.
+
+Besides the text format, trackers can be stored in a versioned binary format:
+a fixed header (see :data:`_binary_header`), the filename, fixed-width peer
+records in the :data:`apiutils.compact_peer` layout, the description, then
+(since version 2) a count and :data:`apiutils.compact_range` records listing
+the ranges of peers which have several.
+:meth:`trackerfile.fromPath` tells the formats apart by
+:const:`BINARY_MAGIC` and reads binary files through :mod:`mmap`. Files are
+converted either way with :func:`convertPath`, or from the command line::
+    
+    ./trackerfile.py binary torrents/*.track
+    ./trackerfile.py text torrents/*.track
+
 Attributes:
     PEER_UPDATE_INTERVAL (int): Peers will be forgotten after this many
         seconds. 
@@ -10,13 +33,29 @@ Attributes:
     
     _DEFAULT_ENCODING (str): global 'constant', default encoding for .track
         file contents.
+    
+    BINARY_MAGIC (bytes): first bytes of a binary .track file.
+    BINARY_VERSION (int): version of the binary format written.
+    
+    _binary_header (:class:`struct.Struct`): header of a binary .track file:
+        magic, version, filesize, md5, peer count, filename length,
+        description offset, and description length.
 """
 
 __license__ = "MIT"
 __docformat__ = 'reStructuredText'
 
 import re
+import io
+import os
+import sys
+import mmap
+import socket
+import struct
+import argparse
 import datetime
+import array
+import collections.abc
 from ipaddress import IPv4Address
 import apiutils
 
@@ -25,11 +64,375 @@ PEER_UPDATE_INTERVAL = 15 * 60 #15 minutes by default
 _re_md5 = re.compile('^[0-9a-f]{32}$', re.A|re.I)
 _DEFAULT_ENCODING = "utf-8"
 
+BINARY_MAGIC = b"MSTRACK\x00"
+BINARY_VERSION = 2
+_binary_count = struct.Struct("!I")
+_binary_header = struct.Struct("!8sHQ32sIHII")
+
 
 class MalformedTrackerFileException(Exception):
     """Raised when parsing a tracker file if the format is malformed."""
     pass
 
+def mergeRanges(ranges):
+    """Sort (*start_byte*, *end_byte*) pairs and merge those which overlap
+    or touch.
+    
+    Returns:
+        list: the merged ranges.
+    """
+    merged = []
+    
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append( (start, end) )
+    
+    return merged
+
+def _packAddress(ip):
+    """Packed bytes of an IPv4 address given as :class:`~ipaddress.IPv4Address`,
+    dotted string, packed bytes, or int.
+    
+    Raises:
+        AddressValueError: if *ip* isn't a valid IPv4 address
+    """
+    
+    if isinstance(ip, bytes) and len(ip) == 4:
+        return ip
+    
+    #fast path for canonical dotted strings, anything else is left to
+    # IPv4Address's stricter parser
+    if isinstance(ip, str):
+        try:
+            packed = socket.inet_aton(ip)
+            if socket.inet_ntoa(packed) == ip:
+                return packed
+        except OSError:
+            pass
+    
+    if not isinstance(ip, IPv4Address):
+        ip = IPv4Address(ip)
+    
+    return ip.packed
+
+
+class PeerRecord(object):
+    """The values of one peer-line.
+    
+    Records are never modified once in a :class:`PeerTable`; updating a peer
+    replaces its record.
+    
+    Args:
+        start_byte (int): The first byte of the peer's main range
+        end_byte (int): The last byte of the peer's main range
+        stamp (int): When the peer was last seen, as written in .track files
+        timestamp (:class:`~datetime.datetime`, optional): *stamp* as a
+            datetime, if already known.
+        ranges (list, optional): every (*start_byte*, *end_byte*) range the
+            peer has, if more than the main one. Merged with
+            :func:`mergeRanges`.
+    
+    Attributes:
+        ranges (:class:`array.array` or None): the merged ranges, flattened
+            into start and end bytes, or None if the peer only has its main
+            range.
+    """
+    
+    __slots__ = ('start_byte', 'end_byte', 'stamp', '_timestamp', 'ranges')
+    
+    def __init__(self, start_byte, end_byte, stamp, timestamp=None,
+                       ranges=None):
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.stamp = stamp
+        self._timestamp = timestamp
+        self.ranges = None
+        
+        if ranges:
+            merged = mergeRanges( list(ranges) + [(start_byte, end_byte)] )
+            
+            if len(merged) > 1:
+                self.ranges = array.array( 'Q',
+                                    [ b for pair in merged for b in pair ] )
+    
+    
+    @property
+    def timestamp(self):
+        """:class:`~datetime.datetime`: *stamp*, converted on first use."""
+        if self._timestamp is None:
+            self._timestamp = datetime.datetime.utcfromtimestamp( self.stamp )
+        
+        return self._timestamp
+    
+    
+    def key(self):
+        """The values compared when looking for duplicate peer-lines."""
+        return (self.start_byte, self.end_byte, self.stamp,
+                self.ranges and tuple(self.ranges))
+    
+    
+    def spans(self):
+        """Every (*start_byte*, *end_byte*) range the peer has, in order."""
+        if self.ranges is None:
+            return [ (self.start_byte, self.end_byte) ]
+        
+        return list( zip( self.ranges[0::2], self.ranges[1::2] ) )
+    
+    
+    def values(self):
+        """(*start_byte*, *end_byte*, *timestamp*), as found in
+        :attr:`trackerfile._peers`."""
+        return (self.start_byte, self.end_byte, self.timestamp)
+
+
+class _PeerItems(collections.abc.ItemsView):
+    """Items of a :class:`PeerTable`, iterated without key lookups."""
+    
+    def __iter__(self):
+        for (ip, port), record in self._mapping._records.items():
+            yield (IPv4Address(ip), port), record.values()
+
+
+class PeerTable(collections.abc.MutableMapping):
+    """The peers of a :class:`trackerfile`.
+    
+    Behaves as a dict mapping (:class:`~ipaddress.IPv4Address` *peer_ip*,
+    :obj:`int` *peer_port*) to (:obj:`int` *start_byte*, :obj:`int`
+    *end_byte*, :class:`~datetime.datetime` *timestamp*), but stores
+    (packed *peer_ip*, *peer_port*) keys and :class:`PeerRecord` values, and
+    builds the address and datetime objects only when they are read. Peer ips
+    may be given as anything :class:`~ipaddress.IPv4Address` accepts, and
+    timestamps as datetimes or as ints in the .track file format. Values may
+    have a fourth item, the peer's ranges as for :meth:`put`.
+    
+    Code that doesn't need the objects can use :meth:`records` instead.
+    """
+    
+    __slots__ = ('_records',)
+    
+    def __init__(self, peers=()):
+        self._records = {}
+        self.update( peers )
+    
+    
+    @staticmethod
+    def recordKey(peer):
+        """The (packed *peer_ip*, :obj:`int` *peer_port*) key of *peer*."""
+        ip, port = peer
+        return _packAddress(ip), int(port)
+    
+    
+    def _lookup(self, peer):
+        try:
+            return self.recordKey( peer )
+        except (ValueError, TypeError):
+            raise KeyError(peer)
+    
+    
+    def __getitem__(self, peer):
+        return self._records[ self._lookup(peer) ].values()
+    
+    
+    def __setitem__(self, peer, values):
+        self.put( peer, *values )
+    
+    
+    def __delitem__(self, peer):
+        del self._records[ self._lookup(peer) ]
+    
+    
+    def __contains__(self, peer):
+        try:
+            return self.recordKey( peer ) in self._records
+        except (ValueError, TypeError):
+            return False
+    
+    
+    def __iter__(self):
+        for ip, port in self._records:
+            yield IPv4Address(ip), port
+    
+    
+    def __len__(self):
+        return len(self._records)
+    
+    
+    def __eq__(self, other):
+        if isinstance(other, PeerTable):
+            return ( self._records.keys() == other._records.keys() and
+                     all( record.key() == other._records[peer].key()
+                          for peer, record in self._records.items() ) )
+        
+        return super(PeerTable, self).__eq__(other)
+    
+    
+    def __repr__(self):
+        return "{}({!r})".format( type(self).__name__, dict(self.items()) )
+    
+    
+    def items(self):
+        return _PeerItems(self)
+    
+    
+    def update(self, other=(), **kwargs):
+        """Like :meth:`dict.update`; records of another :class:`PeerTable`
+        are copied as they are."""
+        if isinstance(other, PeerTable):
+            self._records.update( other._records )
+        else:
+            super(PeerTable, self).update( other, **kwargs )
+    
+    
+    def copy(self):
+        return type(self)( self )
+    
+    
+    def put(self, peer, start_byte, end_byte, timestamp, ranges=None):
+        """Set the values of *peer*.
+        
+        Args:
+            peer (tuple): (*peer_ip*, *peer_port*)
+            start_byte (int): The first byte of the peer's main range
+            end_byte (int): The last byte of the peer's main range
+            timestamp (:class:`~datetime.datetime` or int): When the peer was
+                last seen
+            ranges (list, optional): every (*start_byte*, *end_byte*) range
+                the peer has, see :class:`PeerRecord`.
+        """
+        if isinstance(timestamp, datetime.datetime):
+            record = PeerRecord( int(start_byte), int(end_byte),
+                                 int(timestamp.timestamp()), timestamp,
+                                 ranges )
+        else:
+            record = PeerRecord( int(start_byte), int(end_byte),
+                                 int(timestamp), None, ranges )
+        
+        self._records[ self.recordKey(peer) ] = record
+    
+    
+    def ranges(self, peer):
+        """Every (*start_byte*, *end_byte*) range *peer* has, in order.
+        
+        Raises:
+            KeyError: if there is no such peer.
+        """
+        return self._records[ self._lookup(peer) ].spans()
+    
+    
+    def record(self, peer):
+        """The :class:`PeerRecord` of *peer*, or None if it isn't in the
+        table."""
+        try:
+            return self._records.get( self._lookup(peer) )
+        except KeyError:
+            return None
+    
+    
+    def extraRanges(self, peer):
+        """Like :meth:`ranges`, but None if *peer* only has its main range,
+        or isn't in the table."""
+        try:
+            record = self._records[ self._lookup(peer) ]
+        except KeyError:
+            return None
+        
+        return record.spans() if record.ranges is not None else None
+    
+    
+    def addRecords(self, records):
+        """Add ((packed *peer_ip*, *peer_port*), :class:`PeerRecord`) pairs,
+        as iterated by :meth:`records`."""
+        self._records.update( records )
+    
+    
+    def records(self):
+        """Iterate over ((packed *peer_ip*, *peer_port*), :class:`PeerRecord`)
+        pairs."""
+        return iter( self._records.items() )
+    
+    
+    def pack(self):
+        """All peers as :data:`apiutils.compact_peer` records.
+        
+        Returns:
+            bytes: the packed records.
+        """
+        pack = apiutils.compact_peer.pack
+        
+        return b"".join( pack( ip, port, record.start_byte, record.end_byte,
+                               record.stamp )
+                         for (ip, port), record in self._records.items() )
+    
+    
+    def unpack(self, records):
+        """Add the peers of buffer *records*, packed as by :meth:`pack`."""
+        for ip, port, startb, endb, stamp in \
+                apiutils.compact_peer.iter_unpack( records ):
+            self._records[ (ip, port) ] = PeerRecord( startb, endb, stamp )
+    
+    
+    def packRanges(self, peers=None):
+        """The ranges of every peer which has several, as
+        :data:`apiutils.compact_range` records.
+        
+        Args:
+            peers (iterable, optional): only pack the ranges of these
+                (*peer_ip*, *peer_port*) peers. Defaults to every peer.
+        
+        Returns:
+            tuple: (number of records, bytes of the packed records)
+        """
+        if peers is None:
+            items = self._records.items()
+        else:
+            keys = ( self.recordKey(peer) for peer in peers )
+            items = ( (key, self._records[key]) for key in keys
+                      if key in self._records )
+        
+        pack = apiutils.compact_range.pack
+        packed = [ pack( ip, port, start, end )
+                   for (ip, port), record in items if record.ranges is not None
+                   for start, end in record.spans() ]
+        
+        return len(packed), b"".join( packed )
+    
+    
+    def unpackRanges(self, records):
+        """Set the ranges of peers from buffer *records*, packed as by
+        :meth:`packRanges`. Ranges of peers not in the table are ignored."""
+        ranges = {}
+        
+        for ip, port, start, end in apiutils.compact_range.iter_unpack(records):
+            ranges.setdefault( (ip, port), [] ).append( (start, end) )
+        
+        for key, spans in ranges.items():
+            record = self._records.get(key)
+            if record is not None:
+                self._records[key] = PeerRecord( record.start_byte,
+                                                 record.end_byte, record.stamp,
+                                                 record._timestamp, spans )
+    
+    
+    def setRecord(self, key, record):
+        """Store :class:`PeerRecord` *record* under (packed *peer_ip*,
+        *peer_port*) *key*.
+        
+        Raises:
+            MalformedTrackerFileException: if *key* already has a different
+                record.
+        """
+        old = self._records.get(key)
+        
+        if old is not None and old.key() != record.key():
+            raise MalformedTrackerFileException("Duplicate peer entry for " \
+                "peer {}:{}".format( socket.inet_ntoa(key[0]), key[1] ) )
+        
+        self._records[key] = record
+
+
 class trackerfile(tuple):
     """Abstracts .track file.
     
@@ -44,7 +447,7 @@ class trackerfile(tuple):
         TypeError: if the value of an argument is drastically wrong
     
     Attributes:
-        _peers (dict): Dictionary of peers in the tracker file.
+        _peers (:class:`PeerTable`): Dictionary of peers in the tracker file.
             
             key: (:class:`ipaddress.IPv4Address` *peer_ip*, 
             :obj:`int` *peer_port*)
@@ -79,7 +482,7 @@ class trackerfile(tuple):
                 int(filesize),
                 str(description),
                 str(md5),
-                {})
+                PeerTable())
         return super(trackerfile, cls).__new__(cls, out)
     
     
@@ -108,6 +511,10 @@ class trackerfile(tuple):
     def fromPath(cls, filepath):
         """Create a new :class:`.trackerfile` instance from a .track file.
         
+        Binary files are mapped into memory and read by
+        :meth:`~.trackerfile.fromBuffer`, text files by
+        :meth:`~.trackerfile.fromFileObject`.
+        
         Args:
             filepath (str): Path to the .track file.
         
@@ -118,18 +525,99 @@ class trackerfile(tuple):
             TypeError: if *filepath* is an incompatible type
             OSError: if there is a problem reading from *filepath*
             All exceptions raisable by :meth:`~.trackerfile.fromFileObject`
+                and :meth:`~.trackerfile.fromBuffer`
         """
         
-        with open(filepath, 'r', encoding=_DEFAULT_ENCODING) as fl:
-            return cls.fromFileObject( fl )
+        with open(filepath, 'rb') as fl:
+            if fl.read( len(BINARY_MAGIC) ) == BINARY_MAGIC:
+                with mmap.mmap( fl.fileno(), 0, access=mmap.ACCESS_READ ) as buf:
+                    return cls.fromBuffer( buf )
+            
+            fl.seek(0)
+            return cls.fromFileObject( io.TextIOWrapper( fl,
+                                                encoding=_DEFAULT_ENCODING ) )
+    
+    
+    @classmethod
+    def fromBuffer(cls, buf):
+        """Create a new :class:`.trackerfile` instance from a binary .track
+        file.
+        
+        Peer records are unpacked straight from *buf*, without copying it.
+        
+        Args:
+            buf (bytes-like object): The binary .track file, e.g. a
+                :class:`mmap.mmap`.
+        
+        Returns:
+            :class:`.trackerfile`: a new instance
+        
+        Raises:
+            MalformedTrackerFileException: if *buf* isn't a binary .track file
+                or is truncated
+            ValueError: if the metadata in *buf* isn't acceptable
+        """
+        
+        if len(buf) < _binary_header.size:
+            raise MalformedTrackerFileException("Truncated binary header.")
+        
+        ( magic, version, filesize, md5, count, name_length,
+          descrip_offset, descrip_length ) = _binary_header.unpack_from( buf )
+        
+        if magic != BINARY_MAGIC:
+            raise MalformedTrackerFileException("Not a binary .track file.")
+        
+        if version not in (1, BINARY_VERSION):
+            raise MalformedTrackerFileException("Unsupported binary .track " \
+                    "version {}.".format(version) )
+        
+        peers_offset = _binary_header.size + name_length
+        peers_end = peers_offset + count * apiutils.compact_peer.size
+        
+        #version 2 lists multi-range peers after the description
+        ranges_offset = ranges_end = descrip_offset + descrip_length
+        if version >= 2:
+            ranges_offset += _binary_count.size
+            
+            if ranges_offset <= len(buf):
+                ranges_end = ranges_offset + apiutils.compact_range.size * \
+                    _binary_count.unpack_from( buf, ranges_end )[0]
+        
+        if max( peers_end, ranges_end, ranges_offset ) > len(buf):
+            raise MalformedTrackerFileException("Truncated binary .track file.")
+        
+        try:
+            new_tracker = cls( str( buf[_binary_header.size:peers_offset],
+                                    _DEFAULT_ENCODING ),
+                               filesize,
+                               str( buf[descrip_offset:
+                                        descrip_offset+descrip_length],
+                                    _DEFAULT_ENCODING ),
+                               md5.decode('ascii') )
+        except UnicodeDecodeError as err:
+            raise MalformedTrackerFileException("Bad metadata: {}".format(err))
+        
+        #the view has to be released before an mmap can be closed
+        with memoryview(buf) as view, \
+             view[peers_offset:peers_end] as records, \
+             view[ranges_offset:ranges_end] as ranges:
+            new_tracker._peers.unpack( records )
+            new_tracker._peers.unpackRanges( ranges )
+        
+        return new_tracker
     
     
     @classmethod
     def fromFileObject(cls, fileobj, ignorelines=""):
         """Create a new :class:`.trackerfile` instance from a .track file.
         
+        Peer-lines are parsed straight into :class:`PeerRecord` objects; any
+        line the fast path can't handle goes through
+        :meth:`~.trackerfile.parseLine`.
+        
         Args:
-            fileobj (file-like object): Stream containing a .track file.
+            fileobj (file-like object): Stream containing a .track file, or
+                an iterable of its lines.
             ignorelines (:obj:`str` or :obj:`None`): should contain characters 
                 that, if a line starts with them, will cause the line to be
                 ignored.
@@ -146,9 +634,35 @@ class trackerfile(tuple):
         """
         
         metadata = {}
-        peers = {}
+        peers = PeerTable()
+        records = peers._records
+        inet_aton, inet_ntoa = socket.inet_aton, socket.inet_ntoa
+        
+        #split the whole buffer at once rather than reading line by line
+        if hasattr(fileobj, 'read'):
+            fileobj = fileobj.read().splitlines()
         
         for line in fileobj:
+            
+            #fast path for well-formed, first-seen peer-lines; anything else
+            # goes through parseLine for validation and error reporting
+            if line[:1].isdigit() and line[0] not in ignorelines:
+                parts = line.split(':')
+                
+                if len(parts) == 5:
+                    try:
+                        packed = inet_aton( parts[0] )
+                        key = packed, int(parts[1])
+                        record = PeerRecord( int(parts[2]), int(parts[3]),
+                                             int(parts[4]) )
+                    except (OSError, ValueError):
+                        packed = None
+                    
+                    if ( packed is not None and key not in records and
+                            inet_ntoa(packed) == parts[0] ):
+                        records[key] = record
+                        continue
+            
             parsedline = cls.parseLine(line, ignorelines)
             
             #pass line
@@ -166,20 +680,21 @@ class trackerfile(tuple):
                 metadata[attr] = val
             
             #peer line
-            elif len(parsedline) == 5:
-                peer, values = parsedline[0:2], parsedline[2:]
+            elif len(parsedline) in (5, 6):
+                peer = parsedline[0:2]
+                startb, endb, timestamp = parsedline[2:5]
+                ranges = parsedline[5] if len(parsedline) == 6 else None
                 
-                if peer in peers and peers[peer] != values:
-                    raise MalformedTrackerFileException("Duplicate peer entry" \
-                        " for peer {0[0]}:{0[1]}".format(peer) )
-                
-                peers[peer] = values
+                peers.setRecord( PeerTable.recordKey(peer),
+                                 PeerRecord( startb, endb,
+                                             int(timestamp.timestamp()),
+                                             timestamp, ranges ) )
             
             #unexpected state
             else:
                 raise RuntimeError("Reached unexpected state. {}.parseLine()" \
-                    " returned a {!r}, expected a 2-tuple, 5-tuple, or None" \
-                    ".".format(cls.__name__, parsedline) )
+                    " returned a {!r}, expected a 2-tuple, 5-tuple, 6-tuple," \
+                    " or None.".format(cls.__name__, parsedline) )
             
         for f in cls._fields:
             if f not in metadata:
@@ -209,8 +724,8 @@ class trackerfile(tuple):
                 if a line starts with them, will cause the line to be ignored.
         
         Returns:
-            tuple or None: a 2-tuple (for a metadata line), a 5-tuple
-            (for a peer line), or None (for a pass line).
+            tuple or None: a 2-tuple (for a metadata line), a 5-tuple or
+            6-tuple (for a peer line), or None (for a pass line).
         
         Raises:
             AttributeError: if *line* isn't a string
@@ -286,7 +801,9 @@ class trackerfile(tuple):
             :class:`int` *peer_port*,
             :class:`int` *start_byte*,
             :class:`int` *end_byte*,
-            :class:`~datetime.datetime` *last_timestamp* )
+            :class:`~datetime.datetime` *last_timestamp* ), followed by the
+            :obj:`list` of the peer's (*start_byte*, *end_byte*) *ranges* if
+            the line lists them.
         
         Raises:
             MalformedTrackerFileException: if the *line* is malformed
@@ -294,11 +811,11 @@ class trackerfile(tuple):
             AddressValueError: if the peer ip isn't a valid IPv4 address
             ValueError: if any of the components that should be ints aren't
         """
-        parts = line.split(':',4)
+        parts = line.split(':',5)
         
-        if len(parts) != 5:
+        if len(parts) not in (5, 6):
             raise MalformedTrackerFileException("Wrong number of peer line " \
-                    "components. Expected 5, got {}".format( len(parts) ) )
+                    "components. Expected 5 or 6, got {}".format( len(parts) ))
         
         parts[0] = IPv4Address( parts[0].strip() )
         
@@ -308,6 +825,9 @@ class trackerfile(tuple):
         
         parts[4] = datetime.datetime.utcfromtimestamp( parts[4] )
         
+        if len(parts) == 6:
+            parts[5] = apiutils.ranges_decode( parts[5].strip() )
+        
         return tuple( parts )
     
     
@@ -327,15 +847,18 @@ class trackerfile(tuple):
         
         #threshold for dropping peers
         thresh = datetime.datetime.utcnow() - \
-                 datetime.timedelta(update_interval)
+                 datetime.timedelta(seconds=update_interval)
         
-        for peer, values in self._peers.items():
+        for peer, values in list(self._peers.items()):
             if values[2] < thresh:
                 changed = True
                 self.removePeer( *peer )
+        
+        return changed
     
     
-    def updatePeer(self, peer_ip, peer_port, start_byte, end_byte):
+    def updatePeer(self, peer_ip, peer_port, start_byte, end_byte,
+                         timestamp=None, ranges=None):
         """Update or add peer-line for (*peer_ip*, *peer_port*) pair.
         
         Args:
@@ -343,22 +866,44 @@ class trackerfile(tuple):
             peer_port (int): The peer's port
             start_byte (int): The first byte the peer has
             end_byte (int): The last byte the peer has
+            timestamp (:class:`~datetime.datetime`, optional): When the peer
+                was last seen. Defaults to now.
+            ranges (list, optional): every (*start_byte*, *end_byte*) range
+                the peer has, if it has more than one.
         
         Raises:
             AddressValueError: if *peer_ip* isn't a valid IPv4 address
             ValueError,TypeError: if *peer_port*, *start_byte*, or
-                *end_byte* aren't ints, or *start_byte* and *end_byte* form an
-                invalid range
+                *end_byte* aren't ints, or *start_byte* and *end_byte* (or
+                any of *ranges*) form an invalid range
         """
         
         peer = IPv4Address(peer_ip),int(peer_port)
         startb,endb = int(start_byte),int(end_byte)
         
-        if not (0 <= startb and startb <= endb and endb < self.filesize):
-            raise ValueError("startb {} and endb {} is an invalid range for " \
-                    "file of size {}".format(startb,endb,self.filesize) )
+        if ranges:
+            ranges = [ (int(s), int(e)) for s, e in ranges ]
         
-        self._peers[ peer ] = (startb, endb, datetime.datetime.utcnow())
+        for s, e in [(startb, endb)] + (ranges or []):
+            if not (0 <= s and s <= e and e < self.filesize):
+                raise ValueError("startb {} and endb {} is an invalid range " \
+                        "for file of size {}".format(s,e,self.filesize) )
+        
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow()
+        
+        self._peers.put( peer, startb, endb, timestamp, ranges )
+    
+    
+    def peerRanges(self, peer_ip, peer_port):
+        """Every (*start_byte*, *end_byte*) range (*peer_ip*, *peer_port*)
+        has, in order.
+        
+        Raises:
+            KeyError: if there is no such peer.
+        """
+        
+        return self._peers.ranges( (peer_ip, peer_port) )
     
     
     def removePeer(self, peer_ip, peer_port):
@@ -393,13 +938,20 @@ class trackerfile(tuple):
             yield "{}: {}".format( self._metadata_fields[i], self[i] )
     
     
-    def _peerGenerator(self):
-        """Line generator for peers"""
-        
-        for peer,values in self._peers.items():
-            #       IP     port   sbyte  ebyte
-            yield "{0[0]}:{0[1]}:{1[0]}:{1[1]}:{2}".format( peer,values,
-                                                int(values[2].timestamp()) )
+    def _peerGenerator(self, ranges=True):
+        """Line generator for peers, listing the ranges of peers which have
+        several unless *ranges* is False."""
+        
+        for (ip, port), record in self._peers.records():
+            #       IP  port sbyte ebyte timestamp
+            line = "{}:{}:{}:{}:{}".format( socket.inet_ntoa(ip), port,
+                                            record.start_byte, record.end_byte,
+                                            record.stamp )
+            
+            if ranges and record.ranges is not None:
+                line += ":" + apiutils.ranges_encode( record.spans() )
+            
+            yield line
     
     
     def toString(self):
@@ -413,10 +965,38 @@ class trackerfile(tuple):
         return output
     
     
+    def _serialize(self, ranges=True):
+        """The whole .track file, every line newline-terminated, built in one
+        pass."""
+        
+        lines = list( self._metadataGenerator() )
+        lines.extend( self._peerGenerator(ranges) )
+        lines.append( "" )
+        
+        return "\n".join( lines )
+    
+    
+    def toBytes(self, ranges=True):
+        """Output as .track file format, encoded.
+        
+        Unlike :meth:`toString`, every line ends in a newline.
+        
+        Args:
+            ranges (bool, optional): whether to list the ranges of peers
+                which have several, for readers which don't expect them.
+                Defaults to True.
+        
+        Returns:
+            bytes: The tracker file in the .track file format.
+        """
+        return bytes( self._serialize(ranges), *apiutils.encoding_defaults )
+    
+    
     def writeTo(self, fileobj):
         """Writes the tracker file to *fileobj* in the .track file format.
         
-        Does not close *fileobj*. Only requires ``fileobj.write()`` method.
+        Does not close *fileobj*. Only requires ``fileobj.write()`` method,
+        which is called once.
         
         Args:
             fileobj (file-like object): The file to be written to
@@ -425,32 +1005,100 @@ class trackerfile(tuple):
             OSError,ValueError,AttributeError: If *fileobj* isn't writable
         """
         
-        #write metadata
-        for line in self._metadataGenerator():
-            fileobj.write( line + "\n" )
+        fileobj.write( self._serialize() )
+    
+    
+    def toBinary(self):
+        """Output as binary .track file format.
         
-        #write peers
-        for line in self._peerGenerator():
-            fileobj.write( line + "\n" )
+        Returns:
+            bytes: The tracker file in the binary .track file format.
+        """
+        name = self.filename.encode(_DEFAULT_ENCODING)
+        descrip = self.description.encode(_DEFAULT_ENCODING)
+        peers = self._peers.pack()
+        count, ranges = self._peers.packRanges()
+        
+        header = _binary_header.pack( BINARY_MAGIC, BINARY_VERSION,
+                                      self.filesize, self.md5.encode('ascii'),
+                                      len(self._peers), len(name),
+                                      _binary_header.size + len(name) +
+                                      len(peers),
+                                      len(descrip) )
+        
+        return b"".join( (header, name, peers, descrip,
+                          _binary_count.pack(count), ranges) )
+    
     
     def writeToSocket(self, sock):
         """Writes the tracker file to *sock* in the .track file format.
         
-        Does not close *sock*. 
+        Does not close *sock*. The whole file is sent with a single
+        ``sendall``.
         
         Args:
             sock (:class:`~socket.socket`): The socket to be written to.
         """
         
-        #write metadata
-        for line in self._metadataGenerator():
-            sock.sendall( bytes(line + "\n", *apiutils.encoding_defaults) )
-        
-        #write peers
-        for line in self._peerGenerator():
-            sock.sendall( bytes(line + "\n", *apiutils.encoding_defaults) )
+        sock.sendall( self.toBytes() )
+
+
+def isBinary(filepath):
+    """Whether *filepath* is a binary .track file."""
+    
+    with open(filepath, 'rb') as fl:
+        return fl.read( len(BINARY_MAGIC) ) == BINARY_MAGIC
+
+
+def convertPath(filepath, binary=True):
+    """Rewrite the .track file at *filepath* in the binary or text format.
+    
+    The new file is written next to *filepath* and renamed over it.
+    
+    Args:
+        filepath (str): Path to the .track file.
+        binary (bool, optional): whether to write the binary format rather
+            than text. Defaults to True.
+    
+    Returns:
+        bool: True if the file was converted, False if it already was in the
+        requested format.
+    """
+    
+    if isBinary(filepath) == binary:
+        return False
     
+    tf = trackerfile.fromPath( filepath )
     
+    if binary:
+        with open(filepath + '.tmp', 'wb') as fl:
+            fl.write( tf.toBinary() )
+    else:
+        with open(filepath + '.tmp', 'w', encoding=_DEFAULT_ENCODING) as fl:
+            tf.writeTo( fl )
     
+    os.replace( filepath + '.tmp', filepath )
     
+    return True
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(
+                    description="Convert .track files between formats" )
+    parser.add_argument( "format", choices=("binary", "text"),
+                         help="format to convert the files to" )
+    parser.add_argument( "paths", nargs="+", metavar="path",
+                         help="path of a .track file" )
+    args = parser.parse_args()
+    
+    count = 0
+    
+    for path in args.paths:
+        try:
+            count += convertPath( path, args.format == "binary" )
+        except Exception as err:
+            print("Skipping {!r}: {}".format(path, err))
     
+    print("Converted {} file(s) to {}".format( count, args.format ))
+    sys.exit(0)
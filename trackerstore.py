@@ -0,0 +1,1438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Resident index of trackers for the tracker server.
+
+A :class:`TrackerStore` reads every persisted tracker once, keeps the
+resulting :class:`~trackerfile.trackerfile` instances in memory, and writes
+modified trackers back from a background thread. Request handlers only ever
+touch the in-memory trackers. Persistence is left to a backend: by default a
+:class:`TrackFileBackend`, which keeps one .track file per tracker, or
+:class:`sqlitestore.SQLiteBackend`.
+
+Between two flushes, every mutation is also appended to a
+:class:`TrackerJournal` by the .track backend, so the cost of an announce is
+one short line of I/O and nothing is lost if the server dies before the next
+flush. Flushing compacts the journal back into the .track files.
+
+Reading and modifying a tracker happens under that tracker's lock from a
+:class:`LockStripes` pool, so announces for different torrents proceed in
+parallel while announces for the same torrent are serialized.
+
+Peers which stop announcing are forgotten by the background thread rather
+than by sweeping a tracker's peers on every request: the store keeps a heap of
+peer expiry times, and only pops the entries which are due.
+
+Attributes:
+    FLUSH_INTERVAL (int): default number of seconds between two flushes of
+        dirty trackers to disk.
+    LOCK_STRIPES (int): default number of locks shared by the trackers.
+    DELTA_HISTORY (int): number of peer changes remembered per tracker, see
+        :meth:`TrackerStore.changes`.
+    TRACK_EXTENSION (str): file extension of tracker files.
+    JOURNAL_NAME (str): name of the journal file in the torrents directory.
+    PEER_STRATEGIES (tuple): names of the strategies :func:`selectPeers`
+        accepts.
+"""
+
+__license__ = "MIT"
+__docformat__ = 'reStructuredText'
+
+import re
+import os
+import random
+import os.path
+import heapq
+import bisect
+import threading
+import collections
+import datetime
+from ipaddress import IPv4Address
+
+import trackerfile
+import apiutils
+
+
+FLUSH_INTERVAL = 5
+LOCK_STRIPES = 64
+DELTA_HISTORY = 256
+SEARCH_CACHE_SIZE = 64
+TRACK_EXTENSION = '.track'
+JOURNAL_NAME = '.tracker-journal'
+PEER_STRATEGIES = ('freshest', 'random', 'spread')
+_ENCODING = trackerfile._DEFAULT_ENCODING
+_re_token = re.compile('[0-9a-z]+')
+
+
+def trackName(track_fname):
+    """Convert a .track file name into the name of the tracked file.
+    
+    Args:
+        track_fname (str): name of a .track file, e.g. ``"foo.txt.track"``.
+    
+    Returns:
+        str or None: the tracked file name (``"foo.txt"``), or None if
+        *track_fname* doesn't end in :const:`TRACK_EXTENSION`.
+    """
+    if not track_fname.endswith(TRACK_EXTENSION):
+        return None
+    
+    return track_fname[:-len(TRACK_EXTENSION)]
+
+
+def tokenize(text):
+    """Split *text* into the set of lowercase alphanumeric tokens used by
+    :class:`CatalogIndex`."""
+    return set( _re_token.findall( text.lower() ) )
+
+
+def selectPeers(tf, limit, strategy='freshest'):
+    """Pick at most *limit* of the peers of tracker *tf*.
+    
+    Strategies are:
+    
+    * ``freshest``: the most recently seen peers.
+    * ``random``: a uniform random sample.
+    * ``spread``: peers evenly spaced in the order of their start bytes, so
+      every part of the file is covered by some of them.
+    
+    Returns:
+        :class:`~trackerfile.trackerfile`: *tf* itself if it has at most
+        *limit* peers, otherwise a copy holding only the selected peers.
+    
+    Raises:
+        ValueError: if *strategy* isn't one of :const:`PEER_STRATEGIES`.
+    """
+    if strategy not in PEER_STRATEGIES:
+        raise ValueError("Unknown peer strategy {!r}".format(strategy))
+    
+    if len(tf._peers) <= limit:
+        return tf
+    
+    #work on the raw records so that the peers' ranges are kept
+    peers = list( tf._peers.records() )
+    
+    if strategy == 'freshest':
+        peers = heapq.nlargest( limit, peers, key=lambda peer: peer[1].stamp )
+    
+    elif strategy == 'random':
+        peers = random.sample( peers, limit )
+    
+    else:
+        peers.sort( key=lambda peer: peer[1].start_byte )
+        peers = [ peers[i * len(peers) // limit] for i in range(limit) ]
+    
+    copy = trackerfile.trackerfile( tf.filename, tf.filesize,
+                                    tf.description, tf.md5 )
+    copy._peers.addRecords( peers )
+    
+    return copy
+
+
+class CatalogIndex:
+    """Inverted index from filename and description tokens to trackers.
+    
+    Search terms are lowercased and ANDed together. A plain term must equal a
+    token of the tracker's filename or description. A term starting with
+    ``~`` is a substring filter: the rest of the term must appear somewhere in
+    the filename or description.
+    
+    Substring filters made only of token characters are answered from the
+    token vocabulary, which is much smaller than the catalog; anything else
+    falls back to scanning the indexed text.
+    """
+    
+    def __init__(self):
+        self._postings = {}
+        self._texts = {}
+    
+    
+    def __contains__(self, name):
+        return name in self._texts
+    
+    
+    def add(self, name, tf):
+        """Index the metadata of tracker *tf* under *name*."""
+        text = "{} {}".format( tf.filename, tf.description ).lower()
+        self._texts[name] = text
+        
+        for token in tokenize(text):
+            self._postings.setdefault( token, set() ).add( name )
+    
+    
+    def search(self, terms):
+        """Names of the trackers matching every one of *terms*.
+        
+        Args:
+            terms (iterable of str): search terms, see :class:`CatalogIndex`.
+        
+        Returns:
+            set: matching names. Every name if *terms* is empty.
+        """
+        result = None
+        
+        for term in terms:
+            term = term.lower()
+            
+            if term.startswith('~'):
+                matches = self._substring( term[1:] )
+            else:
+                matches = self._postings.get( term, set() )
+            
+            result = set(matches) if result is None else result & matches
+            
+            if not result:
+                break
+        
+        if result is None:
+            return set(self._texts)
+        
+        return result
+    
+    
+    def _substring(self, sub):
+        """Names whose indexed text contains *sub*."""
+        
+        #an alphanumeric substring can only occur inside a single token
+        if _re_token.fullmatch(sub):
+            matches = set()
+            for token, names in self._postings.items():
+                if sub in token:
+                    matches |= names
+            return matches
+        
+        return { name for name, text in self._texts.items() if sub in text }
+
+
+class RangeIndex:
+    """Index of the byte ranges held by the peers of a tracker, kept up to
+    date as peers change.
+    
+    Every range of every peer is kept in two sorted lists, one ordered by
+    start byte and one by end byte, which are updated with binary searches.
+    The ranges overlapping a query start no later than its end and end no
+    earlier than its start: whichever list has fewer ranges satisfying its
+    bound is scanned, and those ranges are filtered on the other bound.
+    
+    Peers are identified by their (packed *peer_ip*, *peer_port*) key, see
+    :meth:`trackerfile.PeerTable.records`.
+    """
+    
+    def __init__(self, records=()):
+        self._records = dict(records)
+        self._starts = sorted( (start, end, key)
+                               for key, record in self._records.items()
+                               for start, end in record.spans() )
+        self._ends = sorted( (end, start, key)
+                             for start, end, key in self._starts )
+    
+    
+    def update(self, key, record):
+        """Replace the ranges of the peer *key* with those of
+        :class:`~trackerfile.PeerRecord` *record*, or forget the peer if
+        *record* is None."""
+        old = self._records.pop( key, None )
+        if old is not None:
+            for start, end in old.spans():
+                del self._starts[ bisect.bisect_left( self._starts,
+                                                      (start, end, key) ) ]
+                del self._ends[ bisect.bisect_left( self._ends,
+                                                    (end, start, key) ) ]
+        
+        if record is not None:
+            self._records[key] = record
+            for start, end in record.spans():
+                bisect.insort( self._starts, (start, end, key) )
+                bisect.insort( self._ends, (end, start, key) )
+    
+    
+    def overlapping(self, start, end):
+        """Peers holding any of bytes *start* to *end*.
+        
+        Returns:
+            dict: maps the key of every overlapping peer to (*start*, *end*,
+            :class:`~trackerfile.PeerRecord`), the range of the peer
+            overlapping the most and the peer's record.
+        """
+        before = bisect.bisect_left( self._starts, (end + 1,) )
+        after = bisect.bisect_left( self._ends, (start,) )
+        
+        if before <= len(self._ends) - after:
+            ranges = ( (s, e, key) for s, e, key in self._starts[:before]
+                       if e >= start )
+        else:
+            ranges = ( (s, e, key) for e, s, key in self._ends[after:]
+                       if s <= end )
+        
+        best = {}
+        for s, e, key in ranges:
+            overlap = min( e, end ) - max( s, start )
+            if key not in best or overlap > best[key][0]:
+                best[key] = (overlap, s, e)
+        
+        return { key: (s, e, self._records[key])
+                 for key, (_, s, e) in best.items() }
+
+
+class LockStripes:
+    """Fixed pool of locks handed out to trackers by name.
+    
+    Every tracker maps to one lock, so operations on the same tracker are
+    serialized, while operations on trackers mapped to different locks run
+    in parallel. Memory use is bounded by the number of stripes rather than
+    the number of trackers.
+    
+    Arguments:
+        stripes (int, optional): number of locks. Defaults to
+            :const:`LOCK_STRIPES`.
+    """
+    
+    def __init__(self, stripes=None):
+        if stripes is None:
+            stripes = LOCK_STRIPES
+        
+        self._locks = tuple( threading.RLock() for _ in range(int(stripes)) )
+    
+    
+    def __len__(self):
+        return len(self._locks)
+    
+    
+    def lockFor(self, name):
+        """Get the lock guarding the tracker for *name*.
+        
+        Returns:
+            :class:`threading.RLock`
+        """
+        return self._locks[ hash(name) % len(self._locks) ]
+
+
+class TrackerJournal:
+    """Append-only log of tracker mutations.
+    
+    Each line is one record, with fields separated by spaces and encoded
+    using :func:`apiutils.arg_encode`:
+    
+    ``C name filesize description md5``
+        a tracker was created.
+    ``U name ip port start_byte end_byte timestamp [ranges]``
+        a peer-line was updated or added, with the peer's ranges encoded by
+        :func:`apiutils.ranges_encode` if it has several.
+    ``R name ip port``
+        a peer-line was removed.
+    
+    When the store compacts, the journal is :meth:`rotate`-d: the current
+    file becomes the *old* journal, which is deleted with :meth:`discard`
+    once the .track snapshots are safely on disk. :meth:`replay` applies the
+    old journal and then the current one, so a crash at any point leaves
+    enough information to rebuild the trackers.
+    
+    Arguments:
+        path (str): Path of the journal file.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.old_path = path + '.old'
+        self._file = None
+    
+    
+    def open(self):
+        """Open the journal for appending."""
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding=_ENCODING)
+    
+    
+    def close(self):
+        """Close the journal file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    
+    @staticmethod
+    def encode(fields):
+        """The journal line of the record made of *fields*."""
+        return " ".join( apiutils.arg_encode(str(f)) for f in fields ) + "\n"
+    
+    
+    def append(self, *fields):
+        """Append one record made of *fields* and flush it to the OS."""
+        self.open()
+        self._file.write( self.encode(fields) )
+        self._file.flush()
+    
+    
+    def rotate(self):
+        """Move the current journal aside and start an empty one.
+        
+        Returns:
+            bool: False if there was nothing to rotate.
+        """
+        self.close()
+        
+        if not os.path.exists(self.path):
+            return False
+        
+        #if a previous compaction failed, keep its records
+        if os.path.exists(self.old_path):
+            with open(self.path, 'r', encoding=_ENCODING) as src, \
+                 open(self.old_path, 'a', encoding=_ENCODING) as dst:
+                dst.write( src.read() )
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+        
+        return True
+    
+    
+    def discard(self):
+        """Delete the old journal after a successful compaction."""
+        try:
+            os.remove(self.old_path)
+        except FileNotFoundError:
+            pass
+    
+    
+    def records(self):
+        """Generator of records from the old and then the current journal.
+        
+        Yields:
+            list of str: the decoded fields of each record. Truncated or
+            otherwise unreadable lines are skipped.
+        """
+        for path in (self.old_path, self.path):
+            if not os.path.exists(path):
+                continue
+            
+            with open(path, 'r', encoding=_ENCODING) as fl:
+                for line in fl:
+                    if not line.endswith("\n"):
+                        #partial write, the server died mid-append
+                        continue
+                    
+                    yield [ apiutils.arg_decode(f) for f in line.split() ]
+    
+    
+    def replay(self, trackers):
+        """Apply every journal record to the dict *trackers*.
+        
+        Args:
+            trackers (dict): maps names to :class:`~trackerfile.trackerfile`
+                instances. Modified in place.
+        
+        Returns:
+            set: names of trackers that were created or modified.
+        """
+        touched = set()
+        
+        for fields in self.records():
+            try:
+                op, name, args = fields[0], fields[1], fields[2:]
+                
+                if op == 'C':
+                    if name not in trackers:
+                        trackers[name] = trackerfile.trackerfile( name, *args )
+                
+                elif op == 'U':
+                    ip, port, startb, endb, stamp = args[:5]
+                    stamp = datetime.datetime.utcfromtimestamp( int(stamp) )
+                    ranges = None
+                    if len(args) > 5:
+                        ranges = apiutils.ranges_decode( args[5] )
+                    trackers[name].updatePeer( ip, port, startb, endb, stamp,
+                                               ranges )
+                
+                elif op == 'R':
+                    trackers[name].removePeer( *args )
+                
+                else:
+                    raise ValueError("Unknown journal operation {!r}".format(
+                                                                          op))
+            
+            except Exception as err:
+                print("Bad journal record {!r}: {}".format(fields, err))
+                continue
+            
+            touched.add(name)
+        
+        return touched
+
+
+def splitJournals(torrents_dir, journal_name):
+    """Move the records of every journal in *torrents_dir* to the journal of
+    the tracker they are about.
+    
+    Prefork workers each journal the trackers they own, so when the number
+    of workers changes, records of a tracker may be in a journal which its
+    new owner doesn't replay. Every ``JOURNAL_NAME*`` journal, old and
+    current, is read; if any record is misplaced, the records are regrouped
+    per journal, in their original order, into the old journal of their
+    destination, and the sources are deleted.
+    
+    Must be called while no process has any of the journals open.
+    
+    Args:
+        torrents_dir (str): Directory containing the journals.
+        journal_name (callable): maps the name of a tracker to the name of
+            the journal it belongs in.
+    
+    Returns:
+        int: the number of misplaced records which were moved.
+    """
+    pattern = re.compile( re.escape(JOURNAL_NAME) + r"(\.\d+)?" )
+    
+    try:
+        names = sorted( { flname[:-len(".old")] if flname.endswith(".old")
+                          else flname for flname in os.listdir(torrents_dir) } )
+    except FileNotFoundError:
+        return 0
+    
+    journals = [ TrackerJournal( os.path.join(torrents_dir, name) )
+                 for name in names if pattern.fullmatch(name) ]
+    grouped = collections.OrderedDict()
+    moved = 0
+    
+    for journal in journals:
+        source = os.path.basename( journal.path )
+        
+        for fields in journal.records():
+            if len(fields) < 2:
+                #replaying it would only report it
+                continue
+            
+            target = journal_name( fields[1] )
+            grouped.setdefault( target, [] ).append( fields )
+            if target != source:
+                moved += 1
+    
+    if not moved:
+        return 0
+    
+    for target, records in grouped.items():
+        path = os.path.join( torrents_dir, target ) + '.old'
+        
+        with open( path + '.tmp', 'w', encoding=_ENCODING ) as fl:
+            fl.writelines( TrackerJournal.encode(fields)
+                           for fields in records )
+            fl.flush()
+            os.fsync( fl.fileno() )
+        
+        os.replace( path + '.tmp', path )
+    
+    for journal in journals:
+        name = os.path.basename( journal.path )
+        
+        for path in (journal.path, journal.old_path):
+            if name in grouped and path == journal.old_path:
+                #just replaced by the regrouped records
+                continue
+            
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    return moved
+
+
+class BaseBackend:
+    """Base class for the persistence layer beneath a :class:`TrackerStore`.
+    
+    The store keeps every tracker in memory and only talks to its backend to
+    load trackers at startup, to discover trackers added by somebody else,
+    to record individual mutations, and to write dirty trackers in batches.
+    
+    Note:
+        Should use :class:`TrackFileBackend` or
+        :class:`sqlitestore.SQLiteBackend`, rather than using this directly.
+    """
+    
+    def load(self):
+        """Read every persisted tracker.
+        
+        Returns:
+            tuple: (dict mapping names to :class:`~trackerfile.trackerfile`
+            instances, set of names which need to be written again)
+        """
+        raise NotImplementedError
+    
+    
+    def changed(self):
+        """Whether trackers may have been added since the last :meth:`load` or
+        :meth:`scan`, e.g. by another process. Should be cheap."""
+        return False
+    
+    
+    def scan(self, known):
+        """Read the persisted trackers whose names aren't in *known*.
+        
+        Returns:
+            dict: maps names to :class:`~trackerfile.trackerfile` instances.
+        """
+        return {}
+    
+    
+    def exists(self, name):
+        """Whether a tracker for *name* has been persisted."""
+        raise NotImplementedError
+    
+    
+    def record(self, *fields):
+        """Log a single mutation, formatted as a :class:`TrackerJournal`
+        record. Calls are serialized by the store's journal lock, but made
+        without holding :attr:`TrackerStore.lock`."""
+        pass
+    
+    
+    def beginFlush(self):
+        """Called while holding the store's journal lock, right after the set
+        of dirty trackers was taken and every record made before that was
+        passed to :meth:`record`, and before any tracker is serialized."""
+        pass
+    
+    
+    def serialize(self, name, tf):
+        """Capture tracker *tf*, called while holding its lock.
+        
+        Returns:
+            whatever :meth:`write` needs to persist the tracker.
+        """
+        raise NotImplementedError
+    
+    
+    def write(self, items):
+        """Persist a batch of trackers, without holding any store lock.
+        
+        Args:
+            items (list): (name, value returned by :meth:`serialize`) pairs.
+        
+        Returns:
+            list: names of the trackers which couldn't be written.
+        """
+        raise NotImplementedError
+    
+    
+    def endFlush(self, success):
+        """Called once a flush is over. *success* is False if any tracker
+        failed to be written."""
+        pass
+    
+    
+    def close(self):
+        """Release the backend's resources."""
+        pass
+
+
+class TrackFileBackend(BaseBackend):
+    """Stores each tracker in its own .track file, plus a journal.
+    
+    Mutations are appended to a :class:`TrackerJournal` as they happen, and
+    every flush compacts the journal into the .track files. Each file is
+    written to a temporary path and then renamed, so a .track file is never
+    left half-written. The rotated journal is only deleted once every
+    snapshot made it to disk.
+    
+    Arguments:
+        torrents_dir (str): Directory containing the .track files.
+        journal (bool, optional): whether to journal mutations between
+            flushes. Defaults to True.
+        journal_name (str, optional): name of the journal file in
+            *torrents_dir*. Defaults to :const:`JOURNAL_NAME`.
+        binary (bool, optional): whether to write .track files in the binary
+            format of :mod:`trackerfile`. Files in either format are read.
+            Defaults to False.
+    """
+    
+    def __init__(self, torrents_dir, journal=True, journal_name=JOURNAL_NAME,
+                       binary=False):
+        self.torrents_dir = torrents_dir
+        self.binary = binary
+        self.journal = None
+        self._dir_mtime = None
+        
+        if journal:
+            self.journal = TrackerJournal(
+                                os.path.join( torrents_dir, journal_name ) )
+    
+    
+    def trackPath(self, name):
+        """Path of the .track file for tracked file *name*."""
+        return os.path.join( self.torrents_dir, name + TRACK_EXTENSION )
+    
+    
+    def load(self):
+        """Read every .track file, then replay the journal on top of them.
+        
+        Files that fail to parse are reported and skipped. Trackers touched by
+        the journal need to be written again.
+        """
+        trackers = self.scan( () )
+        dirty = set()
+        
+        if self.journal is not None:
+            dirty = self.journal.replay( trackers )
+        
+        return trackers, dirty
+    
+    
+    def changed(self):
+        """True if the modification time of the torrents directory changed
+        since the last scan, other than by the backend's own writes."""
+        try:
+            return os.stat( self.torrents_dir ).st_mtime_ns != self._dir_mtime
+        except OSError as err:
+            print(err)
+            return False
+    
+    
+    def _dirMtime(self):
+        try:
+            return os.stat( self.torrents_dir ).st_mtime_ns
+        except OSError:
+            return None
+    
+    
+    def _ownChanges(self, before):
+        """Don't count the directory changes the backend itself just made
+        (journal rotation, snapshot renames) as changes for :meth:`changed`.
+        
+        Args:
+            before: modification time of the torrents directory right before
+                the backend's writes. If it already differed from the last
+                scan, something else changed the directory and it is left to
+                trigger a scan.
+        """
+        if before is not None and before == self._dir_mtime:
+            self._dir_mtime = self._dirMtime()
+    
+    
+    def scan(self, known):
+        """Read every .track file whose name isn't in *known*."""
+        
+        #stat first so changes made while listing trigger another scan
+        self._dir_mtime = os.stat( self.torrents_dir ).st_mtime_ns
+        trackers = {}
+        
+        for flname in os.listdir( self.torrents_dir ):
+            name = trackName(flname)
+            if name is None or name in known:
+                continue
+            
+            try:
+                trackers[name] = trackerfile.trackerfile.fromPath(
+                                                        self.trackPath(name) )
+            except Exception as err:
+                print("Skipping {!r}: {}".format(flname, err))
+        
+        return trackers
+    
+    
+    def exists(self, name):
+        return os.path.exists( self.trackPath(name) )
+    
+    
+    def record(self, *fields):
+        """Append *fields* to the journal, if journaling is enabled."""
+        if self.journal is None:
+            return
+        
+        #the first record after a rotation creates the journal file
+        before = self._dirMtime() if self.journal._file is None else None
+        
+        try:
+            self.journal.append( *fields )
+        except OSError as err:
+            print("Failed to append to journal: {}".format(err))
+        
+        self._ownChanges(before)
+    
+    
+    def beginFlush(self):
+        """Rotate the journal."""
+        if self.journal is not None:
+            before = self._dirMtime()
+            self.journal.rotate()
+            self._ownChanges(before)
+    
+    
+    def serialize(self, name, tf):
+        if self.binary:
+            return tf.toBinary()
+        
+        return bytes( tf.toString() + "\n", _ENCODING )
+    
+    
+    def write(self, items):
+        """Write each tracker to its .track file."""
+        failed = []
+        before = self._dirMtime()
+        
+        for name, content in items:
+            path = self.trackPath(name)
+            
+            try:
+                with open(path + '.tmp', 'wb') as fl:
+                    fl.write( content )
+                os.replace( path + '.tmp', path )
+            
+            except OSError as err:
+                print("Failed to write {!r}: {}".format(name, err))
+                failed.append(name)
+        
+        self._ownChanges(before)
+        return failed
+    
+    
+    def endFlush(self, success):
+        """Delete the rotated journal if every tracker was written."""
+        if self.journal is not None and success:
+            before = self._dirMtime()
+            self.journal.discard()
+            self._ownChanges(before)
+    
+    
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+class TrackerStore:
+    """In-memory index of trackers with write-behind persistence.
+    
+    Trackers are keyed by the name of the file they track, which is also the
+    name of their .track file minus :const:`TRACK_EXTENSION`. Every mutation
+    goes through the store so that the tracker can be marked dirty and the
+    change recorded by the backend; dirty trackers are persisted in a batch
+    by :meth:`flush`, which is called every *flush_interval* seconds once
+    :meth:`start` has been called.
+    
+    A tracker is only read or modified while holding its lock from
+    :attr:`locks`. :attr:`lock` is only held briefly, to add trackers, mark
+    them dirty and queue the records of mutations, which are then written to
+    the backend holding only :attr:`journal_lock`.
+    
+    Arguments:
+        backend (:class:`BaseBackend`): Where trackers are persisted.
+        flush_interval (int, optional): seconds between flushes. Defaults to
+            :const:`FLUSH_INTERVAL`.
+        stripes (int, optional): number of per-tracker locks. Defaults to
+            :const:`LOCK_STRIPES`.
+        peer_timeout (int, optional): seconds after which a peer which didn't
+            announce is forgotten. Defaults to
+            :const:`trackerfile.PEER_UPDATE_INTERVAL`.
+        owns (callable, optional): predicate telling whether this store may
+            modify the tracker of a given name; the peers of other trackers
+            are never expired. Defaults to owning every tracker.
+    
+    Attributes:
+        backend (:class:`BaseBackend`): Where trackers are persisted.
+        lock (:class:`threading.RLock`): guards the set of trackers, the set
+            of dirty trackers, the queued journal records and the expiry heap.
+        journal_lock (:class:`threading.Lock`): serializes calls to
+            :meth:`BaseBackend.record` and :meth:`BaseBackend.beginFlush`.
+        locks (:class:`LockStripes`): per-tracker locks guarding the peers
+            of each tracker.
+        catalog_version (int): incremented whenever a tracker is added, so
+            that anything derived from :meth:`catalog` can be cached.
+        epoch (str): random token identifying this store instance, so that
+            tracker versions handed out before a restart aren't mistaken for
+            current ones.
+    """
+    
+    def __init__(self, backend, flush_interval=None, stripes=None,
+                       peer_timeout=None, owns=None):
+        if flush_interval is None:
+            flush_interval = FLUSH_INTERVAL
+        if peer_timeout is None:
+            peer_timeout = trackerfile.PEER_UPDATE_INTERVAL
+        
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.peer_timeout = datetime.timedelta( seconds=peer_timeout )
+        self.owns = owns
+        self.lock = threading.RLock()
+        self.locks = LockStripes( stripes )
+        self.journal_lock = threading.Lock()
+        
+        self.catalog_version = 0
+        self.epoch = os.urandom(4).hex()
+        
+        self._index = CatalogIndex()
+        self._trackers = {}
+        self._dirty = set()
+        self._records = []
+        self._versions = {}
+        self._history = {}
+        self._rendered = {}
+        self._ranges = {}
+        self._searches = collections.OrderedDict()
+        self._expiry = []
+        self._scheduled = set()
+        self._stopped = threading.Event()
+        self._flusher = None
+    
+    
+    def __contains__(self, name):
+        return name in self._trackers
+    
+    
+    def __len__(self):
+        return len(self._trackers)
+    
+    
+    def load(self):
+        """Read every persisted tracker into memory.
+        
+        Trackers the backend wants written again, e.g. because they were
+        recovered from a journal, are marked dirty.
+        
+        Returns:
+            int: the number of trackers loaded.
+        """
+        trackers, dirty = self.backend.load()
+        
+        with self.lock:
+            self._add( trackers )
+            self._dirty.update( dirty )
+        
+        return len(self._trackers)
+    
+    
+    def rescan(self):
+        """Pick up trackers persisted by somebody else.
+        
+        Cheap unless :meth:`BaseBackend.changed` says there may be new
+        trackers, in which case they are loaded. Trackers already in memory
+        are never re-read.
+        
+        Returns:
+            int: the number of trackers added.
+        """
+        if not self.backend.changed():
+            return 0
+        
+        with self.lock:
+            return self._add( self.backend.scan( set(self._trackers) ) )
+    
+    
+    def _add(self, trackers):
+        """Make the trackers in dict *trackers* resident, unless their names
+        already are. Must hold :attr:`lock`.
+        
+        Returns:
+            int: the number of trackers added.
+        """
+        added = 0
+        
+        for name, tf in trackers.items():
+            if name in self._trackers:
+                continue
+            
+            self._trackers[name] = tf
+            self._index.add( name, tf )
+            added += 1
+            
+            if self.owns is None or self.owns(name):
+                for peer, values in tf._peers.items():
+                    self._schedule( name, peer, values[2] )
+        
+        if added:
+            self.catalog_version += 1
+        
+        return added
+    
+    
+    def get(self, name):
+        """Get the resident tracker for *name*, or None if there isn't one.
+        
+        The returned tracker is shared; don't mutate it directly, use the
+        store's methods so it gets flushed.
+        """
+        return self._trackers.get(name)
+    
+    
+    def snapshot(self, name):
+        """Get a private copy of the tracker for *name*.
+        
+        Handy for serializing a tracker without holding its lock while
+        writing to a socket.
+        
+        Returns:
+            :class:`~trackerfile.trackerfile` or None
+        """
+        tf = self._trackers.get(name)
+        if tf is None:
+            return None
+        
+        with self.locks.lockFor(name):
+            copy = trackerfile.trackerfile( tf.filename, tf.filesize,
+                                            tf.description, tf.md5 )
+            copy._peers.update( tf._peers )
+        
+        return copy
+    
+    
+    def version(self, name):
+        """Version of the tracker for *name*, incremented on every change of
+        its peers. Resident trackers start at version 0."""
+        return self._versions.get(name, 0)
+    
+    
+    def rendered(self, name, key, render, cache=None):
+        """Get ``render(tf)`` for the tracker *tf* of *name*, cached until the
+        tracker changes.
+        
+        *render* is called while holding the tracker's lock, so the result
+        is consistent with :meth:`version`. Results are cached per (*name*,
+        *key*), so callers rendering the tracker differently should pass
+        different keys. If *cache* is given, it is called with *tf* under
+        the same lock, and results are only cached if it returns true: a
+        render which differs every time, like a random sample of peers,
+        is rendered afresh for every call.
+        
+        Returns:
+            tuple: (*version*, result of *render*), or None if there is no
+            tracker for *name*.
+        """
+        tf = self._trackers.get(name)
+        if tf is None:
+            return None
+        
+        with self.locks.lockFor(name):
+            version = self._versions.get(name, 0)
+            
+            if cache is not None and not cache(tf):
+                return (version, render(tf))
+            
+            #dropped by _changed whenever the version is bumped
+            rendered = self._rendered.setdefault( name, {} )
+            if key not in rendered:
+                rendered[key] = render(tf)
+            
+            return (version, rendered[key])
+    
+    
+    def changes(self, name, since):
+        """Peers of the tracker for *name* which changed after version
+        *since*.
+        
+        Only the last :const:`DELTA_HISTORY` changes of each tracker are
+        remembered.
+        
+        Returns:
+            tuple: (current *version*, dict mapping every changed peer to its
+            current (*start*, *end*, *timestamp*, *ranges*) values, or to None
+            if it was removed). *ranges* lists every range of the peer if it
+            has several, and is None otherwise. The dict is None if the changes
+            since *since* aren't known anymore, or if *since* is a version
+            from the future.
+        
+        Raises:
+            KeyError: if there is no tracker for *name*.
+        """
+        tf = self._trackers[name]
+        
+        with self.locks.lockFor(name):
+            version = self._versions.get(name, 0)
+            history = self._history.get(name, ())
+            
+            if since > version:
+                return version, None
+            if since < version and history[0][0] > since + 1:
+                return version, None
+            
+            changed = {}
+            for peer_version, peer in history:
+                if peer_version > since:
+                    values = tf._peers.get(peer)
+                    if values is not None:
+                        values += ( tf._peers.extraRanges(peer), )
+                    changed[peer] = values
+        
+        return version, changed
+    
+    
+    def overlapping(self, name, start, end, limit=None):
+        """The freshest peers of *name* holding any of bytes *start* to *end*.
+        
+        Peers are looked up in a :class:`RangeIndex` of the tracker, built on
+        the first lookup and then updated along with the peers. A peer with
+        several overlapping ranges is listed once, with the range overlapping
+        the most.
+        
+        Args:
+            start (int): first byte of the range.
+            end (int): last byte of the range.
+            limit (int, optional): maximum number of peers to return.
+        
+        Returns:
+            tuple: (*total* number of overlapping peers, list of at most
+            *limit* (*peer*, (*start*, *end*, *timestamp*)) pairs), most
+            recently seen first.
+        
+        Raises:
+            KeyError: if there is no tracker for *name*.
+        """
+        tf = self._trackers[name]
+        
+        with self.locks.lockFor(name):
+            index = self._ranges.get(name)
+            if index is None:
+                index = RangeIndex( tf._peers.records() )
+                self._ranges[name] = index
+            
+            matches = index.overlapping( start, end ).items()
+            stamp = lambda match: match[1][2].stamp
+            
+            if limit is None or limit >= len(matches):
+                top = sorted( matches, key=stamp, reverse=True )
+            else:
+                top = heapq.nlargest( limit, matches, key=stamp )
+            
+            return len(matches), [ ( (IPv4Address(key[0]), key[1]),
+                                     (s, e, record.timestamp) )
+                                   for key, (s, e, record) in top ]
+    
+    
+    def trackers(self):
+        """List of (name, tracker) pairs for every resident tracker."""
+        with self.lock:
+            return sorted( self._trackers.items() )
+    
+    
+    def catalog(self):
+        """Metadata of every resident tracker, sorted by name.
+        
+        Returns:
+            tuple: (:attr:`catalog_version`, list of
+            (*filename*, *filesize*, *md5*) tuples)
+        """
+        with self.lock:
+            return self.catalog_version, [ (tf.filename, tf.filesize, tf.md5)
+                                for _, tf in sorted(self._trackers.items()) ]
+    
+    
+    def search(self, terms=(), offset=0, limit=None):
+        """Page through the metadata of trackers matching *terms*.
+        
+        Args:
+            terms (iterable of str): search terms, see :class:`CatalogIndex`.
+            offset (int, optional): number of matches to skip.
+            limit (int, optional): maximum number of matches to return.
+        
+        Returns:
+            tuple: (*total* number of matches, list of
+            (*filename*, *filesize*, *md5*) tuples), sorted by name.
+        
+        The sorted matches of the last :const:`SEARCH_CACHE_SIZE` searches
+        are kept until :attr:`catalog_version` changes, so paging through
+        them doesn't sort them again for every page.
+        """
+        key = tuple(terms)
+        
+        with self.lock:
+            cached = self._searches.get(key)
+            if cached is not None and cached[0] == self.catalog_version:
+                names = cached[1]
+                self._searches.move_to_end(key)
+            else:
+                names = sorted( self._index.search(terms) )
+                self._searches[key] = (self.catalog_version, names)
+                while len(self._searches) > SEARCH_CACHE_SIZE:
+                    self._searches.popitem(last=False)
+            
+            end = None if limit is None else offset + limit
+            page = [ self._trackers[name] for name in names[offset:end] ]
+        
+        return len(names), [ (tf.filename, tf.filesize, tf.md5) for tf in page ]
+    
+    
+    def create(self, name, tf):
+        """Add the new tracker *tf* under *name*.
+        
+        Returns:
+            bool: False if a tracker already exists for *name*.
+        """
+        with self.lock:
+            if name in self._trackers or self.backend.exists(name):
+                return False
+            
+            self._trackers[name] = tf
+            self._index.add( name, tf )
+            self._dirty.add(name)
+            self.catalog_version += 1
+            
+            self._journal( 'C', name, tf.filesize, tf.description, tf.md5 )
+            for peer, values in tf._peers.items():
+                self._journal( *self._peerRecord( name, peer, values ) )
+                self._schedule( name, peer, values[2] )
+        
+        self._writeJournal()
+        return True
+    
+    
+    def updatePeer(self, name, peer_ip, peer_port, start_byte, end_byte,
+                         ranges=None):
+        """Update or add a peer-line in the tracker for *name*.
+        
+        *ranges* lists every range the peer has, if more than one, see
+        :meth:`trackerfile.updatePeer`.
+        
+        Raises:
+            KeyError: if there is no tracker for *name*.
+            All exceptions raisable by :meth:`trackerfile.updatePeer`
+        """
+        peer_ip, peer_port = IPv4Address(peer_ip), int(peer_port)
+        peer = (peer_ip, peer_port)
+        tf = self._trackers[name]
+        
+        with self.locks.lockFor(name):
+            tf.updatePeer( peer_ip, peer_port, start_byte, end_byte,
+                           ranges=ranges )
+            values = tf._peers[peer]
+            
+            with self.lock:
+                self._changed( name, peer,
+                               *self._peerRecord( name, peer, values,
+                                            tf._peers.extraRanges(peer) ) )
+                self._schedule( name, peer, values[2] )
+        
+        self._writeJournal()
+    
+    
+    def removePeer(self, name, peer_ip, peer_port):
+        """Remove the peer-line for (*peer_ip*, *peer_port*) from *name*.
+        
+        Returns:
+            bool: True if the peer was removed.
+        
+        Raises:
+            KeyError: if there is no tracker for *name*.
+        """
+        peer = (IPv4Address(peer_ip), int(peer_port))
+        tf = self._trackers[name]
+        
+        with self.locks.lockFor(name):
+            removed = tf.removePeer( *peer )
+            if removed:
+                self._changed( name, peer, 'R', name, peer[0], peer[1] )
+        
+        self._writeJournal()
+        return removed
+    
+    
+    def expire(self, now=None):
+        """Forget the peers which haven't announced for :attr:`peer_timeout`.
+        
+        Every peer has one entry on a heap of expiry times, so this only pops
+        the entries which are due instead of sweeping every peer. If the peer
+        announced again since its entry was pushed, the entry is pushed back
+        with the new expiry time. Removals are recorded like any other
+        mutation.
+        
+        Args:
+            now (:class:`datetime.datetime`, optional): UTC time to expire
+                peers at. Defaults to now.
+        
+        Returns:
+            int: the number of peers removed.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        
+        due = []
+        with self.lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                due.append( heapq.heappop(self._expiry) )
+        
+        removed = 0
+        
+        for _, name, peer in due:
+            tf = self._trackers[name]
+            
+            with self.locks.lockFor(name):
+                values = tf._peers.get(peer)
+                
+                with self.lock:
+                    if values is None:
+                        self._scheduled.discard( (name, peer) )
+                    
+                    elif values[2] + self.peer_timeout > now:
+                        heapq.heappush( self._expiry,
+                                (values[2] + self.peer_timeout, name, peer) )
+                    
+                    else:
+                        tf.removePeer( *peer )
+                        self._scheduled.discard( (name, peer) )
+                        self._changed( name, peer,
+                                       'R', name, peer[0], peer[1] )
+                        removed += 1
+        
+        self._writeJournal()
+        return removed
+    
+    
+    def _schedule(self, name, peer, timestamp):
+        """Push the expiry of *peer*, last seen at *timestamp*, onto the
+        expiry heap unless it already has an entry. Must hold :attr:`lock`.
+        """
+        if (name, peer) in self._scheduled:
+            return
+        
+        self._scheduled.add( (name, peer) )
+        heapq.heappush( self._expiry,
+                        (timestamp + self.peer_timeout, name, peer) )
+    
+    
+    def _changed(self, name, peer, *record):
+        """Mark *name* dirty, bump its version, remember that *peer* changed,
+        record *record*, if any, and update the peer in the range index.
+        
+        Must hold the lock for *name*. Marking and queueing the record happen
+        under :attr:`lock`, so that :meth:`flush` sees either both or neither:
+        a journaled change is never dropped by a compaction without having
+        been written to the .track file. The caller writes the record out with
+        :meth:`_writeJournal` once it released its locks.
+        """
+        with self.lock:
+            self._dirty.add(name)
+            version = self._versions.get(name, 0) + 1
+            self._versions[name] = version
+            self._rendered.pop( name, None )
+            
+            history = self._history.get(name)
+            if history is None:
+                history = collections.deque( maxlen=DELTA_HISTORY )
+                self._history[name] = history
+            history.append( (version, peer) )
+            
+            if record:
+                self._journal( *record )
+        
+        index = self._ranges.get(name)
+        if index is not None:
+            index.update( trackerfile.PeerTable.recordKey(peer),
+                          self._trackers[name]._peers.record(peer) )
+    
+    
+    def _journal(self, *fields):
+        """Queue a mutation record for the backend. Must hold :attr:`lock`."""
+        self._records.append( fields )
+    
+    
+    def _writeJournal(self):
+        """Pass the queued mutation records on to the backend, in order.
+        
+        Only :attr:`journal_lock` is held while the backend writes, so changes
+        to other trackers aren't held up by the journal's disk I/O. If another
+        thread is already writing, it also writes the records queued by this
+        one; whichever thread last released :attr:`journal_lock` checks for
+        records queued in the meantime.
+        """
+        while self._records:
+            if not self.journal_lock.acquire( blocking=False ):
+                return
+            
+            try:
+                with self.lock:
+                    records, self._records = self._records, []
+                
+                for fields in records:
+                    self.backend.record( *fields )
+            finally:
+                self.journal_lock.release()
+    
+    
+    def _peerRecord(self, name, peer, values, ranges=None):
+        """Journal record fields for an update of *peer* in tracker *name*,
+        which has *ranges* if it has more than its main range."""
+        record = ( 'U', name, peer[0], peer[1], values[0], values[1],
+                   int(values[2].timestamp()) )
+        
+        if ranges:
+            record += ( apiutils.ranges_encode(ranges), )
+        
+        return record
+    
+    
+    def flush(self):
+        """Persist every dirty tracker through the backend.
+        
+        The set of dirty trackers and the queued journal records are taken
+        while holding :attr:`lock`; the records are then written and
+        :meth:`BaseBackend.beginFlush` called while holding
+        :attr:`journal_lock`, so every record of a change being flushed
+        precedes the journal rotation. Each tracker is then serialized under
+        its own lock, and the batch is written without holding any lock.
+        Trackers which fail to be written stay dirty.
+        
+        Returns:
+            int: the number of trackers written.
+        """
+        with self.journal_lock:
+            with self.lock:
+                dirty, self._dirty = self._dirty, set()
+                records, self._records = self._records, []
+            
+            for fields in records:
+                self.backend.record( *fields )
+            
+            if dirty:
+                self.backend.beginFlush()
+        
+        #records queued while the journal lock was held belong after the
+        #rotation
+        self._writeJournal()
+        
+        if not dirty:
+            return 0
+        
+        items = []
+        for name in dirty:
+            with self.locks.lockFor(name):
+                items.append( (name, self.backend.serialize( name,
+                                                    self._trackers[name] )) )
+        
+        failed = self.backend.write( items )
+        
+        if failed:
+            with self.lock:
+                self._dirty.update( failed )
+        
+        self.backend.endFlush( not failed )
+        
+        return len(items) - len(failed)
+    
+    
+    def start(self):
+        """Start the background flusher thread."""
+        if self._flusher is not None:
+            return
+        
+        self._stopped.clear()
+        self._flusher = threading.Thread( name="tracker_flusher",
+                                          target=self._flushLoop, daemon=True )
+        self._flusher.start()
+    
+    
+    def stop(self):
+        """Stop the background flusher thread and flush one last time."""
+        if self._flusher is not None:
+            self._stopped.set()
+            self._flusher.join()
+            self._flusher = None
+        
+        self.flush()
+        self.backend.close()
+    
+    
+    def _flushLoop(self):
+        """Body of the flusher thread, which also expires peers."""
+        while not self._stopped.wait( self.flush_interval ):
+            expired = self.expire()
+            if expired:
+                print("Expired {} peer(s).".format(expired))
+            
+            written = self.flush()
+            if written:
+                print("Flushed {} tracker(s) to disk.".format(written))